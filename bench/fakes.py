@@ -0,0 +1,304 @@
+"""
+Local stand-ins for every upstream the worker talks to, for bench/load.py.
+
+Each fake is an aiohttp app on its own port with its own Fault settings:
+a latency distribution, an error rate (HTTP 500) and a 429 rate. Fault
+specs are strings such as "lat=lognormal:800:0.5,err=0.01,429=0.05".
+"""
+import asyncio
+import base64
+import itertools
+import math
+import random
+import time
+import uuid
+from collections import Counter
+from dataclasses import dataclass
+
+import jwt
+from aiohttp import web
+
+# 1x1 PNG, returned by the Gemini stub and served as input media
+PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=="
+)
+
+
+@dataclass
+class Fault:
+    dist: str = "fixed"      # fixed | uniform | lognormal
+    latency_ms: float = 0    # fixed value, uniform upper bound or lognormal median
+    sigma: float = 0.5       # lognormal shape
+    error_rate: float = 0.0
+    throttle_rate: float = 0.0
+    retry_after: int = 1
+
+    @classmethod
+    def parse(cls, spec: str) -> "Fault":
+        f = cls()
+        for part in filter(None, (p.strip() for p in spec.split(","))):
+            key, _, value = part.partition("=")
+            if key == "lat":
+                bits = value.split(":")
+                if len(bits) == 1:
+                    f.latency_ms = float(bits[0])
+                else:
+                    f.dist, f.latency_ms = bits[0], float(bits[1])
+                    if len(bits) > 2:
+                        f.sigma = float(bits[2])
+            elif key == "err":
+                f.error_rate = float(value)
+            elif key == "429":
+                f.throttle_rate = float(value)
+            elif key == "retry_after":
+                f.retry_after = int(value)
+            else:
+                raise ValueError(f"Unknown fault option: {key}")
+        return f
+
+    def delay(self) -> float:
+        if self.dist == "uniform":
+            ms = random.uniform(0, self.latency_ms)
+        elif self.dist == "lognormal":
+            ms = random.lognormvariate(math.log(max(self.latency_ms, 1e-3)), self.sigma)
+        else:
+            ms = self.latency_ms
+        return ms / 1000
+
+
+class Fake:
+    name = "fake"
+
+    def __init__(self, fault: Fault):
+        self.fault = fault
+        self.counts = Counter()
+        # API keys answered with 401; with track_keys requests are counted per key
+        self.revoked: set[str] = set()
+        self.track_keys = False
+        self.app = web.Application(middlewares=[self._inject], client_max_size=64 << 20)
+        self.routes(self.app.router)
+        self._runner = None
+        self.url = None
+
+    def routes(self, router):
+        raise NotImplementedError
+
+    def throttled(self) -> web.Response:
+        return web.json_response({"error": "rate limited"}, status=429,
+                                 headers={"Retry-After": str(self.fault.retry_after)})
+
+    @staticmethod
+    def api_key(request) -> str | None:
+        key = request.headers.get("x-goog-api-key") or request.query.get("key")
+        bearer = request.headers.get("Authorization", "").removeprefix("Bearer ")
+        if key or not bearer:
+            return key
+        try:
+            # Kling: a JWT whose issuer is the access key
+            return jwt.decode(bearer, options={"verify_signature": False})["iss"]
+        except jwt.PyJWTError:
+            return bearer
+
+    @web.middleware
+    async def _inject(self, request, handler):
+        self.counts["requests"] += 1
+        if self.revoked or self.track_keys:
+            key = self.api_key(request)
+            if self.track_keys:
+                self.counts[f"key:{key}"] += 1
+            if key in self.revoked:
+                self.counts["401"] += 1
+                return web.json_response({"error": "invalid api key"}, status=401)
+        await asyncio.sleep(self.fault.delay())
+        roll = random.random()
+        if roll < self.fault.throttle_rate:
+            self.counts["429"] += 1
+            return self.throttled()
+        if roll < self.fault.throttle_rate + self.fault.error_rate:
+            self.counts["500"] += 1
+            return web.json_response({"error": "injected failure"}, status=500)
+        return await handler(request)
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+class TelegramFake(Fake):
+    name = "telegram"
+
+    def __init__(self, fault: Fault):
+        super().__init__(fault)
+        self._message_ids = itertools.count(1)
+
+    def routes(self, router):
+        router.add_post("/bot{token}/{method}", self.call)
+
+    def throttled(self):
+        return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests",
+                                  "parameters": {"retry_after": self.fault.retry_after}}, status=429)
+
+    async def call(self, request):
+        method = request.match_info["method"]
+        await request.read()
+        self.counts[method] += 1
+        return web.json_response({"ok": True, "result": {"message_id": next(self._message_ids)}})
+
+
+class GeminiFake(Fake):
+    name = "gemini"
+
+    def routes(self, router):
+        router.add_post("/{version}/models/{model}", self.generate)
+
+    async def generate(self, request):
+        await request.read()
+        self.counts[request.match_info["model"]] += 1
+        return web.json_response({
+            "candidates": [{
+                "content": {"role": "model",
+                            "parts": [{"inlineData": {"mimeType": "image/png",
+                                                      "data": base64.b64encode(PNG).decode()}}]},
+                "finishReason": "STOP",
+            }],
+        })
+
+
+class KlingFake(Fake):
+    name = "kling"
+
+    def routes(self, router):
+        router.add_post("/v1/videos/{kind}", self.create)
+        router.add_get("/v1/videos/{kind}/{task_id}", self.query)
+
+    async def create(self, request):
+        await request.json()
+        self.counts[request.match_info["kind"]] += 1
+        return web.json_response({"code": 0, "data": {"task_id": uuid.uuid4().hex}})
+
+    async def query(self, request):
+        self.counts["query"] += 1
+        task_id = request.match_info["task_id"]
+        return web.json_response({"code": 0, "data": {
+            "task_id": task_id, "task_status": "succeed",
+            "task_result": {"videos": [{"id": task_id, "url": f"{self.url}/outputs/{task_id}.mp4", "duration": "5"}]},
+        }})
+
+
+class RunwayFake(Fake):
+    """Tasks run for `task_s` seconds; polls report linear progress."""
+
+    name = "runway"
+
+    def __init__(self, fault: Fault, task_s: float = 10, fail_rate: float = 0.0):
+        super().__init__(fault)
+        self.task_s = task_s
+        self.fail_rate = fail_rate
+        self.tasks: dict[str, tuple[float, bool]] = {}
+
+    def routes(self, router):
+        router.add_get("/v1/tasks/{task_id}", self.get_task)
+        router.add_post("/v1/{kind}", self.create)
+
+    async def create(self, request):
+        await request.json()
+        task_id = uuid.uuid4().hex
+        self.tasks[task_id] = (time.monotonic(), random.random() < self.fail_rate)
+        self.counts["create"] += 1
+        return web.json_response({"id": task_id})
+
+    async def get_task(self, request):
+        task_id = request.match_info["task_id"]
+        self.counts["poll"] += 1
+        if task_id not in self.tasks:
+            return web.json_response({"error": "not found"}, status=404)
+        started, fails = self.tasks[task_id]
+        progress = (time.monotonic() - started) / self.task_s
+        if progress < 1:
+            return web.json_response({"id": task_id, "status": "RUNNING", "progress": round(progress, 2)})
+        if fails:
+            return web.json_response({"id": task_id, "status": "FAILED", "failure": "injected failure"})
+        return web.json_response({"id": task_id, "status": "SUCCEEDED",
+                                  "output": [f"{self.url}/outputs/{task_id}.mp4"]})
+
+
+class KieFake(Fake):
+    name = "kie"
+
+    def routes(self, router):
+        router.add_post("/{path:.*}", self.create)
+
+    async def create(self, request):
+        await request.json()
+        self.counts["create"] += 1
+        return web.json_response({"code": 200, "msg": "success", "data": {"taskId": uuid.uuid4().hex}})
+
+
+class OsonFake(Fake):
+    """
+    Records every status call with its arrival time; load.py uses these as
+    the end of a job.
+    """
+
+    name = "oson"
+
+    def __init__(self, fault: Fault):
+        super().__init__(fault)
+        self.events: dict[int, list[tuple[float, str]]] = {}
+        self.changed = asyncio.Event()
+
+    def routes(self, router):
+        router.add_post("/api/job-status", self.job_status)
+        router.add_post("/api/runway/status", self.runway_status)
+        router.add_post("/kling/status", self.kling_status)
+        router.add_post("/api/status/bulk", self.bulk_status)
+
+    def _record(self, job_id, status: str):
+        self.counts[status] += 1
+        self.events.setdefault(int(job_id), []).append((time.time(), status))
+        self.changed.set()
+
+    async def job_status(self, request):
+        data = await request.json()
+        self._record(data["job_id"], data["status"])
+        return web.json_response({"ok": True})
+
+    async def runway_status(self, request):
+        data = await request.json()
+        self._record(data["job_id"], "RUNWAY_SUCCEEDED")
+        return web.json_response({"ok": True})
+
+    async def bulk_status(self, request):
+        data = await request.json()
+        self.counts["bulk"] += 1
+        for event in data["events"]:
+            self._record(event["job_id"], event.get("status") or "RUNWAY_SUCCEEDED")
+        return web.json_response({"ok": True})
+
+    async def kling_status(self, request):
+        await request.read()
+        self.counts["kling_callback"] += 1
+        return web.json_response({"ok": True})
+
+
+class MediaFake(Fake):
+    """Serves input images for the Gemini handlers' downloads."""
+
+    name = "media"
+
+    def routes(self, router):
+        router.add_get("/images/{name}", self.image)
+
+    async def image(self, request):
+        self.counts["image"] += 1
+        return web.Response(body=PNG, content_type="image/png",
+                            headers={"ETag": '"png-1x1"', "Cache-Control": "max-age=600"})
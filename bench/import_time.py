@@ -0,0 +1,61 @@
+"""
+Import-time check of the worker, for CI and before/after a change:
+
+    python -m bench.import_time [--budget-s 0.5] [--runs 5]
+
+Imports worker.worker_settings in fresh interpreters with no settings in
+the environment and exits 1 when the best run is over the budget or when
+a module that must load lazily (a provider SDK) was imported.
+tests/test_import_time.py runs the same probe under pytest.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# loaded with the first job that needs them (worker.handlers, config.gemini_client)
+LAZY = ("google.genai", "worker.handlers.gemini2", "worker.handlers.gemini3", "worker.handlers.kling", "PIL")
+
+PROBE = """
+import json, sys, time
+t = time.perf_counter()
+import worker.worker_settings
+print(json.dumps({"s": time.perf_counter() - t, "modules": len(sys.modules),
+                  "lazy": [m for m in %r if m in sys.modules]}))
+""" % (LAZY,)
+
+# settings the worker reads; unset, to check importing no longer needs them
+SETTINGS = ("BOT_TOKEN", "GEMINI_API_KEY", "KIE_API_KEY", "RUNWAY_API_KEY", "KLING_ACCESS_KEY", "KLING_SECRET_KEY")
+
+
+def probe() -> dict:
+    env = {k: v for k, v in os.environ.items() if k not in SETTINGS}
+    out = subprocess.run([sys.executable, "-c", PROBE], env=env, capture_output=True, text=True)
+    if out.returncode != 0:
+        raise SystemExit(f"import failed:\n{out.stderr}")
+    return json.loads(out.stdout)
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--budget-s", type=float, default=float(os.getenv("IMPORT_BUDGET_S", "0.5")))
+    p.add_argument("--runs", type=int, default=5)
+    args = p.parse_args()
+
+    runs = [probe() for _ in range(args.runs)]
+    best = min(r["s"] for r in runs)
+    print(f"import worker.worker_settings: best {best:.3f}s of {args.runs}, {runs[0]['modules']} modules")
+
+    failed = False
+    if runs[0]["lazy"]:
+        print(f"FAIL: imported eagerly: {', '.join(runs[0]['lazy'])}")
+        failed = True
+    if best > args.budget_s:
+        print(f"FAIL: over the {args.budget_s}s budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Micro-benchmark of the RPM algorithms in worker.limiter against a real Redis.
+
+    REDIS_URL=redis://localhost:6379/15 python -m bench.limiter_bench
+
+The database is flushed before each run, so point it at a scratch DB.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+from redis.asyncio import Redis
+
+from worker.limiter import RPM_KEYS, RateLimiter
+
+
+async def bench(redis: Redis, algorithm: str, rpm: int, n: int, concurrency: int) -> dict:
+    await redis.flushdb()
+    limiter = RateLimiter(redis)
+    model_key = f"bench_{algorithm}"
+    latencies = []
+
+    async def one():
+        t = time.perf_counter()
+        # window large enough that nothing is rejected: we measure the cost of a grant
+        await limiter.acquire(model_key, rpm=rpm, concurrency=None, window_s=3600, algorithm=algorithm)
+        latencies.append(time.perf_counter() - t)
+
+    sem = asyncio.Semaphore(concurrency)
+
+    async def bounded():
+        async with sem:
+            await one()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(bounded() for _ in range(n)))
+    elapsed = time.perf_counter() - start
+
+    state_key = f"{RPM_KEYS[algorithm]}{model_key}"
+    memory = await redis.memory_usage(state_key) or 0
+    latencies.sort()
+    return {
+        "algorithm": algorithm,
+        "ops_s": n / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        "state_bytes": memory,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rpm", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    redis = Redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/15"))
+    n = args.rpm  # fill the window exactly: no waiting, only grants
+    print(f"{n} acquires, rpm={args.rpm}, {args.concurrency} concurrent")
+    print(f"{'algorithm':<10} {'ops/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'state B':>9}")
+    for algorithm in RPM_KEYS:
+        r = await bench(redis, algorithm, args.rpm, n, args.concurrency)
+        print(f"{r['algorithm']:<10} {r['ops_s']:>10.0f} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f} {r['state_bytes']:>9}")
+    await redis.flushdb()
+    await redis.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,421 @@
+"""
+End-to-end load test: real `WorkerSettings` workers against local fakes.
+
+    pip install -r bench/requirements.txt
+    python -m bench.load --jobs 500 --rate 50 --workers 2 \
+        --fault gemini=lat=lognormal:1500:0.4,429=0.02 --fault telegram=lat=40,429=0.01
+
+Workers are started as `python -m worker` subprocesses (the multi-queue
+worker with --queue-per-kind) with every upstream URL pointed at
+bench/fakes.py servers running in this process. Redis is REDIS_URL if
+set (the DB is flushed, default db 15), else a throwaway `redis-server`
+from PATH or from the redislite wheel. The limiter needs real Lua, so
+fakeredis can't stand in here.
+
+Reported: jobs/s, end-to-end and queue latency percentiles per kind,
+limiter wait (scraped from the workers' /metrics), outcomes, peak RSS per
+worker and what each fake saw (requests, injected 429s and 500s).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from urllib.parse import urlparse
+
+import httpx
+from arq import create_pool
+from arq.connections import RedisSettings
+from arq.constants import result_key_prefix
+from arq.jobs import deserialize_result
+from prometheus_client.parser import text_string_to_metric_families
+
+from bench.fakes import (Fault, GeminiFake, KieFake, KlingFake, MediaFake, OsonFake, RunwayFake,
+                         TelegramFake)
+
+QUEUE = "bench:queue"
+DEFAULT_MIX = "gemini_2_5_image=5,gemini_3_image=2,kling_2_6_video=1,kieapi=1,runway=1"
+
+# what the fake Oson backend sees as the end of a job, per kind
+TERMINAL = {
+    "runway": {"RUNWAY_SUCCEEDED", "FAILED"},
+    "kling_2_6_video": {"PROCESSING", "FAILED"},
+    "kieapi": {"PROCESSING", "FAILED"},
+}
+DEFAULT_TERMINAL = {"FINISHED", "FAILED"}
+# worker.outbox.STREAM_KEY: status events not yet accepted by the backend
+OUTBOX_STREAM = "oson:outbox"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def pct(values: list[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def peak_rss_mb(pid: int) -> float:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return float("nan")
+
+
+class RedisProcess:
+    """REDIS_URL or a private redis-server."""
+
+    def __init__(self):
+        self.kind = None
+        self._proc = None
+
+    def start(self) -> RedisSettings:
+        url = os.getenv("REDIS_URL")
+        if url:
+            self.kind = "external"
+            u = urlparse(url)
+            return RedisSettings(host=u.hostname or "localhost", port=u.port or 6379,
+                                 database=int(u.path.lstrip("/") or 15), password=u.password)
+
+        binary = shutil.which("redis-server")
+        self.kind = "redis-server"
+        if not binary:
+            try:
+                import redislite
+            except ImportError:
+                raise RuntimeError("set REDIS_URL, put redis-server on PATH or pip install redislite")
+            binary = redislite.__redis_executable__
+            self.kind = "redislite"
+
+        port = free_port()
+        self._proc = subprocess.Popen([binary, "--port", str(port), "--save", "", "--appendonly", "no"],
+                                      stdout=subprocess.DEVNULL)
+        for _ in range(50):
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        return RedisSettings(host="127.0.0.1", port=port, database=0)
+
+    def close(self):
+        if self._proc is not None:
+            self._proc.terminate()
+            self._proc.wait()
+
+
+class Payloads:
+    def __init__(self, media_url: str, images: int, paid_share: float, users: int):
+        self.media_url = media_url
+        self.images = images
+        self.paid_share = paid_share
+        self.users = users
+        self._ids = iter(range(1, 1 << 31))
+
+    def make(self, kind: str) -> tuple[str, dict, int]:
+        job_id = next(self._ids)
+        user_id = random.randint(1, self.users)
+        prompt = f"bench prompt {job_id}"
+        if kind == "runway":
+            return "runway_create", {
+                "job_id": job_id, "user_id": user_id, "media_type": "Video",
+                "request_url": "/v1/image_to_video", "body": {"promptText": prompt},
+            }, user_id
+
+        payload = {"job_id": job_id, "model_key": kind, "is_test": False, "media_type": "Rasm",
+                   "prompt": prompt, "body": {"prompt": prompt},
+                   "lane": "paid" if random.random() < self.paid_share else "free"}
+        if kind.startswith("gemini"):
+            payload["images"] = [f"{self.media_url}/images/{random.randint(1, 50)}.png"
+                                 for _ in range(self.images)]
+            payload.update(aspect_ratio="1:1", quality="1K")
+        elif kind == "kling_2_6_video":
+            payload.update(generation_type="image2video", duration="5", sound="off", image=None,
+                           image_tail=None, aspect_ratio="16:9")
+        elif kind == "kieapi":
+            payload["request_url"] = "/api/v1/jobs/createTask"
+        return "generate_and_send", payload, user_id
+
+
+def parse_mix(spec: str) -> list[tuple[str, float]]:
+    mix = []
+    for part in spec.split(","):
+        kind, _, weight = part.partition("=")
+        mix.append((kind.strip(), float(weight or 1)))
+    return mix
+
+
+def scrape_limiter_wait(text: str) -> dict[str, dict]:
+    buckets: dict[str, list[tuple[float, float]]] = defaultdict(list)
+    totals: dict[str, dict] = defaultdict(lambda: {"sum": 0.0, "count": 0.0})
+    for family in text_string_to_metric_families(text):
+        if family.name != "worker_limiter_wait_seconds":
+            continue
+        for s in family.samples:
+            model = s.labels.get("model_key")
+            if s.name.endswith("_bucket"):
+                buckets[model].append((float(s.labels["le"]), s.value))
+            elif s.name.endswith("_sum"):
+                totals[model]["sum"] += s.value
+            elif s.name.endswith("_count"):
+                totals[model]["count"] += s.value
+    for model, b in buckets.items():
+        totals[model]["buckets"] = sorted(b)
+    return totals
+
+
+def bucket_quantile(buckets: list[tuple[float, float]], q: float) -> float:
+    if not buckets or not buckets[-1][1]:
+        return float("nan")
+    rank = q * buckets[-1][1]
+    for le, count in buckets:
+        if count >= rank:
+            return le
+    return float("inf")
+
+
+async def run(args) -> dict:
+    faults = {name: Fault.parse(spec) for name, spec in (f.split("=", 1) for f in args.fault)}
+    fakes = {
+        "telegram": TelegramFake(faults.get("telegram", Fault())),
+        "gemini": GeminiFake(faults.get("gemini", Fault(latency_ms=200))),
+        "kling": KlingFake(faults.get("kling", Fault(latency_ms=100))),
+        "runway": RunwayFake(faults.get("runway", Fault(latency_ms=50)), task_s=args.runway_task_s),
+        "kie": KieFake(faults.get("kie", Fault(latency_ms=100))),
+        "oson": OsonFake(faults.get("oson", Fault())),
+        "media": MediaFake(faults.get("media", Fault())),
+    }
+    for fake in fakes.values():
+        await fake.start()
+
+    redis_proc = RedisProcess()
+    settings = redis_proc.start()
+    pool = await create_pool(settings)
+    if redis_proc.kind == "external":
+        await pool.flushdb()
+
+    env = {
+        "BOT_TOKEN": "bench", "GEMINI_API_KEY": "bench", "SERVER_API_KEY": "bench",
+        "KLING_ACCESS_KEY": "bench", "KLING_SECRET_KEY": "bench",
+        "KIE_API_KEY": "bench", "RUNWAY_API_KEY": "bench",
+        "TELEGRAM_API_URL": fakes["telegram"].url, "GEMINI_BASE_URL": fakes["gemini"].url,
+        "KLING_API_URL": fakes["kling"].url, "RUNWAY_API_URL": fakes["runway"].url,
+        "KIE_API_URL": fakes["kie"].url, "BASE_URL": fakes["oson"].url,
+        "RUNWAY_FIRST_POLL_S": "1", "RUNWAY_MIN_INTERVAL_S": "1", "RUNWAY_POLL_TICK_S": "0.5",
+        "ARQ_MAX_JOBS": str(args.max_jobs),
+        **os.environ,
+        "REDIS_HOST": settings.host, "REDIS_PORT": str(settings.port), "REDIS_DB": str(settings.database),
+        "ARQ_QUEUE": QUEUE,
+    }
+    if settings.password:
+        env["REDIS_PASSWORD"] = settings.password
+    if args.oson_bulk:
+        env["OSON_BULK_STATUS_PATH"] = "/api/status/bulk"
+    if args.keys > 1 or args.revoked_keys:
+        # one pool of args.keys accounts per provider, the first args.revoked_keys answered with 401
+        keys = [f"bench-k{i}" for i in range(max(args.keys, 1))]
+        env.update({name: ",".join(keys) for name in ("GEMINI_API_KEYS", "KIE_API_KEYS", "RUNWAY_API_KEYS")})
+        env["KLING_KEYS"] = ",".join(f"{key}:bench" for key in keys)
+        for name in ("gemini", "kling", "runway", "kie"):
+            fakes[name].track_keys = True
+            fakes[name].revoked = set(keys[:args.revoked_keys])
+    if args.queue_per_kind:
+        env["ARQ_QUEUES"] = ",".join(f"{QUEUE}:{kind};model={kind}" for kind, _ in parse_mix(args.mix))
+
+    workers = []
+    log_dir = tempfile.mkdtemp(prefix="bench-")
+    for i in range(args.workers):
+        port = free_port()
+        log = open(os.path.join(log_dir, f"worker-{i}.log"), "w")
+        proc = subprocess.Popen([sys.executable, "-m", "worker"],
+                                env={**env, "METRICS_PORT": str(port)}, stdout=log, stderr=subprocess.STDOUT)
+        workers.append((proc, port))
+
+    metrics_client = httpx.AsyncClient(timeout=5)
+    for proc, port in workers:
+        for _ in range(100):
+            if proc.poll() is not None:
+                raise RuntimeError(f"worker exited with {proc.returncode}, see {log_dir}")
+            try:
+                await metrics_client.get(f"http://127.0.0.1:{port}/metrics")
+                break
+            except httpx.HTTPError:
+                await asyncio.sleep(0.2)
+
+    payloads = Payloads(fakes["media"].url, args.images, args.paid_share, args.users)
+    mix = parse_mix(args.mix)
+    kinds, weights = zip(*mix)
+    jobs: dict[str, dict] = {}
+
+    start = time.time()
+    for n in range(args.jobs):
+        kind = random.choices(kinds, weights)[0]
+        function, payload, user_id = payloads.make(kind)
+        job_args = (payload, user_id) if function == "generate_and_send" else (payload,)
+        queue = f"{QUEUE}:{kind}" if args.queue_per_kind else QUEUE
+        job = await pool.enqueue_job(function, *job_args, _queue_name=queue)
+        jobs[job.job_id] = {"kind": kind, "job_id": payload["job_id"], "enqueued": time.time()}
+        if args.rate:
+            await asyncio.sleep(max(0.0, start + (n + 1) / args.rate - time.time()))
+    enqueued_s = time.time() - start
+
+    oson = fakes["oson"]
+    pending = set(jobs)
+    deadline = time.time() + args.timeout
+    while pending and time.time() < deadline:
+        ids = list(pending)
+        # read before the events: once it is empty every status sent so far has reached the fake
+        outbox_drained = not await pool.xlen(OUTBOX_STREAM)
+        raw = await pool.mget([result_key_prefix + job_id for job_id in ids])
+        for job_id, r in zip(ids, raw):
+            job = jobs[job_id]
+            if r is not None and "result" not in job:
+                result = deserialize_result(r)
+                job.update(result=result, queued=(result.start_time - result.enqueue_time).total_seconds())
+            if "result" not in job:
+                continue
+            terminal = TERMINAL.get(job["kind"], DEFAULT_TERMINAL)
+            events = [e for e in oson.events.get(job["job_id"], []) if e[1] in terminal]
+            if events:
+                job.update(done=events[0][0], outcome=events[0][1])
+            elif not job["result"].success:
+                job.update(done=job["result"].finish_time.timestamp(), outcome="error")
+            elif job["kind"] != "runway" and outbox_drained:
+                # returned without a status call: limiter budget timeout
+                job.update(done=job["result"].finish_time.timestamp(), outcome="no_status")
+            if "done" in job:
+                pending.discard(job_id)
+        if pending:
+            oson.changed.clear()
+            try:
+                await asyncio.wait_for(oson.changed.wait(), timeout=0.5)
+            except asyncio.TimeoutError:
+                pass
+    finished = [j for j in jobs.values() if "done" in j]
+    elapsed = max((j["done"] for j in finished), default=time.time()) - start
+
+    limiter = defaultdict(lambda: {"sum": 0.0, "count": 0.0, "buckets": Counter()})
+    for proc, port in workers:
+        try:
+            text = (await metrics_client.get(f"http://127.0.0.1:{port}/metrics")).text
+        except httpx.HTTPError:
+            continue
+        for model, t in scrape_limiter_wait(text).items():
+            limiter[model]["sum"] += t["sum"]
+            limiter[model]["count"] += t["count"]
+            for le, count in t.get("buckets", []):
+                limiter[model]["buckets"][le] += count
+    await metrics_client.aclose()
+
+    rss = [peak_rss_mb(proc.pid) for proc, _ in workers]
+    for proc, _ in workers:
+        proc.send_signal(signal.SIGINT)
+    for proc, _ in workers:
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+    await pool.aclose()
+    redis_proc.close()
+    for fake in fakes.values():
+        await fake.close()
+
+    by_kind = defaultdict(list)
+    for j in finished:
+        by_kind[j["kind"]].append(j)
+
+    def latency(js):
+        e2e = [j["done"] - j["enqueued"] for j in js]
+        queued = [j["queued"] for j in js if "queued" in j]
+        return {"n": len(js), "p50_s": pct(e2e, 50), "p99_s": pct(e2e, 99),
+                "queue_p50_s": pct(queued, 50), "queue_p99_s": pct(queued, 99)}
+
+    return {
+        "redis": redis_proc.kind,
+        "workers": args.workers,
+        "jobs": len(jobs),
+        "completed": len(finished),
+        "enqueue_s": round(enqueued_s, 3),
+        "elapsed_s": round(elapsed, 3),
+        "jobs_per_s": round(len(finished) / elapsed, 2) if elapsed > 0 else None,
+        "latency": {"all": latency(finished), **{k: latency(v) for k, v in sorted(by_kind.items())}},
+        "outcomes": dict(Counter(j["outcome"] for j in finished)),
+        "limiter_wait": {
+            model: {"count": int(t["count"]),
+                    "mean_s": t["sum"] / t["count"] if t["count"] else float("nan"),
+                    "p50_le_s": bucket_quantile(sorted(t["buckets"].items()), 0.5),
+                    "p99_le_s": bucket_quantile(sorted(t["buckets"].items()), 0.99)}
+            for model, t in sorted(limiter.items())
+        },
+        "peak_rss_mb": {"workers": [round(r, 1) for r in rss], "harness": round(peak_rss_mb(os.getpid()), 1)},
+        "upstreams": {name: dict(fake.counts) for name, fake in fakes.items()},
+        "worker_logs": log_dir,
+    }
+
+
+def print_report(r: dict):
+    print(f"redis={r['redis']} workers={r['workers']} jobs={r['jobs']} completed={r['completed']} "
+          f"enqueue={r['enqueue_s']}s elapsed={r['elapsed_s']}s -> {r['jobs_per_s']} jobs/s")
+    print(f"{'kind':<18}{'n':>6}{'p50 s':>10}{'p99 s':>10}{'queue p50':>11}{'queue p99':>11}")
+    for kind, l in r["latency"].items():
+        print(f"{kind:<18}{l['n']:>6}{l['p50_s']:>10.3f}{l['p99_s']:>10.3f}"
+              f"{l['queue_p50_s']:>11.3f}{l['queue_p99_s']:>11.3f}")
+    print("limiter wait:")
+    for model, w in r["limiter_wait"].items():
+        print(f"  {model:<18} n={w['count']:<6} mean={w['mean_s']:.3f}s p50<={w['p50_le_s']}s p99<={w['p99_le_s']}s")
+    print(f"outcomes: {r['outcomes']}")
+    print(f"peak RSS MB: workers={r['peak_rss_mb']['workers']} harness={r['peak_rss_mb']['harness']}")
+    for name, counts in r["upstreams"].items():
+        print(f"  {name:<9} {counts}")
+    print(f"worker logs: {r['worker_logs']}")
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--jobs", type=int, default=200)
+    p.add_argument("--rate", type=float, default=0, help="enqueue rate in jobs/s, 0 = all at once")
+    p.add_argument("--mix", default=DEFAULT_MIX, help="kind=weight,... (kinds: model keys and 'runway')")
+    p.add_argument("--workers", type=int, default=1)
+    p.add_argument("--max-jobs", type=int, default=50, help="ARQ_MAX_JOBS per worker")
+    p.add_argument("--images", type=int, default=1, help="input images per Gemini job")
+    p.add_argument("--users", type=int, default=1000, help="distinct user ids jobs are spread over")
+    p.add_argument("--paid-share", type=float, default=0.2, help="share of jobs in the paid lane")
+    p.add_argument("--oson-bulk", action="store_true", help="send status events to the fake's bulk endpoint")
+    p.add_argument("--queue-per-kind", action="store_true",
+                   help="one queue per kind, all consumed by each worker (ARQ_QUEUES)")
+    p.add_argument("--keys", type=int, default=1, help="API keys per provider (key pools)")
+    p.add_argument("--revoked-keys", type=int, default=0, help="how many of those keys the fakes reject with 401")
+    p.add_argument("--runway-task-s", type=float, default=5)
+    p.add_argument("--fault", action="append", default=[],
+                   help="name=spec, e.g. gemini=lat=lognormal:800:0.5,err=0.01,429=0.05")
+    p.add_argument("--timeout", type=float, default=300)
+    p.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = p.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, indent=2, default=str))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
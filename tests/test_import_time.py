@@ -0,0 +1,22 @@
+import os
+
+from bench.import_time import LAZY, probe
+
+BUDGET_S = float(os.getenv("IMPORT_BUDGET_S", "0.5"))
+
+
+def test_provider_sdks_load_lazily():
+    assert probe()["lazy"] == []
+
+
+def test_import_within_budget():
+    # best of a few runs: a cold disk cache shouldn't fail the build
+    best = min(probe()["s"] for _ in range(3))
+    assert best <= BUDGET_S, f"importing worker.worker_settings took {best:.3f}s, budget {BUDGET_S}s"
+
+
+def test_lazy_list_names_real_modules():
+    # a renamed handler would make the lazy check pass vacuously
+    import importlib.util
+    for name in LAZY:
+        assert importlib.util.find_spec(name) is not None, name
@@ -0,0 +1,95 @@
+import asyncio
+
+import fakeredis.aioredis
+import pytest
+
+from worker.limiter import BudgetTimeout, RateLimiter
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def grants(limiter, n, **kwargs) -> int:
+    """How many of n back-to-back acquires get through without waiting."""
+    granted = 0
+    for _ in range(n):
+        try:
+            await limiter.acquire(max_wait_s=0.05, poll_s=0.01, **kwargs)
+            granted += 1
+        except BudgetTimeout:
+            pass
+    return granted
+
+
+def test_concurrency_lease_released_to_next():
+    async def main():
+        limiter = RateLimiter(fakeredis.aioredis.FakeRedis())
+        a = await limiter.acquire("m", rpm=None, concurrency=2)
+        await limiter.acquire("m", rpm=None, concurrency=2)
+        with pytest.raises(BudgetTimeout) as e:
+            await limiter.acquire("m", rpm=None, concurrency=2, max_wait_s=0.05, poll_s=0.01)
+        assert e.value.reason == "concurrency"
+        await limiter.release("m", a)
+        assert await limiter.acquire("m", rpm=None, concurrency=2, max_wait_s=0.05, poll_s=0.01)
+        assert (await limiter.pressure("m"))["leases"] == 2
+    run(main())
+
+
+@pytest.mark.parametrize("algorithm", ["zset", "sliding"])
+def test_rpm_window(algorithm):
+    async def main():
+        limiter = RateLimiter(fakeredis.aioredis.FakeRedis())
+        assert await grants(limiter, 8, model_key="m", rpm=5, concurrency=None, algorithm=algorithm) == 5
+    run(main())
+
+
+def test_gcra_spaces_requests_unless_burst_is_set():
+    async def main():
+        limiter = RateLimiter(fakeredis.aioredis.FakeRedis())
+        # default burst 1: one request per emission interval (60s / 5), never more than rpm
+        assert await grants(limiter, 5, model_key="even", rpm=5, concurrency=None, algorithm="gcra") == 1
+        assert await grants(limiter, 8, model_key="bursty", rpm=5, concurrency=None, algorithm="gcra",
+                            burst=5) == 5
+    run(main())
+
+
+def test_user_concurrency_does_not_block_other_users():
+    async def main():
+        limiter = RateLimiter(fakeredis.aioredis.FakeRedis())
+        kwargs = dict(rpm=None, concurrency=3, user_concurrency=1, max_wait_s=0.05, poll_s=0.01)
+        await limiter.acquire("m", user=1, **kwargs)
+        with pytest.raises(BudgetTimeout) as e:
+            await limiter.acquire("m", user=1, **kwargs)
+        assert e.value.reason == "user"
+        assert await limiter.acquire("m", user=2, **kwargs)
+    run(main())
+
+
+def test_feedback_aimd_within_bounds():
+    async def main():
+        limiter = RateLimiter(fakeredis.aioredis.FakeRedis())
+        bounds = dict(concurrency=(4, 1, 6), cooldown_s=0)
+        conc, _ = await limiter.feedback("m", "throttled", **bounds)
+        assert conc == 2
+        for _ in range(10):
+            conc, _ = await limiter.feedback("m", "ok", **bounds)
+        assert 2 < conc <= 6
+        assert (await limiter.limits("m"))["conc"] == conc
+    run(main())
+
+
+def test_pressure_many_counts_waiters():
+    async def main():
+        redis = fakeredis.aioredis.FakeRedis()
+        limiter = RateLimiter(redis)
+        await limiter.acquire("a", rpm=None, concurrency=1)
+        waiter = asyncio.create_task(limiter.acquire("a", rpm=None, concurrency=1, max_wait_s=5, poll_s=0.01))
+        await asyncio.sleep(0.05)
+        a, b = await limiter.pressure_many(["a", "b"])
+        assert (a["leases"], a["waiters"]) == (1, 1)
+        assert (b["leases"], b["waiters"]) == (0, 0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+    run(main())
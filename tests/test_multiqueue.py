@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+
+from worker.multiqueue import MAX_WAITERS, MultiQueueWorker, QueueSpec, parse_queues
+
+
+def test_parse_queues():
+    specs = parse_queues("arq:g3;model=gemini_3_image;weight=3;max_jobs=10, arq:kling")
+    assert specs == [QueueSpec("arq:g3", "gemini_3_image", 3.0, 10), QueueSpec("arq:kling", "arq:kling")]
+
+
+@pytest.mark.parametrize("value", ["a;speed=1", "a;weight=0", "a,a"])
+def test_parse_queues_rejects(value):
+    with pytest.raises(ValueError):
+        parse_queues(value)
+
+
+class FakeQueue:
+    """Stands in for a QueueWorker: starts up to `quota` of its backlog per poll."""
+
+    def __init__(self, name, weight=1.0, max_jobs=10, backlog=100, model_key=None):
+        self.spec = QueueSpec(name, model_key or name, weight)
+        self.queue_name = name
+        self.max_jobs = max_jobs
+        self.backlog = backlog
+        self.job_counter = 0
+        self.quota = 0
+
+    async def _poll_iteration(self):
+        started = min(self.quota, self.backlog)
+        self.backlog -= started
+        self.job_counter += started
+
+
+class FakeLimiter:
+    def __init__(self, leases=0, waiters=0):
+        self.p = {"leases": leases, "waiters": waiters, "conc": None}
+
+    async def pressure_many(self, model_keys):
+        return [dict(self.p) for _ in model_keys]
+
+
+def coordinator(workers, max_jobs, ctx=None) -> MultiQueueWorker:
+    # no arq Workers or Redis: only the scheduling state
+    m = MultiQueueWorker.__new__(MultiQueueWorker)
+    m.workers, m.max_jobs, m.ctx, m._paused = workers, max_jobs, ctx or {}, set()
+    return m
+
+
+def test_free_slots_split_by_weight():
+    async def main():
+        heavy, light = FakeQueue("heavy", weight=3), FakeQueue("light")
+        m = coordinator([heavy, light], max_jobs=8)
+        # one job at a time, as each finishes, the least served queue picks next
+        for _ in range(8):
+            for w in m.workers:
+                w.quota = 0
+            m.max_jobs = heavy.job_counter + light.job_counter + 1
+            await m._poll_iteration()
+        assert (heavy.job_counter, light.job_counter) == (6, 2)
+    asyncio.run(main())
+
+
+def test_idle_queue_leaves_its_share_to_others():
+    async def main():
+        busy, idle = FakeQueue("busy"), FakeQueue("idle", backlog=0)
+        m = coordinator([busy, idle], max_jobs=10)
+        await m._poll_iteration()
+        assert busy.job_counter == 10
+    asyncio.run(main())
+
+
+def test_max_jobs_caps_a_queue():
+    async def main():
+        capped, other = FakeQueue("capped", max_jobs=2), FakeQueue("other", backlog=3)
+        m = coordinator([capped, other], max_jobs=10)
+        await m._poll_iteration()
+        assert (capped.job_counter, other.job_counter) == (2, 3)
+    asyncio.run(main())
+
+
+def test_saturated_model_is_skipped():
+    async def main():
+        # kling_2_6_video: concurrency 3, all leased and the wait queue full
+        kling = FakeQueue("kling", model_key="kling_2_6_video")
+        m = coordinator([kling], max_jobs=10, ctx={"limiter": FakeLimiter(leases=3, waiters=MAX_WAITERS)})
+        await m._poll_iteration()
+        assert kling.job_counter == 0
+        assert "kling" in m._paused
+
+        m.ctx["limiter"] = FakeLimiter(leases=1)
+        await m._poll_iteration()
+        assert kling.job_counter == 2 + MAX_WAITERS
+        assert "kling" not in m._paused
+    asyncio.run(main())
@@ -0,0 +1,96 @@
+import asyncio
+
+import fakeredis.aioredis
+import pytest
+
+from worker import outbox
+from worker.outbox import GROUP, STREAM_KEY, StatusOutbox
+
+
+class FakeOson:
+    def __init__(self, bulk_path=None):
+        self.bulk_path = bulk_path
+        self.down = set()   # statuses the backend rejects
+        self.got = []
+
+    async def post_event(self, kind, body):
+        if body["status"] in self.down:
+            raise RuntimeError("backend down")
+        self.got.append((body["job_id"], body["status"]))
+
+    async def post_bulk(self, events):
+        if any(e["status"] in self.down for e in events):
+            raise RuntimeError("backend down")
+        self.got.extend((e["job_id"], e["status"]) for e in events)
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(outbox, "RETRY_BASE_S", 0.01)
+
+
+async def make(oson) -> tuple[StatusOutbox, object]:
+    redis = fakeredis.aioredis.FakeRedis()
+    await redis.xgroup_create(STREAM_KEY, GROUP, id="0", mkstream=True)
+    return StatusOutbox(redis, oson), redis
+
+
+async def put(box, job_id, status):
+    return await box.put("job-status", {"job_id": job_id, "status": status}, job_id, status)
+
+
+async def retry(box):
+    await asyncio.sleep(0.05)
+    await box._retry_pending()
+
+
+def test_duplicate_status_is_queued_once():
+    async def main():
+        box, redis = await make(FakeOson())
+        assert await put(box, 1, "FINISHED")
+        assert not await put(box, 1, "FINISHED")
+        assert await redis.xlen(STREAM_KEY) == 1
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("bulk_path", [None, "/bulk"])
+def test_newer_event_waits_for_failed_older_one(bulk_path):
+    async def main():
+        oson = FakeOson(bulk_path)
+        box, redis = await make(oson)
+        oson.down = {"PROCESSING"}
+        await put(box, 1, "PROCESSING")
+        await box._flush_new(block_ms=None)
+        # read in a later batch than the failed PROCESSING: held back
+        await put(box, 1, "FINISHED")
+        await put(box, 2, "FINISHED")
+        await box._flush_new(block_ms=None)
+        assert (1, "FINISHED") not in oson.got
+
+        oson.down = set()
+        await retry(box)
+        assert [e for e in oson.got if e[0] == 1] == [(1, "PROCESSING"), (1, "FINISHED")]
+        assert (2, "FINISHED") in oson.got
+        assert await redis.xlen(STREAM_KEY) == 0
+        assert await redis.keys(f"{outbox.JOB_KEY}*") == []
+    asyncio.run(main())
+
+
+def test_gives_up_after_max_attempts(monkeypatch):
+    monkeypatch.setattr(outbox, "MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(outbox, "RETRY_MAX_S", 0.01)
+
+    async def main():
+        oson = FakeOson()
+        box, redis = await make(oson)
+        oson.down = {"PROCESSING"}
+        await put(box, 1, "PROCESSING")
+        await box._flush_new(block_ms=None)
+        for _ in range(3):
+            await retry(box)
+        assert await box.pending() == 0
+        # the dropped event no longer holds the job's later ones back
+        await put(box, 1, "FINISHED")
+        await box._flush_new(block_ms=None)
+        assert oson.got == [(1, "FINISHED")]
+    asyncio.run(main())
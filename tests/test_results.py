@@ -0,0 +1,98 @@
+import asyncio
+import os
+
+import fakeredis.aioredis
+import pytest
+
+from worker import results as results_mod
+from worker import spool
+from worker.results import BLOB_KEY, ResultStore
+from worker.spool import SpooledFile
+
+
+@pytest.fixture(autouse=True)
+def small_spill(monkeypatch, tmp_path):
+    monkeypatch.setattr(results_mod, "SPILL_BYTES", 16)
+    monkeypatch.setattr(spool, "SPOOL_DIR", str(tmp_path / "spool"))
+
+
+def make(tmp_path, blob_store) -> ResultStore:
+    return ResultStore(fakeredis.aioredis.FakeRedis(), blob_store=blob_store, disk_dir=str(tmp_path / "results"))
+
+
+def spilled(data: bytes) -> SpooledFile:
+    return spool._write(data)
+
+
+@pytest.mark.parametrize("blob_store", ["redis", "disk", "memory"])
+def test_saved_result_is_redelivered(tmp_path, blob_store):
+    async def main():
+        store = make(tmp_path, blob_store)
+        await store.save(1, {"ok": True, "bytes": b"png", "mime": "image/png"})
+        result = await store.load(await store.get(1))
+        assert result == {"ok": True, "bytes": b"png", "mime": "image/png"}
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("blob_store", ["redis", "disk"])
+def test_spilled_result_comes_back_as_a_file(tmp_path, blob_store):
+    async def main():
+        store = make(tmp_path, blob_store)
+        data = os.urandom(100)
+        await store.save(1, {"ok": True, "file": spilled(data), "mime": "video/mp4"})
+        result = await store.load(await store.get(1))
+        assert "bytes" not in result
+        assert result["file"].read() == data
+        assert result["file"].size == len(data)
+    asyncio.run(main())
+
+
+def test_memory_store_skips_spilled_results(tmp_path):
+    async def main():
+        store = make(tmp_path, "memory")
+        await store.save(1, {"ok": True, "file": spilled(os.urandom(100)), "mime": "video/mp4"})
+        assert store._memory_bytes == 0
+        assert await store.load(await store.get(1)) is None
+    asyncio.run(main())
+
+
+def test_delivered_keeps_only_the_marker(tmp_path):
+    async def main():
+        store = make(tmp_path, "redis")
+        await store.save(1, {"ok": True, "bytes": b"png", "mime": "image/png"})
+        await store.mark(1, "uploaded")
+        await store.mark(1, "delivered")
+        stored = await store.get(1)
+        assert stored.steps == {"uploaded", "delivered"}
+        assert stored.sha256 is None
+        assert not await store.redis.exists(f"{BLOB_KEY}1")
+    asyncio.run(main())
+
+
+def test_missing_or_corrupt_blob_regenerates(tmp_path):
+    async def main():
+        store = make(tmp_path, "redis")
+        await store.save(1, {"ok": True, "bytes": b"png", "mime": "image/png"})
+        await store.redis.set(f"{BLOB_KEY}1", b"garbage")
+        assert await store.load(await store.get(1)) is None
+        await store.redis.delete(f"{BLOB_KEY}1")
+        assert await store.load(await store.get(1)) is None
+    asyncio.run(main())
+
+
+def test_uploaded_result_finishes_without_its_blob(tmp_path):
+    async def main():
+        store = make(tmp_path, "disk")
+        await store.save(1, {"ok": True, "bytes": b"png", "mime": "image/png"})
+        await store.mark(1, "uploaded")
+        store._disk_drop("1")
+        assert await store.load(await store.get(1)) == {"ok": True, "bytes": b"", "mime": "image/png"}
+    asyncio.run(main())
+
+
+def test_task_results_need_no_blob(tmp_path):
+    async def main():
+        store = make(tmp_path, "disk")
+        await store.save(1, {"ok": True, "task_id": "t1"})
+        assert await store.load(await store.get(1)) == {"ok": True, "task_id": "t1"}
+    asyncio.run(main())
@@ -0,0 +1,35 @@
+"""
+`python -m worker [--burst] [--verbose]`: runs WorkerSettings on
+BudgetedWorker, which the plain `arq` CLI can't be told to use, or on a
+MultiQueueWorker over the queues in ARQ_QUEUES when that is set.
+"""
+import argparse
+import logging.config
+
+
+def main():
+    # imported here: spawned helper processes (worker.imaging) re-import this module
+    from arq.logs import default_log_config
+    from arq.worker import get_kwargs
+
+    from worker.multiqueue import ARQ_QUEUES, MultiQueueWorker, parse_queues
+    from worker.worker_settings import BudgetedWorker, WorkerSettings
+
+    p = argparse.ArgumentParser(prog="python -m worker")
+    p.add_argument("--burst", action="store_true", help="exit once the queues are empty")
+    p.add_argument("--verbose", action="store_true")
+    args = p.parse_args()
+
+    logging.config.dictConfig(default_log_config(args.verbose))
+    kwargs = get_kwargs(WorkerSettings)
+    if args.burst:
+        kwargs["burst"] = True
+    if ARQ_QUEUES:
+        kwargs.pop("queue_name", None)
+        MultiQueueWorker(parse_queues(ARQ_QUEUES), **kwargs).run()
+    else:
+        BudgetedWorker(**kwargs).run()
+
+
+if __name__ == "__main__":
+    main()
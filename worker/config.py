@@ -1,8 +1,11 @@
+import logging
 import os
-from google import genai
 
-client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+log = logging.getLogger(__name__)
 
+# GEMINI_BASE_URL points the SDK at a stand-in (see bench/load.py)
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL")
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 KLING_ACCESS_KEY = os.getenv("KLING_ACCESS_KEY")
@@ -11,3 +14,61 @@ BASE_URL = os.getenv("BASE_URL")
 SERVER_KEY = os.getenv("SERVER_API_KEY")
 KIE_API_KEY = os.getenv("KIE_API_KEY")
 RUNWAY_API_KEY = os.getenv("RUNWAY_API_KEY")
+
+
+def _keys(name: str) -> list[str]:
+    # NAME + "S" is a comma-separated pool of accounts, else the single NAME
+    raw = os.getenv(f"{name}S") or os.getenv(name) or ""
+    return [key.strip() for key in raw.split(",") if key.strip()]
+
+
+# provider -> (key, secret) pairs, one per account (see worker.keypool); an
+# empty pool only fails that provider's jobs
+CREDENTIALS: dict[str, list[tuple[str, str | None]]] = {
+    "gemini": [(key, None) for key in _keys("GEMINI_API_KEY")],
+    # KLING_KEYS="access:secret,access:secret"
+    "kling": [tuple(pair.split(":", 1)) for pair in os.getenv("KLING_KEYS", "").split(",") if ":" in pair]
+             or ([(KLING_ACCESS_KEY, KLING_SECRET_KEY)] if KLING_ACCESS_KEY else []),
+    "kieapi": [(key, None) for key in _keys("KIE_API_KEY")],
+    "runway": [(key, None) for key in _keys("RUNWAY_API_KEY")],
+}
+
+REQUIRED = ("BOT_TOKEN",)
+
+_gemini = {}
+
+
+def gemini_client(api_key: str | None = None):
+    """
+    The google-genai client for a key, built on first use: importing the
+    SDK is most of the worker's import time and only Gemini jobs need it.
+    """
+    api_key = api_key or next((key for key, _ in CREDENTIALS["gemini"]), None)
+    if api_key not in _gemini:
+        from google import genai
+        from google.genai.types import HttpOptions
+
+        _gemini[api_key] = genai.Client(
+            api_key=api_key, http_options=HttpOptions(base_url=GEMINI_BASE_URL) if GEMINI_BASE_URL else None)
+    return _gemini[api_key]
+
+
+async def close():
+    """Called from on_shutdown: close the Gemini clients' sessions before the loop goes away."""
+    clients = list(_gemini.values())
+    _gemini.clear()
+    for client in clients:
+        try:
+            await client.aio.aclose()
+        except Exception as e:
+            log.warning(f"Closing a Gemini client failed: {e}")
+
+
+def validate():
+    """Called from on_startup: fail on missing required settings, warn on empty key pools."""
+    missing = [name for name in REQUIRED if not globals()[name]]
+    if missing:
+        raise RuntimeError(f"{', '.join(missing)} is not set")
+    for provider, keys in CREDENTIALS.items():
+        if not keys:
+            log.warning(f"No {provider} API keys set, {provider} jobs will fail")
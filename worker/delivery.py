@@ -0,0 +1,68 @@
+import asyncio
+import os
+
+from worker.metrics import OSON_STATUS, TELEGRAM_UPLOAD, timed
+from worker.results import ResultStore
+from worker.spool import result_size
+from worker.tracing import span
+from worker.telegram import TelegramClient, OsonIntelektServer
+
+# uploads to Telegram have their own budget, independent of provider slots
+DELIVERY_CONCURRENCY = int(os.getenv("DELIVERY_CONCURRENCY", "20"))
+
+
+class Delivery:
+    """
+    Hands a handler result to the user and the backend. Runs after the
+    provider slot is released, bounded by its own semaphore.
+    """
+
+    def __init__(self, tg: TelegramClient, oson: OsonIntelektServer, concurrency: int = DELIVERY_CONCURRENCY):
+        self.tg = tg
+        self.oson = oson
+        self.sem = asyncio.Semaphore(concurrency)
+
+    async def deliver(self, payload: dict, user_id: int, prompt: str | None, result: dict,
+                      results: ResultStore | None = None, done: set[str] = frozenset()):
+        """
+        `done` are steps finished on an earlier try (see ResultStore); the
+        document upload is recorded in `results` so a retry doesn't send it twice.
+        """
+        model_key = payload.get("model_key", "")
+        async with self.sem:
+            if not result.get("ok"):
+                with span("notify"):
+                    await self.tg.send_text(
+                        user_id,
+                        f"<tg-emoji emoji-id='5258474669769497337'>⚠️</tg-emoji>️ Yaratishda xatolik! Qayta urinib ko'ring\n{result.get('error')}.\n\nPrompt:\n"
+                        f"<blockquote expandable>{prompt}</blockquote>"
+                    )
+                with span("status"), timed(OSON_STATUS, model_key=model_key):
+                    await self.oson.send_job_status(payload['job_id'], 'FAILED')
+                return
+
+            if result.get('task_id', False):
+                with span("notify"):
+                    await self.tg.send_text(user_id,
+                                            f"<tg-emoji emoji-id='5283112212792121487'>©️</tg-emoji>️ <b>{payload['media_type']} tayyornalmoqda!</b>\n\n"
+                                            f"<tg-emoji emoji-id='5249231689695115145'>©️</tg-emoji>️ <b>Prompt:</b>\n<blockquote expandable>{prompt}</blockquote>")
+                with span("status"), timed(OSON_STATUS, model_key=model_key):
+                    await self.oson.send_job_status(payload['job_id'], 'PROCESSING', task_id=result.get('task_id'))
+                return
+
+            mime = result["mime"]
+            ext = mime.split("/")[-1]
+            filename = f"OsonIntelektBot.{ext}"
+
+            if "uploaded" not in done:
+                # spilled results are streamed from their file
+                document = result["file"] if result.get("file") is not None else result["bytes"]
+                with span("upload", bytes=result_size(result)), timed(TELEGRAM_UPLOAD, model_key=model_key):
+                    await self.tg.send_document(user_id, filename, document, mime, caption="@OsonIntelektBot")
+                if results is not None and payload.get("job_id") is not None:
+                    await results.mark(payload["job_id"], "uploaded")
+            with span("notify"):
+                await self.tg.send_text(user_id, f"<tg-emoji emoji-id='5260416304224936047'>©️</tg-emoji>️ <b>Yakunlandi!</b>\n\n"
+                                                 f"<tg-emoji emoji-id='5249231689695115145'>©️</tg-emoji>️ Prompt:\n<blockquote expandable>{prompt}</blockquote>")
+            with span("status"), timed(OSON_STATUS, model_key=model_key):
+                await self.oson.send_job_status(payload['job_id'], 'FINISHED')
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import time
+
+from worker.http_pool import get_client
+from worker.media_cache import CachedMedia, content_hash, media_cache
+from worker.tracing import span
+
+# one semaphore for the whole process, shared by every handler
+DOWNLOAD_SEM = asyncio.Semaphore(int(os.getenv("DOWNLOAD_CONCURRENCY", "20")))
+MAX_IMAGE_BYTES = int(os.getenv("DOWNLOAD_MAX_BYTES", str(20 * 1024 * 1024)))
+DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", "30"))
+
+
+class DownloadTooLarge(Exception):
+    pass
+
+
+def sniff_mime(data: bytes, default: str = "image/jpeg") -> str:
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[4:8] == b"ftyp" and data[8:12] in (b"heic", b"heix", b"mif1", b"msf1"):
+        return "image/heic"
+    return default
+
+
+async def download(url: str, max_bytes: int = MAX_IMAGE_BYTES) -> tuple[bytes, str]:
+    cached = await media_cache.get(url)
+    if cached is not None and cached.is_fresh():
+        media_cache.counters["hits"] += 1
+        return cached.data, cached.mime
+
+    headers = cached.validators() if cached is not None else {}
+    async with DOWNLOAD_SEM:
+        # reference images are often behind CDN or signed-URL redirects
+        async with get_client(url).stream("GET", url, headers=headers, timeout=DOWNLOAD_TIMEOUT,
+                                          follow_redirects=True) as r:
+            if cached is not None and r.status_code == 304:
+                media_cache.counters["revalidated"] += 1
+                await media_cache.touch(cached, r.headers.get("etag"), r.headers.get("last-modified"))
+                return cached.data, cached.mime
+
+            r.raise_for_status()
+            declared = r.headers.get("content-length")
+            if declared and int(declared) > max_bytes:
+                raise DownloadTooLarge(f"{url}: {declared} bytes > {max_bytes}")
+
+            buf = bytearray()
+            async for chunk in r.aiter_bytes():
+                buf += chunk
+                if len(buf) > max_bytes:
+                    raise DownloadTooLarge(f"{url}: more than {max_bytes} bytes")
+            etag, last_modified = r.headers.get("etag"), r.headers.get("last-modified")
+
+    media_cache.counters["stale" if cached is not None else "misses"] += 1
+    data = bytes(buf)
+    mime = sniff_mime(data)
+    await media_cache.put(CachedMedia(
+        url=url, sha256=content_hash(data), mime=mime, size=len(data), fetched_at=time.time(),
+        etag=etag, last_modified=last_modified, data=data,
+    ))
+    return data, mime
+
+
+async def download_all(urls: list[str], max_bytes: int = MAX_IMAGE_BYTES) -> list[tuple[bytes, str]]:
+    """
+    Fetch all images of a job concurrently, preserving order.
+    """
+    if not urls:
+        return []
+    with span("download", count=len(urls)):
+        return list(await asyncio.gather(*(download(url, max_bytes) for url in urls)))
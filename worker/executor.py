@@ -0,0 +1,70 @@
+import asyncio
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+BLOCKING_WORKERS = int(os.getenv("BLOCKING_WORKERS", "8"))
+
+
+class InstrumentedExecutor:
+    """
+    Thread pool for the little blocking work left (disk I/O and the like),
+    sized independently of the loop's default executor. Tracks queue depth
+    and how long calls waited for a thread.
+    """
+
+    def __init__(self, max_workers: int, name: str):
+        self.name = name
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.wait_s_total = 0.0
+        self.wait_s_max = 0.0
+        # optional observer for each wait (seconds), e.g. a histogram
+        self.on_wait: Optional[Callable[[float], None]] = None
+
+    async def run(self, fn, *args, **kwargs):
+        submitted = time.monotonic()
+        with self._lock:
+            self.queued += 1
+
+        def call():
+            waited = time.monotonic() - submitted
+            with self._lock:
+                self.queued -= 1
+                self.running += 1
+                self.wait_s_total += waited
+                self.wait_s_max = max(self.wait_s_max, waited)
+            if self.on_wait is not None:
+                self.on_wait(waited)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.completed += 1
+
+        return await asyncio.get_running_loop().run_in_executor(self._pool, functools.partial(call))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "queued": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "wait_s_total": self.wait_s_total,
+                "wait_s_max": self.wait_s_max,
+            }
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+blocking = InstrumentedExecutor(BLOCKING_WORKERS, "blocking")
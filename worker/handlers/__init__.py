@@ -1,10 +1,35 @@
-from . import gemini2, gemini3, kling, kieapi, runway
+import importlib
 
+from worker.executor import blocking
+
+# name -> (module, function). Modules are imported on first use, so a worker
+# only loads the SDKs of the models it actually runs.
 HANDLERS = {
-    "gemini_2_5_image": gemini2.run,
-    "gemini_3_image": gemini3.run,
-    "kling_2_6_video": kling.run,
-    'kieapi': kieapi.run,
-    'runway_create': runway.create_task,
-    'runway_poll': runway.get_task,
+    "gemini_2_5_image": ("gemini2", "run"),
+    "gemini_3_image": ("gemini3", "run"),
+    "kling_2_6_video": ("kling", "run"),
+    'kieapi': ("kieapi", "run"),
+    'runway_create': ("runway", "create_task"),
+    'runway_poll': ("runway", "get_task"),
+}
+
+# name -> provider whose key pool (worker.keypool) the handler draws from
+PROVIDERS = {
+    "gemini_2_5_image": "gemini",
+    "gemini_3_image": "gemini",
+    "kling_2_6_video": "kling",
+    'kieapi': "kieapi",
+    'runway_create': "runway",
 }
+
+_loaded = {}
+
+
+async def get_handler(name: str):
+    handler = _loaded.get(name)
+    if handler is None:
+        module, attr = HANDLERS[name]
+        # a first SDK import can take a second; keep it off the event loop
+        mod = await blocking.run(importlib.import_module, f"{__name__}.{module}")
+        handler = _loaded[name] = getattr(mod, attr)
+    return handler
@@ -1,46 +1,33 @@
 import logging
-import os
-import asyncio
-import mimetypes
-import requests
-from google import genai
 from google.genai.types import Part, GenerateContentConfig, FinishReason
 
-from worker.config import client
+from worker.config import gemini_client
+from worker.downloader import download_all
+from worker.imaging import prepare_all
+from worker.keypool import Credential, key_error
 
-DOWNLOAD_SEM = asyncio.Semaphore(int(os.getenv("DOWNLOAD_CONCURRENCY", "20")))
 
-
-def _download_sync(url: str) -> bytes:
-    return requests.get(url, timeout=30).content
-
-
-async def _download(url: str) -> bytes:
-    async with DOWNLOAD_SEM:
-        return await asyncio.to_thread(_download_sync, url)
-
-
-async def run(payload: dict) -> dict:
+async def run(payload: dict, key: Credential | None = None) -> dict:
     if bool(payload["is_test"]):
         return {'ok': False, 'error': "Fake error"}
     contents = [payload["prompt"]]
 
-    for img_url in payload.get("images", []):
-        image_bytes = await _download(img_url)
-        mime_type = mimetypes.guess_type(img_url)[0] or "image/jpeg"
+    for image_bytes, mime_type in await prepare_all(await download_all(payload.get("images", [])), payload):
         contents.append(Part.from_bytes(data=image_bytes, mime_type=mime_type))
 
     try:
 
-        response = await asyncio.to_thread(
-            client.models.generate_content,
+        response = await gemini_client(key.key if key else None).aio.models.generate_content(
             model="gemini-2.5-flash-image",
             contents=contents,
             config=GenerateContentConfig(response_modalities=["Image"]),
         )
     except Exception as e:
         logging.exception(e)
-        return {'ok': False, 'error': 'Error when creating image'}
+        # google.genai APIError: 429 is RESOURCE_EXHAUSTED (rate or quota)
+        code = getattr(e, "code", None)
+        return {'ok': False, 'error': 'Error when creating image', 'throttled': code == 429,
+                'key_error': key_error(code, str(e))}
     candidates = getattr(response, "candidates", None)
     if not candidates:
         return {'ok': False, 'error': 'No images in response found'}
@@ -1,45 +1,55 @@
 import logging
+import os
 
 import httpx
 
 from worker import config
+from worker.http_pool import get_client
+from worker.keypool import Credential, key_error
+
+BASE = os.getenv("KIE_API_URL", "https://api.kie.ai")
 
 
 class KieApi:
-    def __init__(self):
-        self.base = "https://api.kie.ai"
+    def __init__(self, key: Credential | None = None):
+        self.base = BASE
         self.headers = {
-            "Authorization": f"Bearer {config.KIE_API_KEY}",
+            "Authorization": f"Bearer {key.key if key else config.KIE_API_KEY}",
             "Content-Type": "application/json"
         }
 
     async def create_task(self, payload: dict, request_url: str):
-        async with httpx.AsyncClient(timeout=30) as s:
-            r = await s.post(self.base + request_url, headers=self.headers, json=payload)
-            r.raise_for_status()
-            data = r.json()
-            if data.get('code', 0) == 200:
-                return {'ok': True, 'task_id': data['data']['taskId']}
+        r = await get_client(self.base).post(self.base + request_url, headers=self.headers, json=payload, timeout=30)
+        r.raise_for_status()
+        data = r.json()
+        if data.get('code', 0) == 200:
+            return {'ok': True, 'task_id': data['data']['taskId']}
 
-            logging.error(data['msg'])
-            return {'ok': False, 'error': data['msg']}
+        logging.error(data['msg'])
+        return {'ok': False, 'error': data['msg'], 'throttled': data.get('code') == 429,
+                'key_error': key_error(data.get('code'), data['msg'])}
 
 
-async def run(payload: dict) -> dict:
+async def run(payload: dict, key: Credential | None = None) -> dict:
     if bool(payload["is_test"]):
         return {'ok': False, 'error': "Fake error"}
 
-    kie_api = KieApi()
+    kie_api = KieApi(key)
     try:
 
         body = payload.get('body')
         request_url = payload.get('request_url')
         s = await kie_api.create_task(body, request_url)
+    except httpx.HTTPStatusError as e:
+        logging.error(e)
+        return {'ok': False, 'error': str(e), 'throttled': e.response.status_code == 429,
+                'key_error': key_error(e.response.status_code, e.response.text)}
     except Exception as e:
         logging.error(e)
         return {'ok': False, 'error': str(e)}
 
     if not s.get('ok'):
-        return {'ok': False, 'error': s.get('error')}
+        return {'ok': False, 'error': s.get('error'), 'throttled': s.get('throttled', False),
+                'key_error': s.get('key_error')}
 
     return {'ok': True, 'task_id': s.get('task_id')}
@@ -1,38 +1,33 @@
 import logging
-import os
-import asyncio
-import time
 
 import httpx
-import jwt
-from pydantic import BaseModel, Field
 
 from worker import config
+from worker.keypool import Credential, key_error
+from worker.kling_client import AUTH_CODES, QUOTA_CODES, THROTTLE_CODES, kling
 
-BASE = "https://api-singapore.klingai.com"
+# task kinds, also the path segment for create and query
+TEXT2VIDEO = "text2video"
+IMAGE2VIDEO = "image2video"
+MOTION_CONTROL = "motion-control"
 
 
-def make_jwt() -> str:
-    now = int(time.time())
-    headers = {"alg": "HS256", "typ": "JWT"}
-    payload = {"iss": config.KLING_ACCESS_KEY, "exp": now + 60, "nbf": now - 5}
-    return jwt.encode(payload, config.KLING_SECRET_KEY, headers=headers)
+def code_key_error(code) -> str | None:
+    return "auth" if code in AUTH_CODES else "quota" if code in QUOTA_CODES else None
 
 
-async def post_json(path: str, body: dict) -> dict:
-    token = make_jwt()
-    async with httpx.AsyncClient(timeout=30) as s:
-        r = await s.post(
-            f"{BASE}{path}",
-            headers={"Content-Type": "application/json", "Authorization": f"Bearer {token}"},
-            json=body,
-        )
-        r.raise_for_status()
-        return r.json()
+def created(j: dict, kind: str) -> dict:
+    data = j.get("data") or {}
+    task_id = data.get("task_id")
+    if not task_id:
+        return {"ok": False, "error": f"create failed: {j}", "throttled": j.get("code") in THROTTLE_CODES,
+                "key_error": code_key_error(j.get("code"))}
+    # kling_kind: lets the reconciler query the task if its callback never comes
+    return {'ok': True, 'task_id': task_id, 'kling_kind': kind}
 
 
-async def image_to_video(payload: dict) -> dict:
-    request_url = '/v1/videos/text2video'
+async def image_to_video(payload: dict, key: Credential | None) -> dict:
+    kind = TEXT2VIDEO
     body = {
         "model_name": "kling-v2-6",
         "mode": "pro",
@@ -46,24 +41,27 @@ async def image_to_video(payload: dict) -> dict:
 
         if payload['image_tail']:
             body['image_tail'] = payload['image_tail']
-        request_url = '/v1/videos/image2video'
+        kind = IMAGE2VIDEO
     else:
         body['aspect_ratio'] = payload['aspect_ratio']
 
-    j = await post_json(request_url, body)
-    data = j.get("data") or {}
-    task_id = data.get("task_id")
-    if not task_id:
-        return {"ok": False, "error": f"create failed: {j}"}
-
-    return {'ok': True, 'task_id': task_id}
+    return created(await kling.post_json(f'/v1/videos/{kind}', body, key), kind)
 
 
-async def motion_control(payload: dict):
-    pass
+async def motion_control(payload: dict, key: Credential | None) -> dict:
+    body = {
+        "model_name": "kling-v2-6",
+        "mode": payload.get('mode', 'pro'),
+        "prompt": payload.get('prompt'),
+        "image_url": payload['image'],
+        "video_url": payload['video'],
+        "character_orientation": payload.get('character_orientation', 'video'),
+        "callback_url": f'{config.BASE_URL}/kling/status'
+    }
+    return created(await kling.post_json(f'/v1/videos/{MOTION_CONTROL}', body, key), MOTION_CONTROL)
 
 
-async def run(payload: dict) -> dict:
+async def run(payload: dict, key: Credential | None = None) -> dict:
     if bool(payload["is_test"]):
         return {'ok': False, 'error': "Fake error"}
 
@@ -71,17 +69,29 @@ async def run(payload: dict) -> dict:
         handlers = {'image2video': image_to_video,
                     'motion-control': motion_control}
 
-        r = await handlers[payload["generation_type"]](payload)
+        r = await handlers[payload["generation_type"]](payload, key)
         if not r.get('ok'):
-            return {'ok': False, 'error': r.get('error')}
+            return {'ok': False, 'error': r.get('error'), 'throttled': r.get('throttled', False),
+                    'key_error': r.get('key_error')}
 
         task_id = r.get('task_id')
+        kind = r.get('kling_kind')
 
+    except httpx.HTTPStatusError as e:
+        logging.exception(e)
+        try:
+            code = e.response.json().get("code")
+        except ValueError:
+            code = None
+        return {'ok': False, 'error': 'Error when creating image', 'throttled': e.response.status_code == 429,
+                'key_error': code_key_error(code) or key_error(e.response.status_code, e.response.text)}
     except Exception as e:
         logging.exception(e)
         return {'ok': False, 'error': 'Error when creating image'}
 
     return {
         "ok": True,
-        "task_id": task_id
+        "task_id": task_id,
+        "kling_kind": kind,
+        "key_id": key.key_id if key else None,
     }
@@ -1,47 +1,51 @@
+import os
 import time
 
-import httpx
-
-from worker import config
-
-BASE = 'https://api.dev.runwayml.com'
-
-
-async def post_json(path: str, body: dict) -> dict:
-    async with httpx.AsyncClient(timeout=30) as s:
-        r = await s.post(
-            f"{BASE}{path}",
-            headers={"Content-Type": "application/json", "Authorization": f"Bearer {config.RUNWAY_API_KEY}",
-                     "X-Runway-Version": "2024-11-06"},
-            json=body,
-        )
-        r.raise_for_status()
-        js = r.json()
-        if r.status_code != 200:
-            return {'code': r.status_code, 'error': js['error']}
-        return js
-
-async def get_json(path: str) -> dict:
-    async with httpx.AsyncClient(timeout=30) as s:
-        r = await s.get(
-            f"{BASE}{path}",
-            headers={"Content-Type": "application/json", "Authorization": f"Bearer {config.RUNWAY_API_KEY}",
-                     "X-Runway-Version": "2024-11-06"}
-        )
-        r.raise_for_status()
-        js = r.json()
-        if r.status_code != 200:
-            return {'code': r.status_code, 'error': js['error']}
-        return js
-
-
-async def create_task(payload: dict):
-    j = await post_json(payload["request_url"], payload['body'])
+from worker.http_pool import get_client
+from worker.keypool import Credential, pools
+
+BASE = os.getenv("RUNWAY_API_URL", 'https://api.dev.runwayml.com')
+
+
+def _headers(key: Credential | None) -> dict:
+    key = key or pools["runway"].get()
+    return {"Content-Type": "application/json", "Authorization": f"Bearer {key.key if key else None}",
+            "X-Runway-Version": "2024-11-06"}
+
+
+async def post_json(path: str, body: dict, key: Credential | None = None) -> dict:
+    r = await get_client(BASE).post(
+        f"{BASE}{path}",
+        headers=_headers(key),
+        json=body,
+        timeout=30,
+    )
+    r.raise_for_status()
+    js = r.json()
+    if r.status_code != 200:
+        return {'code': r.status_code, 'error': js['error']}
+    return js
+
+async def get_json(path: str, key: Credential | None = None) -> dict:
+    r = await get_client(BASE).get(
+        f"{BASE}{path}",
+        headers=_headers(key),
+        timeout=30,
+    )
+    r.raise_for_status()
+    js = r.json()
+    if r.status_code != 200:
+        return {'code': r.status_code, 'error': js['error']}
+    return js
+
+
+async def create_task(payload: dict, key: Credential | None = None):
+    j = await post_json(payload["request_url"], payload['body'], key)
     task_id = j.get("id")
     if not task_id:
         return {"ok": False, "error": f"create failed: {j}"}
 
-    return {"ok": True, "task_id": task_id}
+    return {"ok": True, "task_id": task_id, "key_id": key.key_id if key else None}
 
 
 async def get_task(job_data: dict):
@@ -56,7 +60,8 @@ async def get_task(job_data: dict):
     if time.time() - started_at > 10 * 60:  # 10 minutes
         raise RuntimeError("Generation timeout")
 
-    j = await get_json(f'/v1/tasks/{task_id}')
+    # a task is only visible to the account that created it
+    j = await get_json(f'/v1/tasks/{task_id}', pools["runway"].get(job_data.get("key_id")))
 
     status = j["status"]
 
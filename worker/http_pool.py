@@ -0,0 +1,63 @@
+import os
+from urllib.parse import urlsplit
+
+import httpx
+
+try:
+    import h2  # noqa: F401
+    HTTP2 = os.getenv("HTTP2", "1") == "1"
+except ImportError:
+    HTTP2 = False
+
+MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+DEFAULT_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))
+
+# one keep-alive pool per upstream registered in startup() (scheme://host:port), shared by the
+# whole process; any other origin (user-supplied media URLs) goes through the SHARED client
+_clients: dict[str, httpx.AsyncClient] = {}
+_upstreams: set[str] = set()
+SHARED = "*"
+
+
+def _origin(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def get_client(url: str) -> httpx.AsyncClient:
+    """
+    Pooled client for the host of `url` if it is a registered upstream, else
+    the shared one. Callers still pass absolute URLs.
+    """
+    origin = _origin(url)
+    if origin not in _upstreams:
+        origin = SHARED
+    client = _clients.get(origin)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            http2=HTTP2,
+            timeout=DEFAULT_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_KEEPALIVE,
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            ),
+        )
+        _clients[origin] = client
+    return client
+
+
+async def startup(*urls: str):
+    for url in urls:
+        if url:
+            _upstreams.add(_origin(url))
+            get_client(url)
+
+
+async def shutdown():
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        await client.aclose()
@@ -0,0 +1,130 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from worker.metrics import IMAGE_BYTES_IN, IMAGE_BYTES_SAVED, IMAGE_PREP
+from worker.policies import get_policy
+from worker.tracing import span
+
+log = logging.getLogger(__name__)
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(min(4, os.cpu_count() or 1))))
+# images already within the edge limit and smaller than this are sent untouched
+SKIP_BYTES = int(os.getenv("IMAGE_SKIP_BYTES", str(512 * 1024)))
+# formats Pillow decodes without plugins; anything else (HEIC, GIF) passes through
+PROCESSED = {"image/jpeg", "image/png", "image/webp"}
+
+_pool = None
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn: the worker process has threads (executor, pools) that fork would copy mid-state
+        _pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"),
+                                    max_tasks_per_child=200)
+    return _pool
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def _normalize(data: bytes, max_edge: int, quality: int) -> tuple[bytes, str] | None:
+    """
+    Runs in the pool. Applies EXIF orientation, downscales to `max_edge`,
+    drops metadata and re-encodes (JPEG, or WebP when there is alpha).
+    None when the result would not be smaller.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as img:
+        # JPEG can decode at 1/2, 1/4, 1/8 scale, much cheaper than a full decode
+        img.draft("RGB", (max_edge, max_edge))
+        img = ImageOps.exif_transpose(img)
+        if max(img.size) > max_edge:
+            img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+        alpha = img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+        out = io.BytesIO()
+        if alpha:
+            img.convert("RGBA").save(out, "WEBP", quality=quality, method=4)
+            mime = "image/webp"
+        else:
+            img.convert("RGB").save(out, "JPEG", quality=quality, optimize=True)
+            mime = "image/jpeg"
+
+    encoded = out.getvalue()
+    if len(encoded) >= len(data):
+        return None
+    return encoded, mime
+
+
+def _edge(size: tuple[int, int] | None) -> int:
+    return max(size) if size else 0
+
+
+def _dimensions(data: bytes) -> tuple[int, int] | None:
+    # header-only read, cheap enough for the event loop
+    from PIL import Image
+
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            return img.size
+    except Exception:
+        return None
+
+
+async def normalize(data: bytes, mime: str, max_edge: int, quality: int = 85,
+                    model_key: str = "") -> tuple[bytes, str]:
+    """
+    Shrink one reference image for upload; the original is returned when
+    it is already small, not a format we handle, or processing fails.
+    """
+    if mime not in PROCESSED:
+        return data, mime
+    if len(data) <= SKIP_BYTES and _edge(_dimensions(data)) <= max_edge:
+        return data, mime
+
+    started = time.perf_counter()
+    try:
+        res = await asyncio.get_running_loop().run_in_executor(_get_pool(), _normalize, data, max_edge, quality)
+    except BrokenProcessPool:
+        shutdown()
+        log.warning("Image pool broke, sending the original")
+        return data, mime
+    except Exception as e:
+        log.warning(f"Image normalization failed, sending the original: {e}")
+        return data, mime
+    finally:
+        IMAGE_PREP.labels(model_key=model_key).observe(time.perf_counter() - started)
+
+    IMAGE_BYTES_IN.labels(model_key=model_key).inc(len(data))
+    if res is None:
+        return data, mime
+    IMAGE_BYTES_SAVED.labels(model_key=model_key).inc(len(data) - len(res[0]))
+    return res
+
+
+async def prepare_all(images: list[tuple[bytes, str]], payload: dict) -> list[tuple[bytes, str]]:
+    """
+    Downloaded reference images as the model's policy wants them uploaded
+    (unchanged when the policy sets no input edge).
+    """
+    model_key = payload.get("model_key", "")
+    policy = get_policy(model_key)
+    max_edge = policy.input_edge(payload) if policy is not None else None
+    if not images or not max_edge:
+        return images
+    with span("prepare", count=len(images), max_edge=max_edge):
+        return list(await asyncio.gather(*(
+            normalize(data, mime, max_edge, policy.input_quality, model_key) for data, mime in images
+        )))
@@ -0,0 +1,124 @@
+import hashlib
+import logging
+import os
+import random
+from dataclasses import dataclass
+from typing import Optional
+
+from worker import config
+from worker.metrics import KEY_PICKS, KEY_QUARANTINES
+
+log = logging.getLogger(__name__)
+
+QUARANTINE_KEY = "keys:quarantine:"   # + provider:key_id -> reason, expires with the quarantine
+# how long a key sits out after the provider rejected it
+QUARANTINE_S = {
+    "auth": int(os.getenv("KEY_AUTH_QUARANTINE_S", "1800")),
+    "quota": int(os.getenv("KEY_QUOTA_QUARANTINE_S", "600")),
+}
+
+
+@dataclass(frozen=True)
+class Credential:
+    provider: str
+    # stable across restarts and reorderings, safe to log and to use in Redis keys
+    key_id: str
+    key: str
+    secret: Optional[str] = None  # Kling signs with an access key / secret key pair
+
+
+def key_error(status: Optional[int], message: str = "") -> Optional[str]:
+    """
+    "auth" or "quota" when a provider error means the key itself is unusable
+    for a while (the handlers put it in result["key_error"]), else None.
+    """
+    message = (message or "").lower()
+    # Gemini answers a bad key with 400 INVALID_ARGUMENT "API key not valid"
+    if status in (401, 403) or status == 400 and "api key not valid" in message:
+        return "auth"
+    if status == 402 or status == 429 and "quota" in message:
+        return "quota"
+    return None
+
+
+class KeyPool:
+    """
+    The accounts of one provider. With more than one key every key has its
+    own limiter budget (`<model_key>@<key_id>`, each with the model's full
+    ModelPolicy), and `pick` hands out the least loaded key that is not
+    quarantined. A key that fails with an auth or quota error is
+    quarantined in Redis, so every worker skips it until it expires.
+
+    A single-key pool uses the plain model_key and never touches Redis.
+    """
+
+    def __init__(self, provider: str, pairs: list[tuple[str, Optional[str]]]):
+        self.provider = provider
+        self.credentials = [
+            Credential(provider, hashlib.sha256(f"{key}:{secret or ''}".encode()).hexdigest()[:8], key, secret)
+            for key, secret in pairs
+        ]
+        self._by_id = {c.key_id: c for c in self.credentials}
+
+    def get(self, key_id: Optional[str] = None) -> Optional[Credential]:
+        """The key a task was created with; the first one for tasks tracked before pools."""
+        cred = self._by_id.get(key_id) if key_id else None
+        return cred or (self.credentials[0] if self.credentials else None)
+
+    def limiter_key(self, model_key: str, cred: Optional[Credential]) -> str:
+        if cred is None or len(self.credentials) < 2:
+            return model_key
+        return f"{model_key}@{cred.key_id}"
+
+    def limiter_keys(self, model_key: str) -> list[str]:
+        return [self.limiter_key(model_key, c) for c in self.credentials] or [model_key]
+
+    async def quarantined(self, redis) -> set[str]:
+        reasons = await redis.mget([f"{QUARANTINE_KEY}{self.provider}:{c.key_id}" for c in self.credentials])
+        return {c.key_id for c, reason in zip(self.credentials, reasons) if reason is not None}
+
+    async def quarantine(self, redis, cred: Credential, reason: str, detail=None):
+        ttl = QUARANTINE_S.get(reason, QUARANTINE_S["quota"])
+        log.warning(f"{self.provider} key {cred.key_id} quarantined for {ttl}s ({reason}): {detail}")
+        KEY_QUARANTINES.labels(provider=self.provider, key_id=cred.key_id, reason=reason).inc()
+        if len(self.credentials) > 1:
+            await redis.set(f"{QUARANTINE_KEY}{self.provider}:{cred.key_id}", reason, ex=ttl)
+
+    async def pick(self, redis, limiter=None, model_key: Optional[str] = None, policy=None) -> Optional[Credential]:
+        """
+        A key for the next call: one with free concurrency first, then the
+        lowest (leases + waiters) / limit. Without a limiter or limits, any
+        healthy key. When all are quarantined the pool is used as is.
+        """
+        if len(self.credentials) < 2:
+            cred = self.get()
+        else:
+            out = await self.quarantined(redis)
+            healthy = [c for c in self.credentials if c.key_id not in out]
+            if not healthy:
+                log.warning(f"All {self.provider} keys are quarantined, using them anyway")
+                healthy = self.credentials
+            if limiter is None or policy is None or not (policy.rpm or policy.concurrency):
+                cred = random.choice(healthy)
+            else:
+                pressures = await limiter.pressure_many([self.limiter_key(model_key, c) for c in healthy])
+                cred = min(zip(healthy, pressures), key=lambda cp: self._load(policy, cp[1]))[0]
+        if cred is not None:
+            KEY_PICKS.labels(provider=self.provider, key_id=cred.key_id).inc()
+        return cred
+
+    @staticmethod
+    def _load(policy, p: dict) -> tuple:
+        limit = policy.concurrency
+        if policy.adaptive and p["conc"]:
+            limit = max(1, int(p["conc"]))
+        if not limit:
+            # RPM only: a full window shows up as waiters
+            return p["waiters"] > 0, p["waiters"], random.random()
+        full = p["leases"] >= limit or p["waiters"] > 0
+        # random last: workers picking at the same moment spread over equal keys
+        return full, (p["leases"] + p["waiters"]) / limit, random.random()
+
+
+# provider -> pool, from config.CREDENTIALS
+pools: dict[str, KeyPool] = {provider: KeyPool(provider, pairs) for provider, pairs in config.CREDENTIALS.items()}
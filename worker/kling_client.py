@@ -0,0 +1,75 @@
+import asyncio
+import os
+import time
+
+import jwt
+
+from worker.http_pool import get_client
+from worker.keypool import Credential, pools
+
+BASE = os.getenv("KLING_API_URL", "https://api-singapore.klingai.com")
+# account rate / concurrency limit exceeded
+THROTTLE_CODES = {1302, 1303}
+# the key is unusable: authentication failed / account in arrears or resource pack used up
+AUTH_CODES = {1000, 1001, 1002, 1003, 1004, 1103}
+QUOTA_CODES = {1101, 1102}
+TOKEN_TTL_S = int(os.getenv("KLING_TOKEN_TTL_S", "1800"))
+# a cached token is replaced this long before it expires
+TOKEN_REFRESH_S = int(os.getenv("KLING_TOKEN_REFRESH_S", "120"))
+QUERY_CONCURRENCY = int(os.getenv("KLING_QUERY_CONCURRENCY", "5"))
+
+
+class KlingClient:
+    """
+    One per process: signs a JWT per key once per TOKEN_TTL_S instead of
+    per request and sends everything over the pooled keep-alive client.
+    Calls without a key use the first one of the pool.
+    """
+
+    def __init__(self, base: str = BASE):
+        self.base = base
+        # key_id -> (token, expires at)
+        self._tokens: dict[str, tuple[str, int]] = {}
+        self._query_sem = asyncio.Semaphore(QUERY_CONCURRENCY)
+
+    def token(self, key: Credential | None = None) -> str:
+        key = key or pools["kling"].get()
+        now = int(time.time())
+        token, token_exp = self._tokens.get(key.key_id, (None, 0))
+        if token is None or now >= token_exp - TOKEN_REFRESH_S:
+            exp = now + TOKEN_TTL_S
+            headers = {"alg": "HS256", "typ": "JWT"}
+            payload = {"iss": key.key, "exp": exp, "nbf": now - 5}
+            token = jwt.encode(payload, key.secret, headers=headers)
+            self._tokens[key.key_id] = (token, exp)
+        return token
+
+    def _headers(self, key: Credential | None) -> dict:
+        return {"Content-Type": "application/json", "Authorization": f"Bearer {self.token(key)}"}
+
+    async def post_json(self, path: str, body: dict, key: Credential | None = None) -> dict:
+        r = await get_client(self.base).post(f"{self.base}{path}", headers=self._headers(key), json=body, timeout=30)
+        r.raise_for_status()
+        return r.json()
+
+    async def get_json(self, path: str, key: Credential | None = None) -> dict:
+        r = await get_client(self.base).get(f"{self.base}{path}", headers=self._headers(key), timeout=30)
+        r.raise_for_status()
+        return r.json()
+
+    async def query(self, kind: str, task_id: str, key: Credential | None = None) -> dict:
+        """
+        Task `data` as in Kling's callback body (task_id, task_status,
+        task_result, ...); tasks are per account, so `key` is the creating one.
+        """
+        async with self._query_sem:
+            j = await self.get_json(f"/v1/videos/{kind}/{task_id}", key)
+        return j.get("data") or {}
+
+    async def query_many(self, tasks: list[tuple[str, str, Credential | None]]) -> list[dict | BaseException]:
+        """(kind, task_id, key) tuples, QUERY_CONCURRENCY at a time; errors are returned in place."""
+        return list(await asyncio.gather(*(self.query(kind, task_id, key) for kind, task_id, key in tasks),
+                                         return_exceptions=True))
+
+
+kling = KlingClient()
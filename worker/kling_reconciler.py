@@ -0,0 +1,173 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Awaitable, Callable
+
+import httpx
+
+from worker.keypool import pools
+from worker.kling_client import KlingClient
+from worker.metrics import KLING_RECONCILE
+
+log = logging.getLogger(__name__)
+
+TASKS_KEY = "kling:tasks"      # hash: task_id -> job_data json
+DUE_KEY = "kling:due"          # zset: task_id -> next check at
+RESOLVED_KEY = "kling:resolved:"  # + task_id: its callback arrived, set in case it beats track()
+
+TICK_S = float(os.getenv("KLING_RECONCILE_TICK_S", "10"))
+# a task still unfinished this long after creation is checked with Kling
+CALLBACK_GRACE_S = float(os.getenv("KLING_CALLBACK_GRACE_S", "900"))
+RECHECK_S = float(os.getenv("KLING_RECHECK_S", "120"))
+# unfinished this long after creation: reported as failed
+MAX_AGE_S = float(os.getenv("KLING_MAX_AGE_S", str(3 * 3600)))
+BATCH = int(os.getenv("KLING_RECONCILE_BATCH", "50"))
+# a claimed task is due again after this, in case its worker died mid-check
+CLAIM_S = 60
+
+FINAL = {"succeed", "failed"}
+
+LUA_CLAIM_DUE = r"""
+-- KEYS[1] = due zset
+-- ARGV[1] = now
+-- ARGV[2] = count
+-- ARGV[3] = claim until
+local due = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1], "LIMIT", 0, ARGV[2])
+for _, task_id in ipairs(due) do
+  redis.call("ZADD", KEYS[1], ARGV[3], task_id)
+end
+return due
+"""
+
+Callback = Callable[..., Awaitable[None]]
+
+
+class KlingReconciler:
+    """
+    Kling reports results only through callback_url, straight to the
+    backend, so a lost callback leaves the job in PROCESSING. Every created
+    task is tracked here; once it is CALLBACK_GRACE_S old the tasks due are
+    queried in batches and finished ones are re-reported with the body
+    Kling's callback carries (the backend sees them as a late callback).
+    Tasks are claimed atomically, so each check runs on one worker.
+
+    The backend enqueues `kling_resolved` when a callback does arrive, which
+    untracks the task, so only unresolved tasks are ever re-reported.
+    """
+
+    def __init__(self, redis, client: KlingClient, on_status: Callback, on_expired: Callback):
+        self.redis = redis
+        self.client = client
+        self.on_status = on_status
+        self.on_expired = on_expired
+        self._claim = redis.register_script(LUA_CLAIM_DUE)
+        self._task = None
+
+    async def track(self, job_data: dict):
+        """job_data: task_id, kind, job_id, user_id and key_id (the creating key)."""
+        job_data = {**job_data, "created_at": time.time()}
+        task_id = job_data["task_id"]
+        if await self.redis.exists(f"{RESOLVED_KEY}{task_id}"):
+            return
+        await self.redis.hset(TASKS_KEY, task_id, json.dumps(job_data))
+        await self.redis.zadd(DUE_KEY, {task_id: job_data["created_at"] + CALLBACK_GRACE_S}, nx=True)
+
+    async def untrack(self, task_id: str):
+        """Kling's callback reached the backend: nothing left to reconcile."""
+        await self.redis.set(f"{RESOLVED_KEY}{task_id}", 1, ex=int(MAX_AGE_S))
+        await self._finish(task_id)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                while await self._tick() == BATCH:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Kling reconciler tick failed")
+            await asyncio.sleep(TICK_S)
+
+    async def _tick(self) -> int:
+        now = time.time()
+        due = await self._claim(keys=[DUE_KEY], args=[now, BATCH, now + CLAIM_S])
+        if not due:
+            return 0
+        task_ids = [t.decode() if isinstance(t, bytes) else t for t in due]
+        raws = await self.redis.hmget(TASKS_KEY, task_ids)
+
+        jobs = []
+        for task_id, raw in zip(task_ids, raws):
+            if raw is None:
+                await self.redis.zrem(DUE_KEY, task_id)
+            else:
+                jobs.append(json.loads(raw))
+        results = await self.client.query_many([(job["kind"], job["task_id"], pools["kling"].get(job.get("key_id")))
+                                                for job in jobs])
+        await asyncio.gather(*(self._handle(job, res) for job, res in zip(jobs, results)))
+        return len(due)
+
+    async def _handle(self, job_data: dict, res):
+        task_id = job_data["task_id"]
+        age = time.time() - job_data["created_at"]
+
+        if isinstance(res, BaseException):
+            if isinstance(res, httpx.HTTPStatusError) and res.response.status_code == 404:
+                log.warning(f"Kling task {task_id} not found, dropping")
+                KLING_RECONCILE.labels(outcome="missing").inc()
+                await self._finish(task_id)
+                return
+            log.warning(f"Kling status query failed, will retry: {task_id}: {res}")
+            KLING_RECONCILE.labels(outcome="error").inc()
+        elif res.get("task_status") in FINAL:
+            if not await self.redis.hexists(TASKS_KEY, task_id):
+                # untracked while we queried Kling: the callback got there first
+                KLING_RECONCILE.labels(outcome="resolved").inc()
+                await self.redis.zrem(DUE_KEY, task_id)
+                return
+            try:
+                await self.on_status(job_data, res)
+            except Exception:
+                log.exception(f"Kling status dispatch failed: {task_id}")
+                await self._reschedule(task_id)
+                return
+            KLING_RECONCILE.labels(outcome=res["task_status"]).inc()
+            await self._finish(task_id)
+            return
+
+        if age > MAX_AGE_S:
+            log.error(f"Kling task {task_id} unfinished after {age:.0f}s, reporting failure")
+            KLING_RECONCILE.labels(outcome="expired").inc()
+            try:
+                await self.on_expired(job_data)
+            except Exception:
+                log.exception(f"Kling expiry dispatch failed: {task_id}")
+                await self._reschedule(task_id)
+                return
+            await self._finish(task_id)
+            return
+        if not isinstance(res, BaseException):
+            KLING_RECONCILE.labels(outcome="pending").inc()
+        await self._reschedule(task_id)
+
+    async def _reschedule(self, task_id: str):
+        await self.redis.zadd(DUE_KEY, {task_id: time.time() + RECHECK_S})
+
+    async def _finish(self, task_id: str):
+        await self.redis.zrem(DUE_KEY, task_id)
+        await self.redis.hdel(TASKS_KEY, task_id)
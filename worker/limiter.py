@@ -1,68 +1,646 @@
 import asyncio
+import json
+import logging
+import os
+import socket
 import time
+import uuid
 from typing import Optional
 
-LUA_ACQUIRE = r"""
--- KEYS[1] = rpm zset key
--- KEYS[2] = semaphore key
+log = logging.getLogger(__name__)
+
+WAKE_CHANNEL = "lim:wake:"
+
+# a concurrency slot is a lease that expires unless its holder heartbeats
+LEASE_TTL_S = float(os.getenv("LIMITER_LEASE_TTL_S", "30"))
+# how long a locally prefetched RPM token may wait to be spent
+PREFETCH_TTL_S = float(os.getenv("LIMITER_PREFETCH_TTL_S", "5"))
+# adaptive limits of a model that saw no feedback for this long reset to the policy
+AIMD_TTL_S = int(os.getenv("LIMITER_AIMD_TTL_S", "86400"))
+
+# rpm algorithm -> key prefix of its state
+RPM_KEYS = {
+    "zset": "lim:rpm:",      # exact sliding log, one member per request
+    "gcra": "lim:gcra:",     # one float (theoretical arrival time)
+    "sliding": "lim:swc:",   # two-bucket sliding counter, one small hash
+}
+
+# Shared by the scripts that wake a waiter: the first one in fair-queue order
+# whose user is under the per-user lease cap (only the first 200 are looked at).
+LUA_NEXT_WAITER = r"""
+local function next_waiter(wq_key, wquser_key, uconc_key, wfq_key, stop_at)
+  local cap = tonumber(redis.call("HGET", wfq_key, "cap") or "0")
+  for _, w in ipairs(redis.call("ZRANGE", wq_key, 0, 199)) do
+    if w == stop_at then
+      return nil
+    end
+    if cap <= 0 then
+      return w
+    end
+    local u = redis.call("HGET", wquser_key, w)
+    if not u or u == "" or tonumber(redis.call("HGET", uconc_key, u) or "0") < cap then
+      return w
+    end
+  end
+  return nil
+end
+
+local function drop_lease_users(luser_key, uconc_key, ids)
+  for _, id in ipairs(ids) do
+    local u = redis.call("HGET", luser_key, id)
+    if u then
+      redis.call("HDEL", luser_key, id)
+      if redis.call("HINCRBY", uconc_key, u, -1) <= 0 then
+        redis.call("HDEL", uconc_key, u)
+      end
+    end
+  end
+end
+"""
+
+LUA_ACQUIRE = LUA_NEXT_WAITER + r"""
+-- KEYS[1] = rpm key (zset, gcra string or sliding-counter hash, see ARGV[9])
+-- KEYS[2] = lease zset (lease id -> expires at)
+-- KEYS[3] = wait queue zset (waiter -> virtual finish tag)
+-- KEYS[4] = wait heartbeat zset (waiter -> last seen)
+-- KEYS[5] = lease holders hash (lease id -> json)
+-- KEYS[6] = adaptive limits hash (see LUA_FEEDBACK)
+-- KEYS[7] = fair queue state hash (v = virtual time, cap, f:<flow> = last finish tag)
+-- KEYS[8] = waiter users hash (waiter -> user)
+-- KEYS[9] = user lease counts hash (user -> leases held)
+-- KEYS[10] = lease users hash (lease id -> user)
 -- ARGV[1] = now (seconds)
 -- ARGV[2] = window_s
 -- ARGV[3] = rpm_limit (-1 means disabled)
 -- ARGV[4] = conc_limit (-1 means disabled)
--- ARGV[5] = sem_ttl_ms
+-- ARGV[5] = lease_ttl_s
+-- ARGV[6] = waiter id
+-- ARGV[7] = waiter stale_s
+-- ARGV[8] = wake channel
+-- ARGV[9] = rpm algorithm: zset | gcra | sliding
+-- ARGV[10] = gcra burst
+-- ARGV[11] = lease id
+-- ARGV[12] = holder info (json)
+-- ARGV[13] = rpm tokens wanted (1 + how many to prefetch)
+-- ARGV[14] = prefetch_ttl (seconds a prefetched token may stay unused)
+-- ARGV[15] = 1 to use the adaptive limits from KEYS[6] when set
+-- ARGV[16] = user ("" = anonymous, queued as its own flow)
+-- ARGV[17] = per-user lease cap (-1 means disabled, needs conc)
+-- ARGV[18] = lane weight (a flow with weight 2 is served twice as often)
+-- returns {ok, reason, retry_after_ms (-1 = wait for a wake), tokens granted, valid until}
 
 local rpm_key = KEYS[1]
-local sem_key = KEYS[2]
+local lease_key = KEYS[2]
+local wq_key = KEYS[3]
+local hb_key = KEYS[4]
+local holders_key = KEYS[5]
+local aimd_key = KEYS[6]
+local wfq_key = KEYS[7]
+local wquser_key = KEYS[8]
+local uconc_key = KEYS[9]
+local luser_key = KEYS[10]
 
 local now = tonumber(ARGV[1])
 local window = tonumber(ARGV[2])
 local rpm = tonumber(ARGV[3])
 local conc = tonumber(ARGV[4])
-local sem_ttl = tonumber(ARGV[5])
+local lease_ttl = tonumber(ARGV[5])
+local waiter = ARGV[6]
+local stale = tonumber(ARGV[7])
+local channel = ARGV[8]
+local algo = ARGV[9]
+local burst = tonumber(ARGV[10])
+local lease_id = ARGV[11]
+local holder = ARGV[12]
+local take = tonumber(ARGV[13])
+local prefetch_ttl = tonumber(ARGV[14])
+local user = ARGV[16]
+local user_cap = tonumber(ARGV[17])
+local weight = tonumber(ARGV[18])
+local flow = "f:" .. (user ~= "" and user or waiter)
+
+-- adaptive policies: the shared limits replace the static ones
+if ARGV[15] == "1" then
+  local limits = redis.call("HMGET", aimd_key, "conc", "rpm")
+  if conc > 0 and limits[1] then
+    conc = math.max(1, math.floor(tonumber(limits[1])))
+  end
+  if rpm > 0 and limits[2] then
+    rpm = math.max(1, math.floor(tonumber(limits[2])))
+  end
+end
+
+-- drop waiters whose process stopped refreshing (crash, kill -9)
+local dead = redis.call("ZRANGEBYSCORE", hb_key, 0, now - stale)
+if #dead > 0 then
+  redis.call("ZREM", wq_key, unpack(dead))
+  redis.call("ZREM", hb_key, unpack(dead))
+  redis.call("HDEL", wquser_key, unpack(dead))
+end
+
+-- weighted fair queuing: each user is a flow, a job's finish tag is
+-- max(virtual time, the flow's last tag) + 1 / lane weight, and the queue is
+-- served in tag order. One user's backlog therefore interleaves with
+-- everybody else's jobs instead of standing in front of them.
+local function finish_tag()
+  local state = redis.call("HMGET", wfq_key, "v", flow)
+  return math.max(tonumber(state[1] or "0"), tonumber(state[2] or "0")) + 1 / weight
+end
+
+local function enqueue()
+  if not redis.call("ZSCORE", wq_key, waiter) then
+    local tag = finish_tag()
+    redis.call("ZADD", wq_key, tag, waiter)
+    redis.call("HSET", wfq_key, flow, tostring(tag), "cap", user_cap)
+    redis.call("HSET", wquser_key, waiter, user)
+  end
+  redis.call("ZADD", hb_key, now, waiter)
+  for _, key in ipairs({wq_key, hb_key, wfq_key, wquser_key}) do
+    redis.call("EXPIRE", key, math.ceil(stale * 10))
+  end
+end
+
+-- RPM algorithms. check() returns retry_after seconds (0 = allowed), how
+-- many of the `take` requested tokens can be granted (>= 1 when allowed) and
+-- whether another request would still fit afterwards; grant() records them.
+-- Tokens beyond the first are prefetched by the caller and may be spent up
+-- to `prefetch_ttl` later, so they are booked as if used at that time.
+
+-- zset: one member per request inside the window (exact, O(rpm) memory)
+local function zset_check()
+  redis.call("ZREMRANGEBYSCORE", rpm_key, 0, now - window)
+  local count = tonumber(redis.call("ZCARD", rpm_key) or "0")
+  if count >= rpm then
+    local oldest = redis.call("ZRANGE", rpm_key, 0, 0, "WITHSCORES")[2]
+    return math.max(tonumber(oldest) + window - now, 0.001), 0, false
+  end
+  local granted = math.min(take, rpm - count)
+  return 0, granted, count + granted < rpm
+end
+
+local function zset_grant(granted)
+  local seq = redis.call("INCRBY", rpm_key .. ":seq", granted)
+  for i = 1, granted do
+    local at = now
+    if i > 1 then
+      at = now + prefetch_ttl
+    end
+    redis.call("ZADD", rpm_key, at, tostring(now) .. "-" .. tostring(seq - i + 1))
+  end
+  redis.call("EXPIRE", rpm_key, math.ceil(window * 2 + prefetch_ttl))
+  return now + prefetch_ttl
+end
+
+-- gcra: a single theoretical arrival time, rate rpm/window with `burst` slack;
+-- any burst > 1 lets up to burst - 1 requests more than rpm into a window
+local emission = window / math.max(rpm, 1)
+local tolerance = emission * (burst - 1)
+local new_tat = 0
+
+local function gcra_check()
+  local tat = tonumber(redis.call("GET", rpm_key) or "0")
+  if tat < now then
+    tat = now
+  end
+  if tat - now > tolerance then
+    return tat - tolerance - now, 0, false
+  end
+  local granted = math.min(take, math.floor((tolerance - (tat - now)) / emission) + 1)
+  new_tat = tat + granted * emission
+  return 0, granted, new_tat - now <= tolerance
+end
+
+local function gcra_grant(granted)
+  redis.call("SET", rpm_key, tostring(new_tat), "PX", math.ceil((new_tat - now) * 1000) + 1000)
+  -- arriving later than booked never breaks the rate
+  return now + prefetch_ttl
+end
+
+-- sliding: counts for the current and previous fixed window, weighted by overlap
+local bucket = math.floor(now / window)
+local prev, curr = 0, 0
+
+local function sliding_check()
+  local state = redis.call("HMGET", rpm_key, "bucket", "curr", "prev")
+  local stored = tonumber(state[1] or "-1")
+  if stored == bucket then
+    curr, prev = tonumber(state[2]), tonumber(state[3])
+  elseif stored == bucket - 1 then
+    curr, prev = 0, tonumber(state[2])
+  end
+  local elapsed = (now - bucket * window) / window
+  local estimate = prev * (1 - elapsed) + curr
+  if estimate + 1 > rpm then
+    if curr + 1 > rpm or prev == 0 then
+      return (bucket + 1) * window - now, 0, false
+    end
+    local needed = 1 - (rpm - 1 - curr) / prev
+    return math.max((needed - elapsed) * window, 0.001), 0, false
+  end
+  local granted = math.min(take, math.floor(rpm - estimate))
+  return 0, granted, estimate + granted + 1 <= rpm
+end
+
+local function sliding_grant(granted)
+  redis.call("HSET", rpm_key, "bucket", bucket, "curr", curr + granted, "prev", prev)
+  redis.call("EXPIRE", rpm_key, math.ceil(window * 2))
+  -- prefetched tokens are only exact inside the bucket they were counted in
+  return math.min(now + prefetch_ttl, (bucket + 1) * window)
+end
+
+local rpm_check, rpm_grant = zset_check, zset_grant
+if algo == "gcra" then
+  rpm_check, rpm_grant = gcra_check, gcra_grant
+elseif algo == "sliding" then
+  rpm_check, rpm_grant = sliding_check, sliding_grant
+end
+
+if conc > 0 then
+  -- reap leases whose holder stopped heartbeating (crashed worker)
+  local expired = redis.call("ZRANGEBYSCORE", lease_key, 0, now)
+  if #expired > 0 then
+    redis.call("ZREM", lease_key, unpack(expired))
+    redis.call("HDEL", holders_key, unpack(expired))
+    drop_lease_users(luser_key, uconc_key, expired)
+  end
+end
 
+-- a user at their lease cap waits without holding up anyone else
+if conc > 0 and user_cap > 0 and user ~= ""
+    and tonumber(redis.call("HGET", uconc_key, user) or "0") >= user_cap then
+  enqueue()
+  return {0, "user", -1}
+end
+
+-- fair order: only the first eligible waiter may take a freed slot
+if redis.call("ZCARD", wq_key) > 0 then
+  enqueue()
+  if next_waiter(wq_key, wquser_key, uconc_key, wfq_key, waiter) then
+    return {0, "queued", -1}
+  end
+end
+
+local current = 0
 if conc > 0 then
-  local current = tonumber(redis.call("GET", sem_key) or "0")
+  current = redis.call("ZCARD", lease_key)
   if current >= conc then
-    return {0, "concurrency"}
+    enqueue()
+    return {0, "concurrency", -1}
   end
 end
 
+local rpm_room = true
+local granted = 0
 if rpm > 0 then
-  local cutoff = now - window
-  redis.call("ZREMRANGEBYSCORE", rpm_key, 0, cutoff)
-  local count = tonumber(redis.call("ZCARD", rpm_key) or "0")
-  if count >= rpm then
-    return {0, "rpm"}
+  local retry
+  retry, granted, rpm_room = rpm_check()
+  if retry > 0 then
+    enqueue()
+    return {0, "rpm", math.max(math.ceil(retry * 1000), 1)}
   end
 end
 
 if conc > 0 then
-  redis.call("INCR", sem_key)
-  redis.call("PEXPIRE", sem_key, sem_ttl)
+  redis.call("ZADD", lease_key, now + lease_ttl, lease_id)
+  redis.call("HSET", holders_key, lease_id, holder)
+  if user ~= "" then
+    redis.call("HSET", luser_key, lease_id, user)
+    redis.call("HINCRBY", uconc_key, user, 1)
+  end
+  for _, key in ipairs({lease_key, holders_key, luser_key, uconc_key}) do
+    redis.call("EXPIRE", key, math.ceil(lease_ttl * 2))
+  end
 end
 
+local valid_until = 0
 if rpm > 0 then
-  local member = tostring(now) .. "-" .. tostring(redis.call("INCR", rpm_key .. ":seq"))
-  redis.call("ZADD", rpm_key, now, member)
-  redis.call("EXPIRE", rpm_key, math.ceil(window * 2))
+  valid_until = rpm_grant(granted)
+end
+
+-- advance virtual time to the tag just served
+local tag = tonumber(redis.call("ZSCORE", wq_key, waiter) or "0")
+if tag == 0 then
+  tag = finish_tag()
+end
+redis.call("ZREM", wq_key, waiter)
+redis.call("ZREM", hb_key, waiter)
+redis.call("HDEL", wquser_key, waiter)
+if redis.call("ZCARD", wq_key) == 0 then
+  -- idle again: restart virtual time and forget every flow
+  redis.call("DEL", wfq_key)
+else
+  local v = math.max(tonumber(redis.call("HGET", wfq_key, "v") or "0"), tag)
+  redis.call("HSET", wfq_key, "v", tostring(v))
+  if tonumber(redis.call("HGET", wfq_key, flow) or "0") <= v then
+    redis.call("HDEL", wfq_key, flow)
+  end
+end
+
+-- capacity left over: let the next waiter try right away
+local nxt = next_waiter(wq_key, wquser_key, uconc_key, wfq_key, nil)
+if nxt and (conc <= 0 or current + 1 < conc) and rpm_room then
+  redis.call("PUBLISH", channel, nxt)
+end
+
+return {1, "ok", 0, granted, tostring(valid_until)}
+"""
+
+LUA_RELEASE = LUA_NEXT_WAITER + r"""
+-- KEYS[1] = lease zset
+-- KEYS[2] = wait queue zset
+-- KEYS[3] = lease holders hash
+-- KEYS[4..7] = fair queue state, waiter users, user lease counts, lease users
+-- ARGV[1] = wake channel
+-- ARGV[2] = lease id
+redis.call("ZREM", KEYS[1], ARGV[2])
+redis.call("HDEL", KEYS[3], ARGV[2])
+drop_lease_users(KEYS[7], KEYS[6], {ARGV[2]})
+local head = next_waiter(KEYS[2], KEYS[5], KEYS[6], KEYS[4], nil)
+if head then
+  redis.call("PUBLISH", ARGV[1], head)
+end
+return 1
+"""
+
+LUA_RENEW = r"""
+-- KEYS[1] = lease zset
+-- KEYS[2] = lease holders hash
+-- KEYS[3] = user lease counts hash
+-- KEYS[4] = lease users hash
+-- ARGV[1] = new expiry (seconds)
+-- ARGV[2] = lease_ttl_s
+-- ARGV[3..] = lease ids
+-- returns the lease ids that were already reaped
+local lost = {}
+for i = 3, #ARGV do
+  if redis.call("ZADD", KEYS[1], "XX", "CH", ARGV[1], ARGV[i]) == 0
+      and not redis.call("ZSCORE", KEYS[1], ARGV[i]) then
+    table.insert(lost, ARGV[i])
+  end
+end
+for i = 1, 4 do
+  redis.call("EXPIRE", KEYS[i], math.ceil(tonumber(ARGV[2]) * 2))
+end
+return lost
+"""
+
+LUA_LEAVE = LUA_NEXT_WAITER + r"""
+-- KEYS[1] = wait queue zset
+-- KEYS[2] = wait heartbeat zset
+-- KEYS[3..5] = fair queue state, waiter users, user lease counts
+-- ARGV[1] = waiter id
+-- ARGV[2] = wake channel
+redis.call("ZREM", KEYS[1], ARGV[1])
+redis.call("ZREM", KEYS[2], ARGV[1])
+redis.call("HDEL", KEYS[4], ARGV[1])
+local head = next_waiter(KEYS[1], KEYS[4], KEYS[5], KEYS[3], nil)
+if head then
+  redis.call("PUBLISH", ARGV[2], head)
+end
+return 1
+"""
+
+LUA_FEEDBACK = LUA_NEXT_WAITER + r"""
+-- AIMD: successes grow each limit by `step` per round (conc: one round is
+-- `conc` successes, rpm: `rpm` successes, i.e. a window at full use);
+-- throttling or a latency spike multiplies it by `decrease`, at most once
+-- per cooldown so the burst of failures already in flight counts once.
+-- KEYS[1] = adaptive limits hash (conc, rpm, cut_at)
+-- KEYS[2] = wait queue zset
+-- KEYS[3..5] = fair queue state, waiter users, user lease counts
+-- ARGV[1] = now (seconds)
+-- ARGV[2] = outcome: ok | throttled | slow
+-- ARGV[3..6] = conc start, min, max, step (start -1 = not limited)
+-- ARGV[7..10] = rpm start, min, max, step (start -1 = not limited)
+-- ARGV[11] = decrease factor
+-- ARGV[12] = cooldown_s
+-- ARGV[13] = wake channel
+-- ARGV[14] = state ttl_s (idle models start over from the static limits)
+-- returns {conc, rpm} after the update
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local outcome = ARGV[2]
+local decrease = tonumber(ARGV[11])
+local cooldown = tonumber(ARGV[12])
+
+local state = redis.call("HMGET", key, "conc", "rpm", "cut_at")
+local cut_at = tonumber(state[3] or "0")
+local cut = outcome ~= "ok" and now - cut_at >= cooldown
+
+local function current(stored, start)
+  if stored and tonumber(stored) > 0 then
+    return tonumber(stored)
+  end
+  return start
 end
 
-return {1, "ok"}
+local function update(stored, start, min, max, step)
+  if start <= 0 then
+    return -1
+  end
+  local limit = current(stored, start)
+  if outcome == "ok" then
+    limit = limit + step / math.max(limit, 1)
+  elseif cut then
+    limit = limit * decrease
+  end
+  return math.min(max, math.max(min, limit))
+end
+
+local old_conc = current(state[1], tonumber(ARGV[3]))
+local conc = update(state[1], tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6]))
+local rpm = update(state[2], tonumber(ARGV[7]), tonumber(ARGV[8]), tonumber(ARGV[9]), tonumber(ARGV[10]))
+if cut then
+  cut_at = now
+end
+
+redis.call("HSET", key, "conc", tostring(conc), "rpm", tostring(rpm), "cut_at", tostring(cut_at))
+redis.call("EXPIRE", key, ARGV[14])
+
+-- a slot just appeared: wake the head waiter instead of waiting for a release
+if math.floor(conc) > math.floor(old_conc) then
+  local head = next_waiter(KEYS[2], KEYS[4], KEYS[5], KEYS[3], nil)
+  if head then
+    redis.call("PUBLISH", ARGV[13], head)
+  end
+end
+return {tostring(conc), tostring(rpm)}
 """
 
-LUA_RELEASE = r"""
--- KEYS[1] = semaphore key
-local sem_key = KEYS[1]
-local current = tonumber(redis.call("GET", sem_key) or "0")
-if current > 0 then
-  redis.call("DECR", sem_key)
+LUA_REFUND = r"""
+-- KEYS[1] = rpm key
+-- ARGV[1] = now (seconds)
+-- ARGV[2] = window_s
+-- ARGV[3] = rpm_limit
+-- ARGV[4] = rpm algorithm
+-- ARGV[5] = unused prefetched tokens to give back
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local rpm = tonumber(ARGV[3])
+local algo = ARGV[4]
+local n = tonumber(ARGV[5])
+
+if algo == "gcra" then
+  local tat = tonumber(redis.call("GET", key) or "0")
+  local refunded = math.max(now, tat - n * window / rpm)
+  if tat > now then
+    redis.call("SET", key, tostring(refunded), "PX", math.ceil((refunded - now) * 1000) + 1000)
+  end
+elseif algo == "sliding" then
+  local state = redis.call("HMGET", key, "bucket", "curr")
+  if tonumber(state[1] or "-1") == math.floor(now / window) then
+    redis.call("HSET", key, "curr", math.max(0, tonumber(state[2]) - n))
+  end
+else
+  -- prefetched members carry the highest (future) scores
+  redis.call("ZPOPMAX", key, n)
 end
 return 1
 """
 
+
+def _fair_keys(model_key: str) -> list[str]:
+    # fair queue state, waiter -> user, user -> leases held, lease -> user
+    return [f"lim:wfq:{model_key}", f"lim:wquser:{model_key}", f"lim:uconc:{model_key}", f"lim:luser:{model_key}"]
+
+
+class BudgetTimeout(TimeoutError):
+    def __init__(self, model_key: str, reason: str):
+        super().__init__(f"Budget wait timeout: {model_key} ({reason})")
+        self.reason = reason
+
+
 class RateLimiter:
+    """
+    Waiters queue up in Redis and sleep until `release` (or the next
+    waiter's acquire) publishes their id on `lim:wake:<model_key>`, or until
+    the oldest RPM entry leaves the window. Polling is only a fallback for
+    lost pub/sub messages.
+
+    The queue is weighted-fair per user: every user is a flow, jobs of one
+    user interleave with other users' jobs, and a lane weight makes a flow
+    proportionally faster. With `user_concurrency` a user holds at most that
+    many leases; their other jobs wait without blocking anyone.
+
+    Concurrency slots are per-holder leases in `lim:leases:<model_key>`,
+    scored by expiry. One heartbeat task per process renews every lease it
+    holds; leases of crashed workers expire and are reaped on acquire.
+
+    With `prefetch > 0` an acquire that has to go to Redis for an RPM token
+    takes up to `prefetch` extra ones into a per-process bucket. They are
+    booked globally when taken, expire locally after PREFETCH_TTL_S, and the
+    unused ones are refunded on `close`.
+
+    With `adaptive=True` the concurrency and RPM limits are read from
+    `lim:aimd:<model_key>`, which `feedback` moves up on success and down
+    on throttling (AIMD), so every worker sees the same effective limits.
+
+    Scripts are registered once and run with EVALSHA (redis-py reloads them
+    on NOSCRIPT).
+    """
+
     def __init__(self, redis):
         self.redis = redis
+        self._acquire = redis.register_script(LUA_ACQUIRE)
+        self._release = redis.register_script(LUA_RELEASE)
+        self._leave = redis.register_script(LUA_LEAVE)
+        self._renew = redis.register_script(LUA_RENEW)
+        self._refund = redis.register_script(LUA_REFUND)
+        self._feedback = redis.register_script(LUA_FEEDBACK)
+        self._waiters: dict[str, asyncio.Event] = {}
+        # lease id -> (model_key, lease_ttl_s) for leases held by this process
+        self._held: dict[str, tuple[str, float]] = {}
+        self._tasks: list[asyncio.Task] = []
+        self._holder_prefix = f"{socket.gethostname()}:{os.getpid()}"
+        # model_key -> valid-until timestamps of prefetched RPM tokens
+        self._tokens: dict[str, list[float]] = {}
+        # model_key -> (algorithm, window_s, rpm) needed to refund them
+        self._token_meta: dict[str, tuple[str, int, int]] = {}
+
+    async def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._listen()), asyncio.create_task(self._heartbeat())]
+
+    async def close(self):
+        await self._refund_tokens()
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+
+    def _take_token(self, model_key: str) -> Optional[float]:
+        tokens = self._tokens.get(model_key)
+        now = time.time()
+        while tokens:
+            valid_until = tokens.pop()
+            if valid_until > now:
+                return valid_until
+        return None
+
+    async def _refund_tokens(self):
+        now = time.time()
+        for model_key, tokens in self._tokens.items():
+            unused = sum(1 for valid_until in tokens if valid_until > now)
+            if not unused:
+                continue
+            algorithm, window_s, rpm = self._token_meta[model_key]
+            try:
+                await self._refund(
+                    keys=[f"{RPM_KEYS[algorithm]}{model_key}"],
+                    args=[now, window_s, rpm, algorithm, unused],
+                )
+            except Exception as e:
+                log.warning(f"Could not refund {unused} prefetched tokens: {model_key}: {e}")
+        self._tokens.clear()
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(LEASE_TTL_S / 3)
+            groups: dict[tuple[str, float], list[str]] = {}
+            for lease_id, key in list(self._held.items()):
+                groups.setdefault(key, []).append(lease_id)
+            for (model_key, ttl), lease_ids in groups.items():
+                try:
+                    lost = await self._renew(
+                        keys=[f"lim:leases:{model_key}", f"lim:holders:{model_key}",
+                              f"lim:uconc:{model_key}", f"lim:luser:{model_key}"],
+                        args=[time.time() + ttl, ttl, *lease_ids],
+                    )
+                except Exception as e:
+                    log.warning(f"Lease heartbeat failed: {model_key}: {e}")
+                    continue
+                for lease_id in lost:
+                    if isinstance(lease_id, bytes):
+                        lease_id = lease_id.decode()
+                    log.warning(f"Lease expired before renewal: {model_key} {lease_id}")
+
+    async def _listen(self):
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.psubscribe(f"{WAKE_CHANNEL}*")
+                async for msg in pubsub.listen():
+                    if msg["type"] != "pmessage":
+                        continue
+                    waiter = msg["data"]
+                    if isinstance(waiter, bytes):
+                        waiter = waiter.decode()
+                    event = self._waiters.get(waiter)
+                    if event is not None:
+                        event.set()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # waiters fall back to polling until we are back
+                log.warning(f"Limiter wake listener error: {e}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
 
     async def acquire(
         self,
@@ -70,38 +648,182 @@ class RateLimiter:
         rpm: Optional[int],
         concurrency: Optional[int],
         window_s: int = 60,
-        sem_ttl_ms: int = 10 * 60 * 1000,
-        poll_s: float = 0.25,
+        poll_s: float = 2.0,
         max_wait_s: float = 120.0,
-    ):
-        rpm_key = f"lim:rpm:{model_key}"
-        sem_key = f"lim:sem:{model_key}"
+        algorithm: str = "zset",
+        burst: Optional[int] = None,
+        lease_ttl_s: float = LEASE_TTL_S,
+        holder: Optional[dict] = None,
+        prefetch: int = 0,
+        adaptive: bool = False,
+        user: Optional[str | int] = None,
+        user_concurrency: Optional[int] = None,
+        weight: float = 1.0,
+    ) -> Optional[str]:
+        """
+        Wait for an RPM token and a concurrency lease. Returns the lease id to
+        pass to `release` (None when the policy has no concurrency limit).
+        `user` and `weight` (the lane's) place the job in the fair queue.
+        """
+        rpm_key = f"{RPM_KEYS[algorithm]}{model_key}"
+        lease_key = f"lim:leases:{model_key}"
+        holders_key = f"lim:holders:{model_key}"
+        wq_key = f"lim:wq:{model_key}"
+        hb_key = f"lim:wqhb:{model_key}"
+        aimd_key = f"lim:aimd:{model_key}"
+        fair_keys = _fair_keys(model_key)
+        channel = f"{WAKE_CHANNEL}{model_key}"
 
         rpm_arg = int(rpm) if rpm and rpm > 0 else -1
         conc_arg = int(concurrency) if concurrency and concurrency > 0 else -1
+        # gcra: strictly rpm per window unless the policy opts into a burst
+        burst_arg = int(burst) if burst and burst > 0 else 1
+        user_cap_arg = int(user_concurrency) if user_concurrency and user_concurrency > 0 else -1
+        stale_s = max(10.0, poll_s * 4)
+
+        take = 1
+        local_token = None
+        if rpm_arg > 0 and prefetch > 0:
+            local_token = self._take_token(model_key)
+            if local_token is not None:
+                # already booked globally; only the concurrency lease is left
+                rpm_arg = -1
+                if conc_arg < 0:
+                    return None
+            else:
+                take = 1 + prefetch
+
+        waiter = uuid.uuid4().hex
+        lease_id = f"{self._holder_prefix}:{waiter[:12]}"
+        holder_arg = json.dumps({**(holder or {}), "acquired_at": time.time()})
+        wake = self._waiters[waiter] = asyncio.Event()
+        acquired = False
 
         start = time.monotonic()
-        while True:
-            now = time.time()
+        try:
+            while True:
+                wake.clear()
+                now = time.time()
+
+                res = await self._acquire(
+                    keys=[rpm_key, lease_key, wq_key, hb_key, holders_key, aimd_key, *fair_keys],
+                    args=[now, window_s, rpm_arg, conc_arg, lease_ttl_s, waiter, stale_s, channel,
+                          algorithm, burst_arg, lease_id, holder_arg, take, PREFETCH_TTL_S,
+                          1 if adaptive else 0, "" if user is None else str(user), user_cap_arg, weight],
+                )
+                ok, reason, retry_ms = res[:3]
+
+                if int(ok) == 1:
+                    acquired = True
+                    granted = int(res[3])
+                    if granted > 1:
+                        self._tokens.setdefault(model_key, []).extend([float(res[4])] * (granted - 1))
+                        self._token_meta[model_key] = (algorithm, window_s, rpm_arg)
+                    if conc_arg < 0:
+                        return None
+                    self._held[lease_id] = (model_key, lease_ttl_s)
+                    return lease_id
 
-            # IMPORTANT: redis eval signature is: eval(script, numkeys, *keys_and_args)
-            ok, reason = await self.redis.eval(
-                LUA_ACQUIRE,
-                2,              # numkeys
-                rpm_key, sem_key,
-                now, window_s, rpm_arg, conc_arg, sem_ttl_ms
-            )
+                remaining = max_wait_s - (time.monotonic() - start)
+                if remaining <= 0:
+                    if isinstance(reason, bytes):
+                        reason = reason.decode()
+                    raise BudgetTimeout(model_key, reason)
 
-            if int(ok) == 1:
-                return
+                timeout = min(poll_s, remaining)
+                if int(retry_ms) > 0:
+                    timeout = min(timeout, int(retry_ms) / 1000)
+                try:
+                    await asyncio.wait_for(wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._waiters.pop(waiter, None)
+            if not acquired:
+                if local_token is not None:
+                    self._tokens[model_key].append(local_token)
+                # give our place to the next waiter (timeout or job cancelled)
+                await asyncio.shield(self._leave(keys=[wq_key, hb_key, *fair_keys[:3]], args=[waiter, channel]))
+
+    async def release(self, model_key: str, lease_id: Optional[str]):
+        if lease_id is None:
+            return
+        self._held.pop(lease_id, None)
+        await self._release(
+            keys=[f"lim:leases:{model_key}", f"lim:wq:{model_key}", f"lim:holders:{model_key}",
+                  *_fair_keys(model_key)],
+            args=[f"{WAKE_CHANNEL}{model_key}", lease_id],
+        )
+
+    async def feedback(
+        self,
+        model_key: str,
+        outcome: str,
+        concurrency: Optional[tuple[int, int, int]] = None,
+        rpm: Optional[tuple[int, int, int]] = None,
+        concurrency_step: float = 1.0,
+        rpm_step: float = 1.0,
+        decrease: float = 0.5,
+        cooldown_s: float = 5.0,
+    ) -> tuple[Optional[float], Optional[float]]:
+        """
+        Report how a call went for an adaptive model: "ok", "throttled" (429,
+        quota) or "slow" (latency spike). `concurrency` and `rpm` are
+        (start, min, max) bounds. Returns the new shared limits.
+        """
+        conc_args = list(concurrency) if concurrency else [-1, -1, -1]
+        rpm_args = list(rpm) if rpm else [-1, -1, -1]
+        res = await self._feedback(
+            keys=[f"lim:aimd:{model_key}", f"lim:wq:{model_key}", *_fair_keys(model_key)[:3]],
+            args=[time.time(), outcome, *conc_args, concurrency_step, *rpm_args, rpm_step,
+                  decrease, cooldown_s, f"{WAKE_CHANNEL}{model_key}", AIMD_TTL_S],
+        )
+        conc, rpm_limit = (float(v) for v in res)
+        return (conc if conc > 0 else None), (rpm_limit if rpm_limit > 0 else None)
 
-            if time.monotonic() - start > max_wait_s:
-                raise TimeoutError(f"Budget wait timeout: {model_key} ({reason})")
+    async def limits(self, model_key: str) -> dict:
+        """
+        Current adaptive limits of a model (empty until the first feedback).
+        """
+        state = await self.redis.hgetall(f"lim:aimd:{model_key}")
+        return {(k.decode() if isinstance(k, bytes) else k): float(v) for k, v in state.items()}
 
-            await asyncio.sleep(poll_s)
+    async def pressure(self, model_key: str) -> dict:
+        """
+        Live leases, queued waiters and the adaptive concurrency (None until
+        the first feedback) of a model.
+        """
+        return (await self.pressure_many([model_key]))[0]
 
-    async def release(self, model_key: str):
-        sem_key = f"lim:sem:{model_key}"
+    async def pressure_many(self, model_keys: list[str]) -> list[dict]:
+        """`pressure` of several models (or keys of a pool) in one round trip."""
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        for model_key in model_keys:
+            pipe.zcount(f"lim:leases:{model_key}", now, "+inf")
+            pipe.zcard(f"lim:wq:{model_key}")
+            pipe.hget(f"lim:aimd:{model_key}", "conc")
+        res = await pipe.execute()
+        return [{"leases": int(leases), "waiters": int(waiters), "conc": float(conc) if conc is not None else None}
+                for leases, waiters, conc in zip(res[0::3], res[1::3], res[2::3])]
 
-        # numkeys = 1, then key, then args (none here)
-        await self.redis.eval(LUA_RELEASE, 1, sem_key)
+    async def holders(self, model_key: str) -> list[dict]:
+        """
+        Current concurrency leases of a model, oldest expiry first.
+        """
+        leases = await self.redis.zrange(f"lim:leases:{model_key}", 0, -1, withscores=True)
+        if not leases:
+            return []
+        infos = await self.redis.hmget(f"lim:holders:{model_key}", [lease_id for lease_id, _ in leases])
+        now = time.time()
+        result = []
+        for (lease_id, expires_at), info in zip(leases, infos):
+            if isinstance(lease_id, bytes):
+                lease_id = lease_id.decode()
+            result.append({
+                "lease_id": lease_id,
+                "expires_at": expires_at,
+                "expired": expires_at <= now,
+                **(json.loads(info) if info else {}),
+            })
+        return result
@@ -0,0 +1,196 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import Optional
+
+from worker.executor import blocking
+
+MEMORY_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+DISK_DIR = os.getenv("MEDIA_CACHE_DIR")  # unset = memory only
+DISK_MAX_BYTES = int(os.getenv("MEDIA_CACHE_DISK_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+# disk entries not used for this long are removed, whatever the size
+DISK_MAX_AGE_S = float(os.getenv("MEDIA_CACHE_DISK_MAX_AGE_S", str(7 * 24 * 3600)))
+# entries younger than this are served without asking the origin
+FRESH_S = float(os.getenv("MEDIA_CACHE_FRESH_S", "600"))
+
+
+@dataclass
+class CachedMedia:
+    url: str
+    sha256: str
+    mime: str
+    size: int
+    fetched_at: float
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    data: bytes = b""
+
+    def is_fresh(self) -> bool:
+        return time.time() - self.fetched_at < FRESH_S
+
+    def validators(self) -> dict:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class MediaCache:
+    """
+    Two tiers: in-memory LRU bounded by bytes, plus an optional on-disk store.
+    On disk, blobs are content-addressed (blobs/<sha256>) and URLs map to them
+    through small JSON index files (index/<sha1(url)>.json). Files are
+    touched on every hit, so the disk tier is pruned least recently used
+    first down to disk_max_bytes, and anything unused for disk_max_age_s goes.
+    """
+
+    def __init__(self, max_bytes: int = MEMORY_MAX_BYTES, disk_dir: Optional[str] = DISK_DIR,
+                 disk_max_bytes: int = DISK_MAX_BYTES, disk_max_age_s: float = DISK_MAX_AGE_S):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_max_age_s = disk_max_age_s
+        self._lru: OrderedDict[str, CachedMedia] = OrderedDict()
+        self._bytes = 0
+        self._disk_writes = 0
+        self.counters = {"hits": 0, "misses": 0, "revalidated": 0, "stale": 0}
+
+        if disk_dir:
+            os.makedirs(os.path.join(disk_dir, "blobs"), exist_ok=True)
+            os.makedirs(os.path.join(disk_dir, "index"), exist_ok=True)
+
+    def stats(self) -> dict:
+        return {**self.counters, "entries": len(self._lru), "bytes": self._bytes}
+
+    async def get(self, url: str) -> Optional[CachedMedia]:
+        entry = self._lru.get(url)
+        if entry is not None:
+            self._lru.move_to_end(url)
+            return entry
+
+        if self.disk_dir:
+            entry = await blocking.run(self._disk_get, url)
+            if entry is not None:
+                self._remember(entry)
+                return entry
+        return None
+
+    async def put(self, entry: CachedMedia):
+        self._remember(entry)
+        if self.disk_dir:
+            await blocking.run(self._disk_put, entry)
+
+    async def touch(self, entry: CachedMedia, etag: Optional[str], last_modified: Optional[str]):
+        # origin answered 304: content unchanged, restart the freshness window
+        entry.fetched_at = time.time()
+        entry.etag = etag or entry.etag
+        entry.last_modified = last_modified or entry.last_modified
+        if self.disk_dir:
+            await blocking.run(self._disk_write_index, entry)
+
+    def _remember(self, entry: CachedMedia):
+        if entry.size > self.max_bytes:
+            return
+        old = self._lru.pop(entry.url, None)
+        if old is not None:
+            self._bytes -= old.size
+        self._lru[entry.url] = entry
+        self._bytes += entry.size
+        while self._bytes > self.max_bytes:
+            _, evicted = self._lru.popitem(last=False)
+            self._bytes -= evicted.size
+
+    # disk tier (runs on the blocking executor)
+
+    def _index_path(self, url: str) -> str:
+        return os.path.join(self.disk_dir, "index", hashlib.sha1(url.encode()).hexdigest() + ".json")
+
+    def _blob_path(self, sha256: str) -> str:
+        return os.path.join(self.disk_dir, "blobs", sha256)
+
+    def _disk_get(self, url: str) -> Optional[CachedMedia]:
+        index = self._index_path(url)
+        try:
+            with open(index) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        try:
+            blob = self._blob_path(meta["sha256"])
+            with open(blob, "rb") as f:
+                data = f.read()
+        except (OSError, KeyError):
+            data = None
+        if data is None or hashlib.sha256(data).hexdigest() != meta["sha256"]:
+            # blob pruned or damaged: the index entry is no use either
+            self._remove(index)
+            return None
+        # mtime is the last use, the order _disk_prune evicts in
+        for path in (index, blob):
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return CachedMedia(**meta, data=data)
+
+    def _disk_write_index(self, entry: CachedMedia):
+        meta = asdict(entry)
+        meta.pop("data")
+        path = self._index_path(entry.url)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, path)
+
+    def _disk_put(self, entry: CachedMedia):
+        blob = self._blob_path(entry.sha256)
+        if not os.path.exists(blob):
+            tmp = f"{blob}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(entry.data)
+            os.replace(tmp, blob)
+        self._disk_write_index(entry)
+
+        self._disk_writes += 1
+        if self._disk_writes % 100 == 0:
+            self._disk_prune()
+
+    def _disk_prune(self):
+        # least recently used first; index files left pointing at removed blobs are dropped on their next get
+        cutoff = time.time() - self.disk_max_age_s
+        blobs = []
+        for kind in ("blobs", "index"):
+            for entry in os.scandir(os.path.join(self.disk_dir, kind)):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                if st.st_mtime < cutoff:
+                    self._remove(entry.path)
+                elif kind == "blobs":
+                    blobs.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in blobs)
+        for _, size, path in sorted(blobs):
+            if total <= self.disk_max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+media_cache = MediaCache()
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram, start_http_server
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from worker.executor import blocking
+from worker.media_cache import media_cache
+from worker.spool import inflight
+
+log = logging.getLogger(__name__)
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 = no endpoint
+QUEUE_POLL_S = float(os.getenv("METRICS_QUEUE_POLL_S", "5"))
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+SIZE_BUCKETS = (64 << 10, 256 << 10, 1 << 20, 2 << 20, 4 << 20, 8 << 20, 16 << 20, 32 << 20)
+
+LIMITER_WAIT = Histogram("worker_limiter_wait_seconds", "Time spent in RateLimiter.acquire",
+                         ["model_key"], buckets=LATENCY_BUCKETS)
+HANDLER_LATENCY = Histogram("worker_handler_seconds", "Provider handler latency",
+                            ["model_key"], buckets=LATENCY_BUCKETS)
+RESULT_BYTES = Histogram("worker_result_bytes", "Size of generated results",
+                         ["model_key"], buckets=SIZE_BUCKETS)
+TELEGRAM_UPLOAD = Histogram("worker_telegram_upload_seconds", "Telegram sendDocument duration",
+                            ["model_key"], buckets=LATENCY_BUCKETS)
+OSON_STATUS = Histogram("worker_oson_status_seconds", "Oson backend status call duration",
+                        ["model_key"], buckets=LATENCY_BUCKETS)
+FAILURES = Counter("worker_job_failures_total", "Failed jobs by reason",
+                   ["model_key", "reason"])
+BLOCKING_WAIT = Histogram("worker_blocking_executor_wait_seconds", "Wait for a blocking-executor thread",
+                          buckets=LATENCY_BUCKETS)
+ADAPTIVE_LIMIT = Gauge("worker_adaptive_limit", "Shared AIMD limit after this process's last feedback",
+                       ["model_key", "limit"])
+RESULT_STORE = Counter("worker_result_store_total", "Retries served from the result store",
+                       ["model_key", "outcome"])
+QUEUE_DEPTH = Gauge("worker_arq_queue_depth", "Jobs waiting in the arq queue", ["queue"])
+IMAGE_PREP = Histogram("worker_image_prep_seconds", "Reference image normalization time",
+                       ["model_key"], buckets=LATENCY_BUCKETS)
+IMAGE_BYTES_IN = Counter("worker_image_prep_input_bytes_total", "Reference image bytes sent to normalization",
+                         ["model_key"])
+IMAGE_BYTES_SAVED = Counter("worker_image_prep_saved_bytes_total", "Upload bytes saved by normalization",
+                            ["model_key"])
+KLING_RECONCILE = Counter("worker_kling_reconcile_total", "Kling task checks by the reconciler by outcome",
+                          ["outcome"])
+OUTBOX_EVENTS = Counter("worker_outbox_events_total", "Oson status outbox events by outcome", ["outcome"])
+QUEUE_SKIPPED = Counter("worker_queue_skipped_total", "Multi-queue polls that skipped a queue, by reason",
+                        ["queue", "reason"])
+KEY_PICKS = Counter("worker_api_key_picks_total", "Provider calls by API key of the pool", ["provider", "key_id"])
+KEY_QUARANTINES = Counter("worker_api_key_quarantines_total", "API keys taken out of their pool, by reason",
+                          ["provider", "key_id", "reason"])
+QUEUE_RUNNING = Gauge("worker_queue_running_jobs", "Jobs of each queue running in this process", ["queue"])
+
+
+@contextmanager
+def timed(histogram: Histogram, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(**labels).observe(time.perf_counter() - start)
+
+
+class _LocalStateCollector:
+    """
+    Exposes in-process counters that live elsewhere (executor, media cache,
+    in-flight results, limiter) at scrape time instead of mirroring them on every change.
+    """
+
+    def __init__(self):
+        self.limiter = None
+
+    def collect(self):
+        stats = blocking.stats()
+        g = GaugeMetricFamily("worker_blocking_executor_jobs", "Blocking executor jobs by state", labels=["state"])
+        g.add_metric(["queued"], stats["queued"])
+        g.add_metric(["running"], stats["running"])
+        yield g
+
+        cache = media_cache.stats()
+        c = CounterMetricFamily("worker_media_cache_lookups", "Input media cache lookups by outcome",
+                                labels=["outcome"])
+        for outcome in ("hits", "misses", "revalidated", "stale"):
+            c.add_metric([outcome], cache[outcome])
+        yield c
+        yield GaugeMetricFamily("worker_media_cache_bytes", "Bytes held in the in-memory media cache",
+                                value=cache["bytes"])
+
+        yield GaugeMetricFamily("worker_inflight_result_bytes", "Result bytes held by this process's running jobs",
+                                value=inflight.used)
+        yield GaugeMetricFamily("worker_inflight_result_budget_bytes", "In-flight result bytes before job pickup pauses",
+                                value=inflight.budget)
+
+        if self.limiter is not None:
+            yield GaugeMetricFamily("worker_limiter_waiters", "Jobs of this process waiting in acquire",
+                                    value=len(self.limiter._waiters))
+
+
+_collector = _LocalStateCollector()
+REGISTRY.register(_collector)
+blocking.on_wait = BLOCKING_WAIT.observe
+
+
+class MetricsServer:
+    def __init__(self, redis, limiter, queue_names: list[str], port: int = METRICS_PORT):
+        self.redis = redis
+        self.queue_names = queue_names
+        self.port = port
+        self._server = None
+        self._task = None
+        _collector.limiter = limiter
+
+    async def start(self):
+        if not self.port:
+            return
+        server = start_http_server(self.port)
+        # prometheus_client >= 0.17 returns (server, thread)
+        self._server = server[0] if isinstance(server, tuple) else None
+        if self.queue_names:
+            self._task = asyncio.create_task(self._poll_queue())
+        log.info(f"Metrics on :{self.port}/metrics")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._server is not None:
+            self._server.shutdown()
+
+    async def _poll_queue(self):
+        while True:
+            try:
+                for queue_name in self.queue_names:
+                    QUEUE_DEPTH.labels(queue=queue_name).set(await self.redis.zcard(queue_name))
+            except Exception as e:
+                log.warning(f"Queue depth poll failed: {e}")
+            await asyncio.sleep(QUEUE_POLL_S)
@@ -0,0 +1,216 @@
+"""
+One process consuming several arq queues, e.g.
+
+    ARQ_QUEUES="arq:gemini3;model=gemini_3_image;weight=3;max_jobs=10,arq:kling;model=kling_2_6_video"
+
+Per queue: `model` is the limiter key checked before pulling (defaults to
+the queue name; a name without a policy is never throttled), `weight` its
+share of ARQ_MAX_JOBS when queues compete (default 1) and `max_jobs` a
+hard cap (default: may use all of ARQ_MAX_JOBS when the others are idle).
+`python -m worker` runs this instead of the single-queue worker when
+ARQ_QUEUES is set.
+"""
+import asyncio
+import logging
+import math
+import os
+import signal
+from dataclasses import dataclass
+from typing import Optional
+
+from arq.connections import create_pool
+from arq.utils import poll
+
+from worker.handlers import PROVIDERS
+from worker.keypool import pools
+from worker.metrics import QUEUE_RUNNING, QUEUE_SKIPPED
+from worker.policies import get_policy
+from worker.worker_settings import BudgetedWorker
+
+log = logging.getLogger(__name__)
+
+ARQ_QUEUES = os.getenv("ARQ_QUEUES", "")
+# jobs a queue may still pull for a model whose limiter has this many waiters queued
+MAX_WAITERS = int(os.getenv("QUEUE_MAX_WAITERS", "2"))
+
+
+@dataclass
+class QueueSpec:
+    name: str
+    model_key: str
+    weight: float = 1.0
+    max_jobs: Optional[int] = None
+
+
+def parse_queues(value: str) -> list[QueueSpec]:
+    specs = []
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        name, *options = (part.strip() for part in item.split(";"))
+        spec = QueueSpec(name=name, model_key=name)
+        for option in options:
+            key, _, raw = option.partition("=")
+            if key == "model":
+                spec.model_key = raw
+            elif key == "weight":
+                spec.weight = float(raw)
+            elif key == "max_jobs":
+                spec.max_jobs = int(raw)
+            else:
+                raise ValueError(f"ARQ_QUEUES: unknown option {key!r} for {name}")
+        if spec.weight <= 0:
+            raise ValueError(f"ARQ_QUEUES: weight of {name} must be positive")
+        specs.append(spec)
+    if len({spec.name for spec in specs}) != len(specs):
+        raise ValueError("ARQ_QUEUES: a queue is listed twice")
+    return specs
+
+
+class QueueWorker(BudgetedWorker):
+    """
+    One queue of a MultiQueueWorker: arq's job handling as is, but polled
+    by the coordinator, which sets how many jobs it may pull each round.
+    """
+
+    def __init__(self, spec: QueueSpec, **kwargs):
+        super().__init__(**kwargs)
+        self.spec = spec
+        self.quota = 0
+
+    def may_pick(self) -> bool:
+        return self.quota > 0 and super().may_pick()
+
+    async def _poll_iteration(self) -> None:
+        self.queue_read_limit = max(self.quota, 1)
+        await super()._poll_iteration()
+
+
+class MultiQueueWorker:
+    """
+    Polls its queues in order of running jobs per unit of weight, so under
+    contention each gets its weighted share of `max_jobs`. A queue is only
+    asked for as many jobs as its model's limiter has room for: free
+    concurrency leases plus MAX_WAITERS places in the wait queue, summed
+    over the keys of the provider's pool (worker.keypool). Jobs of a
+    saturated model stay in Redis for a worker (or a later round) that can
+    start them instead of sleeping in RateLimiter.acquire here.
+
+    Startup, shutdown, the Redis pool and ctx are shared by all queues.
+    """
+
+    def __init__(self, specs: list[QueueSpec], *, redis_settings=None, on_startup=None, on_shutdown=None,
+                 max_jobs: int = 10, poll_delay: float = 0.5, burst: bool = False, **kwargs):
+        if not specs:
+            raise ValueError("MultiQueueWorker needs at least one queue")
+        self.redis_settings = redis_settings
+        self.on_startup = on_startup
+        self.on_shutdown = on_shutdown
+        self.max_jobs = max_jobs
+        self.poll_delay_s = poll_delay
+        self.burst = burst
+        self.ctx = {"queues": [spec.name for spec in specs]}
+        self.workers = [
+            QueueWorker(spec, queue_name=spec.name, max_jobs=min(spec.max_jobs or max_jobs, max_jobs),
+                        poll_delay=poll_delay, handle_signals=False, **kwargs)
+            for spec in specs
+        ]
+        for w in self.workers:
+            w.ctx = self.ctx
+        self._pool = None
+        self._paused = set()
+        self.main_task = None
+        self.loop = self.workers[0].loop
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(sig, self.handle_sig, sig)
+
+    def run(self) -> None:
+        self.main_task = self.loop.create_task(self.main())
+        try:
+            self.loop.run_until_complete(self.main_task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.loop.run_until_complete(self.close())
+
+    async def main(self) -> None:
+        self._pool = await create_pool(self.redis_settings)
+        for w in self.workers:
+            w._pool = self._pool
+        self.ctx["redis"] = self._pool
+        log.info("Starting multi-queue worker: " + ", ".join(
+            f"{w.queue_name} (model={w.spec.model_key} weight={w.spec.weight:g} max_jobs={w.max_jobs})"
+            for w in self.workers))
+        if self.on_startup:
+            await self.on_startup(self.ctx)
+
+        async for _ in poll(self.poll_delay_s):
+            await self._poll_iteration()
+            if self.burst and not any(w.tasks for w in self.workers):
+                if not any(await asyncio.gather(*(self._pool.zcard(w.queue_name) for w in self.workers))):
+                    return
+
+    async def _poll_iteration(self) -> None:
+        # least served (running / weight) first, so it gets first pick of the free slots
+        free = self.max_jobs - sum(w.job_counter for w in self.workers)
+        for w in sorted(self.workers, key=lambda w: w.job_counter / w.spec.weight):
+            w.quota = min(free, w.max_jobs - w.job_counter)
+            if w.quota > 0:
+                w.quota = min(w.quota, await self._headroom(w))
+            running = w.job_counter
+            await w._poll_iteration()
+            free -= w.job_counter - running
+            QUEUE_RUNNING.labels(queue=w.queue_name).set(w.job_counter)
+
+    async def _headroom(self, w: QueueWorker) -> int:
+        """Jobs of this queue its model's limiter (every key of its pool) could take now."""
+        model_key = w.spec.model_key
+        policy = get_policy(model_key)
+        if policy is None or not (policy.rpm or policy.concurrency) or "limiter" not in self.ctx:
+            return self.max_jobs
+        pool = pools.get(PROVIDERS.get(model_key))
+        try:
+            ps = await self.ctx["limiter"].pressure_many(pool.limiter_keys(model_key) if pool else [model_key])
+        except Exception as e:
+            log.warning(f"Limiter pressure for {model_key} unavailable, not throttling {w.queue_name}: {e}")
+            return self.max_jobs
+
+        headroom = sum(max(0, self._key_headroom(policy, p)) for p in ps)
+        p = {"leases": sum(p["leases"] for p in ps), "waiters": sum(p["waiters"] for p in ps)}
+        saturated = headroom <= 0
+        if saturated != (w.queue_name in self._paused):
+            if saturated:
+                self._paused.add(w.queue_name)
+                log.info(f"{model_key} saturated ({p['leases']} leases, {p['waiters']} waiting), "
+                         f"skipping {w.queue_name}")
+            else:
+                self._paused.discard(w.queue_name)
+                log.info(f"{model_key} has room again, polling {w.queue_name}")
+        if saturated:
+            QUEUE_SKIPPED.labels(queue=w.queue_name, reason="limiter").inc()
+        return min(headroom, self.max_jobs)
+
+    def _key_headroom(self, policy, p: dict) -> int:
+        headroom = MAX_WAITERS - p["waiters"]
+        if headroom > 0 and policy.concurrency:
+            limit = policy.concurrency
+            if policy.adaptive and p["conc"]:
+                limit = max(1, math.floor(p["conc"]))
+            headroom += max(0, limit - p["leases"])
+        elif headroom > 0:
+            # RPM only: a full window shows up as waiters
+            headroom = self.max_jobs
+        return headroom
+
+    def handle_sig(self, signum) -> None:
+        for w in self.workers:
+            w.handle_sig(signum)
+        self.main_task and self.main_task.cancel()
+
+    async def close(self) -> None:
+        if not self._pool:
+            return
+        await asyncio.gather(*(t for w in self.workers for t in w.tasks.values()))
+        await self._pool.delete(*(w.health_check_key for w in self.workers))
+        if self.on_shutdown:
+            await self.on_shutdown(self.ctx)
+        await self._pool.close(close_connection_pool=True)
+        self._pool = None
@@ -0,0 +1,245 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+
+from worker.metrics import OUTBOX_EVENTS
+
+log = logging.getLogger(__name__)
+
+STREAM_KEY = "oson:outbox"
+GROUP = "oson-outbox"
+DEDUPE_KEY = "oson:sent:"      # per (job_id, status), set when the event is queued
+JOB_KEY = "oson:outbox:job:"   # per job_id: list of its unacked entry ids, oldest first
+
+BATCH = int(os.getenv("OUTBOX_BATCH", "50"))
+BLOCK_MS = int(os.getenv("OUTBOX_BLOCK_MS", "1000"))
+RETRY_BASE_S = float(os.getenv("OUTBOX_RETRY_BASE_S", "1"))
+RETRY_MAX_S = float(os.getenv("OUTBOX_RETRY_MAX_S", "60"))
+MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "50"))
+DEDUPE_TTL_S = int(os.getenv("OUTBOX_DEDUPE_TTL_S", "86400"))
+MAXLEN = int(os.getenv("OUTBOX_MAXLEN", "100000"))
+
+LUA_PUT = r"""
+-- KEYS[1] = stream
+-- KEYS[2] = dedupe key
+-- KEYS[3] = job entries list
+-- ARGV[1] = dedupe ttl_s
+-- ARGV[2] = stream maxlen
+-- ARGV[3] = kind
+-- ARGV[4] = body json
+-- ARGV[5] = job_id
+-- returns the entry id, or false if this (job_id, status) was queued before
+if not redis.call("SET", KEYS[2], 1, "NX", "EX", ARGV[1]) then
+  return false
+end
+local id = redis.call("XADD", KEYS[1], "MAXLEN", "~", ARGV[2], "*", "kind", ARGV[3], "body", ARGV[4], "job", ARGV[5])
+redis.call("RPUSH", KEYS[3], id)
+redis.call("EXPIRE", KEYS[3], ARGV[1])
+return id
+"""
+
+LUA_HEAD = r"""
+-- KEYS[1] = stream
+-- KEYS[2] = job entries list
+-- returns the job's oldest entry still in the stream, or false
+while true do
+  local id = redis.call("LINDEX", KEYS[2], 0)
+  if not id then
+    return false
+  end
+  if #redis.call("XRANGE", KEYS[1], id, id) > 0 then
+    return id
+  end
+  -- trimmed by MAXLEN
+  redis.call("LPOP", KEYS[2])
+end
+"""
+
+LUA_ACK = r"""
+-- KEYS[1] = stream
+-- ARGV[1] = group
+-- ARGV[2] = job entries list prefix
+-- ARGV[3..] = entry ids
+for i = 3, #ARGV do
+  local id = ARGV[i]
+  local entry = redis.call("XRANGE", KEYS[1], id, id)[1]
+  if entry then
+    local f = entry[2]
+    for j = 1, #f, 2 do
+      if f[j] == "job" then
+        redis.call("LREM", ARGV[2] .. f[j + 1], 1, id)
+      end
+    end
+  end
+  redis.call("XACK", KEYS[1], ARGV[1], id)
+  redis.call("XDEL", KEYS[1], id)
+end
+return 1
+"""
+
+
+def _str(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class StatusOutbox:
+    """
+    Status events for the Oson backend go to a Redis stream instead of being
+    posted inline; a background task per worker reads them through a consumer
+    group and sends them in batches. An event is acked only once the backend
+    accepted it. Failed ones stay pending and are retried with exponential
+    backoff by whichever worker is alive, in per-job order: a job's newer
+    events are held back (left pending) while an older one of it is unacked,
+    so a retried PROCESSING never lands after the job's FINISHED.
+    """
+
+    def __init__(self, redis, oson):
+        self.redis = redis
+        self.oson = oson
+        self.consumer = f"{socket.gethostname()}:{os.getpid()}"
+        self._put = redis.register_script(LUA_PUT)
+        self._head = redis.register_script(LUA_HEAD)
+        self._ack_script = redis.register_script(LUA_ACK)
+        self._task = None
+
+    async def put(self, kind: str, body: dict, job_id, status: str) -> bool:
+        """
+        Queue an event; False if the same (job_id, status) was queued before.
+        """
+        entry = await self._put(
+            keys=[STREAM_KEY, f"{DEDUPE_KEY}{job_id}:{status}", f"{JOB_KEY}{job_id}"],
+            args=[DEDUPE_TTL_S, MAXLEN, kind, json.dumps(body), job_id],
+        )
+        OUTBOX_EVENTS.labels(outcome="queued" if entry else "duplicate").inc()
+        return bool(entry)
+
+    async def start(self):
+        try:
+            await self.redis.xgroup_create(STREAM_KEY, GROUP, id="0", mkstream=True)
+        except Exception as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self, drain_s: float = 5.0):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # best effort: whatever is left stays in the stream for the other workers
+        try:
+            await asyncio.wait_for(self._flush_new(block_ms=None), drain_s)
+        except Exception as e:
+            log.warning(f"Outbox drain on shutdown incomplete: {e}")
+
+    async def _loop(self):
+        while True:
+            try:
+                await self._retry_pending()
+                await self._flush_new(block_ms=BLOCK_MS)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Outbox flush failed")
+                await asyncio.sleep(1)
+
+    async def _flush_new(self, block_ms):
+        res = await self.redis.xreadgroup(GROUP, self.consumer, {STREAM_KEY: ">"}, count=BATCH, block=block_ms)
+        for _, entries in res or []:
+            await self._send(entries)
+
+    async def _retry_pending(self):
+        pending = await self.redis.xpending_range(STREAM_KEY, GROUP, min="-", max="+", count=BATCH,
+                                                  idle=int(RETRY_BASE_S * 1000))
+        due, give_up = [], []
+        for p in pending:
+            attempts = p["times_delivered"]
+            backoff = min(RETRY_MAX_S, RETRY_BASE_S * 2 ** (attempts - 1))
+            if attempts >= MAX_ATTEMPTS:
+                give_up.append(_str(p["message_id"]))
+            elif p["time_since_delivered"] >= backoff * 1000:
+                due.append(p["message_id"])
+        if give_up:
+            log.error(f"Outbox dropping {len(give_up)} events after {MAX_ATTEMPTS} attempts: {give_up}")
+            OUTBOX_EVENTS.labels(outcome="dropped").inc(len(give_up))
+            await self._ack(give_up)
+        if not due:
+            return
+        # claiming resets the idle time and counts the attempt
+        entries = await self.redis.xclaim(STREAM_KEY, GROUP, self.consumer, min_idle_time=int(RETRY_BASE_S * 1000),
+                                          message_ids=due)
+        entries = [e for e in entries if e[1]]  # trimmed by MAXLEN meanwhile
+        if entries:
+            OUTBOX_EVENTS.labels(outcome="retried").inc(len(entries))
+            await self._send(entries)
+
+    async def _send(self, entries):
+        by_job: dict[str, list] = {}
+        for entry_id, fields in entries:
+            fields = {_str(k): _str(v) for k, v in fields.items()}
+            body = json.loads(fields["body"])
+            # entries queued before "job" was stored are grouped by their body
+            job = fields.get("job") or str(body.get("job_id", body.get("task_id")))
+            by_job.setdefault(job, []).append((_str(entry_id), fields["kind"], body))
+        by_job = await self._ready(by_job)
+        events = [event for evs in by_job.values() for event in evs]
+        if not events:
+            return
+
+        if self.oson.bulk_path:
+            try:
+                await self.oson.post_bulk([{"kind": kind, **body} for _, kind, body in events])
+                sent = [entry_id for entry_id, _, _ in events]
+            except Exception as e:
+                log.warning(f"Outbox bulk send of {len(events)} events failed: {e}")
+                sent = []
+        else:
+            # one job's events in order, jobs in parallel
+            sent = [entry_id for ids in await asyncio.gather(*(self._send_job(evs) for evs in by_job.values()))
+                    for entry_id in ids]
+
+        if sent:
+            await self._ack(sent)
+        OUTBOX_EVENTS.labels(outcome="sent").inc(len(sent))
+        if len(sent) < len(events):
+            OUTBOX_EVENTS.labels(outcome="failed").inc(len(events) - len(sent))
+
+    async def _send_job(self, events) -> list[str]:
+        sent = []
+        for entry_id, kind, body in events:
+            try:
+                await self.oson.post_event(kind, body)
+            except Exception as e:
+                # stays pending; later events of this job wait behind it
+                log.warning(f"Outbox send failed, will retry: {kind} {body.get('job_id')}: {e}")
+                break
+            sent.append(entry_id)
+        return sent
+
+    async def _ready(self, by_job: dict[str, list]) -> dict[str, list]:
+        """
+        The jobs whose oldest unacked event is in this batch. The others wait,
+        pending, for the older event (retried by this or another worker).
+        """
+        heads = await asyncio.gather(*(self._head(keys=[STREAM_KEY, f"{JOB_KEY}{job}"]) for job in by_job))
+        ready = {}
+        for (job, events), head in zip(by_job.items(), heads):
+            if head is None or _str(head) == events[0][0]:
+                ready[job] = events
+        held = sum(len(events) for job, events in by_job.items() if job not in ready)
+        if held:
+            OUTBOX_EVENTS.labels(outcome="held").inc(held)
+        return ready
+
+    async def _ack(self, entry_ids: list[str]):
+        await self._ack_script(keys=[STREAM_KEY], args=[GROUP, JOB_KEY, *entry_ids])
+
+    async def pending(self) -> int:
+        info = await self.redis.xpending(STREAM_KEY, GROUP)
+        return int(info["pending"]) if info else 0
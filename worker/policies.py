@@ -1,18 +1,84 @@
-from dataclasses import dataclass
-from typing import Optional
+import argparse
+import asyncio
+import json
+import logging
+import os
+from dataclasses import asdict, dataclass, fields, replace
+from typing import Optional, get_args
+
+from redis.exceptions import WatchError
+
+from worker.limiter import RPM_KEYS
+
+log = logging.getLogger(__name__)
+
+# gemini3 payload["quality"] -> output edge in px
+QUALITY_EDGES = {"1K": 1024, "2K": 2048, "4K": 4096}
 
 
 @dataclass(frozen=True)
 class ModelPolicy:
-    rpm: Optional[int] = None,
+    rpm: Optional[int] = None
     window_s: int = 60
     concurrency: Optional[int] = None
     timeout_s: int = 600
+    # "zset" (exact, one entry per request), "gcra" or "sliding" (O(1) state)
+    rpm_algorithm: str = "zset"
+    # gcra only: requests allowed back to back, default 1 (evenly spaced). A burst of
+    # b lets up to rpm + b - 1 through in one window; gcra prefetch takes at most b
+    rpm_burst: Optional[int] = None
+    # RPM tokens a worker may take ahead into its local bucket (0 = strictly global)
+    rpm_prefetch: int = 0
+    # slots one user may hold at once (needs concurrency)
+    user_concurrency: Optional[int] = None
+
+    # adaptive (AIMD): `rpm`/`concurrency` above are starting points, moved
+    # within [min, max] by provider feedback and shared by all workers. Off in
+    # the code defaults; enable per model with `python -m worker.policies set`.
+    # max_* default to the static limits, so only raise them if the quota allows
+    adaptive: bool = False
+    min_concurrency: int = 1
+    max_concurrency: Optional[int] = None  # defaults to concurrency
+    min_rpm: int = 1
+    max_rpm: Optional[int] = None  # defaults to rpm
+    # slots added per round of successes / rpm added per window of successes (default max_rpm / 20)
+    concurrency_step: float = 1.0
+    rpm_step: Optional[float] = None
+    # on 429/quota errors or a success slower than latency_slo_s
+    decrease: float = 0.5
+    latency_slo_s: Optional[float] = None
+    cooldown_s: Optional[float] = None  # between two decreases, defaults to window_s
+
+    # reference images: downscaled to this longest edge, stripped and re-encoded
+    # before upload (see worker.imaging); None sends them as downloaded
+    input_max_edge: Optional[int] = None
+    # size the edge to payload["quality"] (QUALITY_EDGES) instead, capped by input_max_edge
+    input_edge_from_quality: bool = False
+    input_quality: int = 85  # JPEG/WebP quality
 
+    def concurrency_bounds(self) -> Optional[tuple[int, int, int]]:
+        if not self.concurrency:
+            return None
+        return self.concurrency, self.min_concurrency, self.max_concurrency or self.concurrency
 
+    def rpm_bounds(self) -> Optional[tuple[int, int, int]]:
+        if not self.rpm:
+            return None
+        return self.rpm, self.min_rpm, self.max_rpm or self.rpm
+
+    def input_edge(self, payload: dict) -> Optional[int]:
+        edge = QUALITY_EDGES.get(payload.get("quality")) if self.input_edge_from_quality else None
+        if edge and self.input_max_edge:
+            return min(edge, self.input_max_edge)
+        return edge or self.input_max_edge
+
+
+# code defaults; PolicyStore overlays the overrides kept in Redis
 POLICIES: dict[str, ModelPolicy] = {
-    "gemini_2_5_image": ModelPolicy(rpm=500, concurrency=50),
-    "gemini_3_image": ModelPolicy(rpm=20, concurrency=4),
+    "gemini_2_5_image": ModelPolicy(rpm=500, concurrency=50, rpm_algorithm="sliding", rpm_prefetch=10,
+                                    user_concurrency=10, input_max_edge=1536),
+    "gemini_3_image": ModelPolicy(rpm=20, concurrency=4, user_concurrency=2,
+                                  input_max_edge=4096, input_edge_from_quality=True),
     "kling_2_6_video": ModelPolicy(concurrency=3),
     'kieapi': ModelPolicy(concurrency=10, rpm=20, window_s=20),
 
@@ -26,3 +92,230 @@ POLICIES: dict[str, ModelPolicy] = {
     # # если реально без лимитов (не советую)
     # "unlimited": ModelPolicy(),
 }
+
+# payload["lane"] -> share of the fair queue (a weight-4 lane is served 4x as often)
+LANE_WEIGHTS: dict[str, float] = {
+    "free": 1.0,
+    "paid": 4.0,
+}
+DEFAULT_LANE = "free"
+
+
+POLICY_KEY = "policies"             # hash: model_key -> json of fields overriding the code default
+POLICY_CHANNEL = "policies:changed"
+# full reload even without a message, in case one was missed while reconnecting
+RESYNC_S = float(os.getenv("POLICY_RESYNC_S", "30"))
+
+# field -> accepted value types (None aside)
+FIELD_TYPES = {f.name: tuple(t for t in (get_args(f.type) or (f.type,)) if t is not type(None))
+               for f in fields(ModelPolicy)}
+
+
+# numeric fields that may be 0; every other number must be positive
+NON_NEGATIVE = {"rpm_prefetch"}
+
+
+def check(policy: ModelPolicy):
+    """Values the limiter can't work with (its Lua divides by window_s, rpm, ...)."""
+    if policy.rpm_algorithm not in RPM_KEYS:
+        raise ValueError(f"rpm_algorithm={policy.rpm_algorithm!r}: expected one of {', '.join(RPM_KEYS)}")
+    for name, value in asdict(policy).items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        if value < 0 or value == 0 and name not in NON_NEGATIVE:
+            raise ValueError(f"{name}={value!r}: must be {'>= 0' if name in NON_NEGATIVE else 'positive'}")
+    if policy.decrease >= 1:
+        raise ValueError(f"decrease={policy.decrease!r}: must be below 1")
+    if policy.input_quality > 100:
+        raise ValueError(f"input_quality={policy.input_quality!r}: must be at most 100")
+    if policy.max_concurrency and policy.max_concurrency < policy.min_concurrency:
+        raise ValueError("max_concurrency is below min_concurrency")
+    if policy.max_rpm and policy.max_rpm < policy.min_rpm:
+        raise ValueError("max_rpm is below min_rpm")
+
+
+def build(model_key: str, overrides: dict) -> ModelPolicy:
+    for name, value in overrides.items():
+        if name not in FIELD_TYPES:
+            raise ValueError(f"unknown policy field: {name}")
+        types = FIELD_TYPES[name] + ((int,) if float in FIELD_TYPES[name] else ())
+        if isinstance(value, bool) and bool not in types or not isinstance(value, types):
+            raise ValueError(f"{name}={value!r}: expected {' or '.join(t.__name__ for t in FIELD_TYPES[name])}")
+    policy = replace(POLICIES.get(model_key, ModelPolicy()), **overrides)
+    check(policy)
+    return policy
+
+
+class PolicyStore:
+    """
+    Per-process view of the policies: code defaults with the Redis
+    overrides on top. Reads are served from memory; the whole table is
+    reloaded when someone publishes on POLICY_CHANNEL (and every RESYNC_S).
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.policies: dict[str, ModelPolicy] = dict(POLICIES)
+        self.overrides: dict[str, dict] = {}
+        self._task = None
+
+    async def start(self):
+        global _store
+        await self.reload()
+        _store = self
+        if self._task is None:
+            self._task = asyncio.create_task(self._listen())
+
+    async def close(self):
+        global _store
+        if _store is self:
+            _store = None
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def reload(self):
+        raw = await self.redis.hgetall(POLICY_KEY)
+        policies, overrides = dict(POLICIES), {}
+        for model_key, value in raw.items():
+            model_key = model_key.decode() if isinstance(model_key, bytes) else model_key
+            try:
+                override = json.loads(value)
+                policies[model_key] = build(model_key, override)
+            except Exception as e:
+                # keep what the workers ran with so far rather than falling back to the code default
+                log.error(f"Ignoring bad policy override for {model_key}, keeping the last good one: {e}")
+                if model_key in self.overrides:
+                    policies[model_key] = self.policies[model_key]
+                    overrides[model_key] = self.overrides[model_key]
+                continue
+            overrides[model_key] = override
+        if overrides != self.overrides:
+            log.info(f"Policy overrides now: {overrides}")
+        # swapped in one step, readers never see a half-built table
+        self.policies, self.overrides = policies, overrides
+
+    async def _listen(self):
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(POLICY_CHANNEL)
+                while True:
+                    await self.reload()
+                    await pubsub.get_message(ignore_subscribe_messages=True, timeout=RESYNC_S)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # the last loaded table stays in use
+                log.warning(f"Policy listener error: {e}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+
+_store: Optional[PolicyStore] = None
+
+
+def get_policy(model_key: str) -> Optional[ModelPolicy]:
+    """The live policy (code default until a PolicyStore is started)."""
+    if _store is not None:
+        return _store.policies.get(model_key)
+    return POLICIES.get(model_key)
+
+
+async def set_policy(redis, model_key: str, **overrides):
+    """
+    Merge `overrides` into the stored ones and tell every worker; a None
+    value drops that override. Optimistic (WATCH): an edit racing with
+    another one is redone on top of it instead of overwriting it.
+    """
+    async with redis.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                await pipe.watch(POLICY_KEY)
+                raw = await pipe.hget(POLICY_KEY, model_key)
+                merged = {**(json.loads(raw) if raw else {}), **overrides}
+                merged = {k: v for k, v in merged.items() if v is not None}
+                build(model_key, merged)
+                pipe.multi()
+                if merged:
+                    pipe.hset(POLICY_KEY, model_key, json.dumps(merged))
+                else:
+                    pipe.hdel(POLICY_KEY, model_key)
+                pipe.publish(POLICY_CHANNEL, model_key)
+                await pipe.execute()
+                return merged
+            except WatchError:
+                continue
+
+
+async def reset_policy(redis, model_key: str):
+    await redis.hdel(POLICY_KEY, model_key)
+    await redis.publish(POLICY_CHANNEL, model_key)
+
+
+def _value(text: str):
+    # rpm=40, adaptive=true, latency_slo_s=120, max_rpm=null, rpm_algorithm=gcra
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+async def _cli(args):
+    from redis.asyncio import Redis
+
+    redis = Redis(host=os.getenv("REDIS_HOST", "localhost"), port=int(os.getenv("REDIS_PORT", "6379")),
+                  db=int(os.getenv("REDIS_DB", "0")), password=os.getenv("REDIS_PASSWORD"))
+    try:
+        if args.cmd == "set":
+            if any("=" not in item for item in args.fields):
+                raise ValueError("fields are given as field=value")
+            pairs = dict(item.split("=", 1) for item in args.fields)
+            merged = await set_policy(redis, args.model_key, **{k: _value(v) for k, v in pairs.items()})
+            print(f"{args.model_key}: {json.dumps(merged)}")
+        elif args.cmd == "reset":
+            await reset_policy(redis, args.model_key)
+            print(f"{args.model_key}: back to code default")
+        else:
+            store = PolicyStore(redis)
+            await store.reload()
+            model_key = getattr(args, "model_key", None)
+            keys = [model_key] if model_key else sorted(store.policies)
+            for model_key in keys:
+                policy = store.policies.get(model_key)
+                if policy is None:
+                    print(f"{model_key}: no such policy")
+                    continue
+                override = store.overrides.get(model_key)
+                print(f"{model_key}{' (overridden: ' + json.dumps(override) + ')' if override else ''}")
+                for name, value in asdict(policy).items():
+                    print(f"  {name}{'*' if override and name in override else ' '} = {value}")
+    finally:
+        await redis.aclose()
+
+
+def main():
+    p = argparse.ArgumentParser(prog="python -m worker.policies",
+                                description="View or change model policies for every worker at once")
+    sub = p.add_subparsers(dest="cmd")
+    show = sub.add_parser("show", help="live policies, * marks overridden fields")
+    show.add_argument("model_key", nargs="?")
+    set_ = sub.add_parser("set", help="override fields, e.g. rpm=40 concurrency=6 (field=null drops one)")
+    set_.add_argument("model_key")
+    set_.add_argument("fields", nargs="+", metavar="field=value")
+    reset = sub.add_parser("reset", help="drop all overrides of a model")
+    reset.add_argument("model_key")
+    args = p.parse_args()
+    try:
+        asyncio.run(_cli(args))
+    except ValueError as e:
+        p.error(str(e))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+
+from worker.executor import blocking
+from worker.media_cache import content_hash
+from worker.spool import CHUNK, SPILL_BYTES, SpooledFile, result_size, spool_path
+
+log = logging.getLogger(__name__)
+
+RESULT_KEY = "result:"          # hash per job_id: meta json + one field per finished step
+BLOB_KEY = "result:blob:"       # redis blob store only
+RESULT_TTL_S = int(os.getenv("RESULT_TTL_S", str(6 * 3600)))
+# where result bytes live: "disk" (this host), "memory" (this process) or "redis" (shared by all
+# workers, but every result sits in Redis memory until delivered: only for small deployments)
+BLOB_STORE = os.getenv("RESULT_BLOB_STORE", "disk")
+RESULTS_DIR = os.getenv("RESULTS_DIR", os.path.join(tempfile.gettempdir(), "oson-results"))
+MEMORY_MAX_BYTES = int(os.getenv("RESULT_MEMORY_MAX_BYTES", str(256 * 1024 * 1024)))
+
+
+@dataclass
+class StoredResult:
+    job_id: str
+    ok: bool
+    created_at: float
+    mime: Optional[str] = None
+    size: int = 0
+    sha256: Optional[str] = None
+    task_id: Optional[str] = None
+    # delivery steps already done: "uploaded", "delivered"
+    steps: set[str] = field(default_factory=set)
+
+    def meta(self) -> str:
+        return json.dumps({"ok": self.ok, "created_at": self.created_at, "mime": self.mime, "size": self.size,
+                           "sha256": self.sha256, "task_id": self.task_id})
+
+
+class ResultStore:
+    """
+    Provider output keyed by job_id, so an arq retry after a delivery
+    failure re-delivers instead of generating again, and a retry of a
+    delivered job does nothing. Metadata and step markers live in Redis;
+    the bytes in the configured blob store. Everything expires after
+    RESULT_TTL_S.
+    """
+
+    def __init__(self, redis, blob_store: str = BLOB_STORE, ttl_s: int = RESULT_TTL_S,
+                 disk_dir: str = RESULTS_DIR, memory_max_bytes: int = MEMORY_MAX_BYTES):
+        self.redis = redis
+        self.blob_store = blob_store
+        self.ttl_s = ttl_s
+        self.disk_dir = disk_dir
+        self.memory_max_bytes = memory_max_bytes
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_writes = 0
+        if blob_store == "disk":
+            os.makedirs(disk_dir, exist_ok=True)
+
+    async def get(self, job_id) -> Optional[StoredResult]:
+        state = await self.redis.hgetall(f"{RESULT_KEY}{job_id}")
+        if not state:
+            return None
+        state = {(k.decode() if isinstance(k, bytes) else k): v for k, v in state.items()}
+        steps = {name for name in ("uploaded", "delivered") if name in state}
+        if "meta" not in state:
+            # delivered jobs keep only their markers
+            return StoredResult(job_id=str(job_id), ok=True, created_at=0.0, steps=steps)
+        return StoredResult(job_id=str(job_id), steps=steps, **json.loads(state["meta"]))
+
+    async def load(self, stored: StoredResult) -> Optional[dict]:
+        """
+        The handler result for a stored entry, or None if its bytes are gone
+        (expired, evicted, or kept by another worker's or host's store).
+        """
+        if stored.task_id:
+            return {"ok": True, "task_id": stored.task_id}
+        if not stored.sha256:
+            return None
+        data = await self._get_blob(stored)
+        if isinstance(data, SpooledFile):
+            if await blocking.run(data.sha256) == stored.sha256:
+                return {"ok": True, "file": data, "mime": stored.mime}
+            await blocking.run(data.discard)
+        elif data is not None and content_hash(data) == stored.sha256:
+            return {"ok": True, "bytes": data, "mime": stored.mime}
+        reason = "missing" if data is None else "corrupt"
+        if "uploaded" in stored.steps:
+            # the user has the document already: only the notice and the status are left to send
+            log.warning(f"Result blob of job {stored.job_id} is {reason} in the {self.blob_store} store, "
+                        f"already uploaded, finishing without it")
+            return {"ok": True, "bytes": b"", "mime": stored.mime}
+        log.warning(f"Result blob of job {stored.job_id} is {reason} in the {self.blob_store} store, "
+                    f"generating again")
+        return None
+
+    async def save(self, job_id, result: dict):
+        stored = StoredResult(job_id=str(job_id), ok=True, created_at=time.time(), task_id=result.get("task_id"))
+        # bytes, or a SpooledFile for results spilled to disk
+        data = result.get("bytes") or result.get("file")
+        if data:
+            stored.mime = result.get("mime")
+            stored.size = result_size(result)
+            if isinstance(data, SpooledFile):
+                stored.sha256 = await blocking.run(data.sha256)
+            else:
+                stored.sha256 = content_hash(data)
+            await self._put_blob(stored, data)
+        key = f"{RESULT_KEY}{job_id}"
+        await self.redis.hset(key, "meta", stored.meta())
+        await self.redis.expire(key, self.ttl_s)
+
+    async def mark(self, job_id, step: str):
+        key = f"{RESULT_KEY}{job_id}"
+        await self.redis.hset(key, step, time.time())
+        await self.redis.expire(key, self.ttl_s)
+        if step == "delivered":
+            # nothing left to re-deliver: keep the marker, drop the payload
+            await self.redis.hdel(key, "meta")
+            await self._drop_blob(str(job_id))
+
+    # blob stores
+
+    async def _put_blob(self, stored: StoredResult, data: bytes | SpooledFile):
+        if self.blob_store == "redis":
+            if isinstance(data, SpooledFile):
+                await self._redis_put_file(stored.job_id, data)
+            else:
+                await self.redis.set(f"{BLOB_KEY}{stored.job_id}", data, ex=self.ttl_s)
+        elif self.blob_store == "disk":
+            await blocking.run(self._disk_put, stored.job_id, data)
+        elif isinstance(data, SpooledFile):
+            # spilled to keep it out of memory: a retry generates it again
+            log.info(f"Result of job {stored.job_id} is spilled to disk, not kept in the memory store")
+        else:
+            self._memory[stored.job_id] = data
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.memory_max_bytes and self._memory:
+                _, old = self._memory.popitem(last=False)
+                self._memory_bytes -= len(old)
+
+    async def _redis_put_file(self, job_id: str, spooled: SpooledFile):
+        """Appended chunk by chunk, so a spilled result is never read into memory whole."""
+        key = f"{BLOB_KEY}{job_id}"
+        tmp = f"{key}:{os.getpid()}:tmp"
+        await self.redis.delete(tmp)
+        f = await blocking.run(spooled.open)
+        try:
+            while chunk := await blocking.run(f.read, CHUNK):
+                await self.redis.pipeline(transaction=False).append(tmp, chunk).expire(tmp, self.ttl_s).execute()
+        finally:
+            await blocking.run(f.close)
+        await self.redis.pipeline(transaction=True).rename(tmp, key).expire(key, self.ttl_s).execute()
+
+    async def _get_blob(self, stored: StoredResult) -> Optional[bytes | SpooledFile]:
+        # results that were spilled come back as a SpooledFile, copied in chunks
+        spilled = stored.size > SPILL_BYTES
+        if self.blob_store == "redis":
+            if spilled:
+                return await self._redis_get_file(stored)
+            return await self.redis.get(f"{BLOB_KEY}{stored.job_id}")
+        if self.blob_store == "disk":
+            return await blocking.run(self._disk_get_file if spilled else self._disk_get, stored.job_id)
+        return self._memory.get(stored.job_id)
+
+    async def _redis_get_file(self, stored: StoredResult) -> Optional[SpooledFile]:
+        """Read back chunk by chunk with GETRANGE, the way _redis_put_file writes it."""
+        key = f"{BLOB_KEY}{stored.job_id}"
+        if not await self.redis.exists(key):
+            return None
+        spooled = SpooledFile(await blocking.run(spool_path), 0)
+        f = await blocking.run(open, spooled.path, "wb")
+        try:
+            while chunk := await self.redis.getrange(key, spooled.size, spooled.size + CHUNK - 1):
+                await blocking.run(f.write, chunk)
+                spooled.size += len(chunk)
+        finally:
+            await blocking.run(f.close)
+        if spooled.size != stored.size:
+            # expired or replaced while we read it
+            await blocking.run(spooled.discard)
+            return None
+        return spooled
+
+    async def _drop_blob(self, job_id: str):
+        if self.blob_store == "redis":
+            await self.redis.delete(f"{BLOB_KEY}{job_id}")
+        elif self.blob_store == "disk":
+            await blocking.run(self._disk_drop, job_id)
+        else:
+            data = self._memory.pop(job_id, None)
+            if data is not None:
+                self._memory_bytes -= len(data)
+
+    # disk store (runs on the blocking executor)
+
+    def _disk_path(self, job_id: str) -> str:
+        return os.path.join(self.disk_dir, f"{job_id}.bin")
+
+    def _disk_put(self, job_id: str, data: bytes | SpooledFile):
+        path = self._disk_path(job_id)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        if isinstance(data, SpooledFile):
+            shutil.copyfile(data.path, tmp)
+        else:
+            with open(tmp, "wb") as f:
+                f.write(data)
+        os.replace(tmp, path)
+        self._disk_writes += 1
+        if self._disk_writes % 100 == 0:
+            self._disk_prune()
+
+    def _disk_get(self, job_id: str) -> Optional[bytes]:
+        try:
+            with open(self._disk_path(job_id), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _disk_get_file(self, job_id: str) -> Optional[SpooledFile]:
+        # a copy: the job discards it after delivery, the stored blob stays for a retry
+        path = spool_path()
+        try:
+            shutil.copyfile(self._disk_path(job_id), path)
+        except FileNotFoundError:
+            os.remove(path)
+            return None
+        return SpooledFile(path, os.path.getsize(path))
+
+    def _disk_drop(self, job_id: str):
+        try:
+            os.remove(self._disk_path(job_id))
+        except FileNotFoundError:
+            pass
+
+    def _disk_prune(self):
+        cutoff = time.time() - self.ttl_s
+        for entry in os.scandir(self.disk_dir):
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+from typing import Awaitable, Callable
+
+import httpx
+
+from worker.handlers import runway
+
+log = logging.getLogger(__name__)
+
+TASKS_KEY = "runway:tasks"     # hash: task_id -> job_data json
+DUE_KEY = "runway:due"         # zset: task_id -> next poll at
+OWNER_KEY = "runway:owner:"    # string per task: worker that polls it
+
+TICK_S = float(os.getenv("RUNWAY_POLL_TICK_S", "1"))
+FIRST_POLL_S = float(os.getenv("RUNWAY_FIRST_POLL_S", "10"))
+MIN_INTERVAL_S = float(os.getenv("RUNWAY_MIN_INTERVAL_S", "5"))
+MAX_INTERVAL_S = float(os.getenv("RUNWAY_MAX_INTERVAL_S", "30"))
+BATCH = int(os.getenv("RUNWAY_POLL_BATCH", "50"))
+MAX_HTTP_ERRORS = 3
+OWNER_TTL_MS = int(MAX_INTERVAL_S * 3 * 1000)
+
+LUA_CLAIM = r"""
+-- KEYS[1] = owner key
+-- ARGV[1] = worker id
+-- ARGV[2] = ttl ms
+local owner = redis.call("GET", KEYS[1])
+if owner and owner ~= ARGV[1] then
+  return 0
+end
+redis.call("SET", KEYS[1], ARGV[1], "PX", ARGV[2])
+return 1
+"""
+
+Callback = Callable[..., Awaitable[None]]
+
+
+def next_interval(job_data: dict, progressed: bool) -> float:
+    """
+    Poll young or moving tasks often, back off on old or stalled ones.
+    """
+    age = time.time() - job_data["started_at"]
+    interval = max(MIN_INTERVAL_S, age / 20)
+    if not progressed:
+        interval = max(interval, job_data.get("interval", MIN_INTERVAL_S) * 1.5)
+    return min(interval, MAX_INTERVAL_S)
+
+
+class RunwayPoller:
+    """
+    One loop per worker polls every in-flight Runway task tracked in Redis.
+    Each task is owned by a single worker (sticky claim that expires if the
+    owner dies). Only completion, failure and changed progress are dispatched.
+    """
+
+    def __init__(self, redis, on_progress: Callback, on_success: Callback, on_failure: Callback):
+        self.redis = redis
+        self.on_progress = on_progress
+        self.on_success = on_success
+        self.on_failure = on_failure
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._claim = redis.register_script(LUA_CLAIM)
+        self._task = None
+
+    async def track(self, job_data: dict):
+        task_id = job_data["task_id"]
+        await self.redis.hset(TASKS_KEY, task_id, json.dumps(job_data))
+        await self.redis.zadd(DUE_KEY, {task_id: time.time() + FIRST_POLL_S}, nx=True)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self._tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Runway poller tick failed")
+            await asyncio.sleep(TICK_S)
+
+    async def _tick(self):
+        due = await self.redis.zrangebyscore(DUE_KEY, 0, time.time(), start=0, num=BATCH)
+        mine = []
+        for task_id in due:
+            if isinstance(task_id, bytes):
+                task_id = task_id.decode()
+            if int(await self._claim(keys=[OWNER_KEY + task_id], args=[self.worker_id, OWNER_TTL_MS])):
+                mine.append(task_id)
+        await asyncio.gather(*(self._poll(task_id) for task_id in mine))
+
+    async def _finish(self, task_id: str):
+        await self.redis.zrem(DUE_KEY, task_id)
+        await self.redis.hdel(TASKS_KEY, task_id)
+        await self.redis.delete(OWNER_KEY + task_id)
+
+    async def _poll(self, task_id: str):
+        raw = await self.redis.hget(TASKS_KEY, task_id)
+        if raw is None:
+            await self._finish(task_id)
+            return
+        job_data = json.loads(raw)
+
+        try:
+            r = await asyncio.wait_for(runway.get_task(job_data), timeout=30)
+        except (httpx.HTTPError, asyncio.TimeoutError) as e:
+            job_data["errors"] = job_data.get("errors", 0) + 1
+            if job_data["errors"] < MAX_HTTP_ERRORS:
+                log.warning(f"Runway poll failed, will retry: {task_id}: {e}")
+                await self._reschedule(task_id, job_data, progressed=False)
+                return
+            r = {"ok": False, "error": str(e)}
+        except Exception as e:
+            logging.error(e)
+            r = {"ok": False, "error": str(e)}
+
+        if r.get("ok") and r.get("status") != "SUCCEEDED":
+            progress = r.get("progress") or 0
+            progressed = progress != job_data.get("progress")
+            job_data["errors"] = 0
+            if progressed:
+                job_data["progress"] = progress
+                try:
+                    await self.on_progress(job_data, progress)
+                except Exception as e:
+                    logging.error(e)
+            await self._reschedule(task_id, job_data, progressed)
+            return
+
+        try:
+            if r.get("ok"):
+                await self.on_success(job_data, r.get("result_url"))
+            else:
+                await self.on_failure(job_data, r.get("error"))
+        except Exception:
+            log.exception(f"Runway event dispatch failed: {task_id}")
+        await self._finish(task_id)
+
+    async def _reschedule(self, task_id: str, job_data: dict, progressed: bool):
+        job_data["interval"] = next_interval(job_data, progressed)
+        await self.redis.hset(TASKS_KEY, task_id, json.dumps(job_data))
+        await self.redis.zadd(DUE_KEY, {task_id: time.time() + job_data["interval"]})
@@ -0,0 +1,122 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+from worker.executor import blocking
+
+log = logging.getLogger(__name__)
+
+# results larger than this are written to disk and uploaded from the file
+SPILL_BYTES = int(os.getenv("RESULT_SPILL_BYTES", str(2 * 1024 * 1024)))
+SPOOL_DIR = os.getenv("SPOOL_DIR", os.path.join(tempfile.gettempdir(), "oson-spool"))
+# result bytes held by running jobs of this process before it stops taking new ones; 0 disables
+INFLIGHT_BUDGET_BYTES = int(os.getenv("INFLIGHT_BUDGET_BYTES", str(512 * 1024 * 1024)))
+
+CHUNK = 1024 * 1024
+
+
+class SpooledFile:
+    """A result written to SPOOL_DIR; owned by the job that spilled it."""
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+
+    def open(self):
+        return open(self.path, "rb")
+
+    def read(self) -> bytes:
+        with self.open() as f:
+            return f.read()
+
+    def sha256(self) -> str:
+        h = hashlib.sha256()
+        with self.open() as f:
+            while chunk := f.read(CHUNK):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _write(data: bytes) -> SpooledFile:
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=SPOOL_DIR, suffix=".bin")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    return SpooledFile(path, len(data))
+
+
+def spool_path() -> str:
+    """A new empty file in SPOOL_DIR, for results filled in chunks (see worker.results)."""
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=SPOOL_DIR, suffix=".bin")
+    os.close(fd)
+    return path
+
+
+async def spill(result: dict) -> dict:
+    """
+    Move result["bytes"] above SPILL_BYTES to a file (result["file"]), so
+    the job stops holding it in memory until the upload.
+    """
+    data = result.get("bytes")
+    if not data or len(data) <= SPILL_BYTES:
+        return result
+    spooled = await blocking.run(_write, data)
+    result = {**result, "file": spooled}
+    del result["bytes"]
+    return result
+
+
+def result_size(result: dict | None) -> int:
+    if not result:
+        return 0
+    if result.get("file") is not None:
+        return result["file"].size
+    return len(result.get("bytes") or b"")
+
+
+def memory_size(result: dict | None) -> int:
+    """Bytes of the result held in memory: 0 once it is spilled."""
+    return len(result.get("bytes") or b"") if result else 0
+
+
+async def discard(result: dict | None):
+    if result and result.get("file") is not None:
+        await blocking.run(result["file"].discard)
+
+
+class InflightBytes:
+    """
+    Result bytes held in memory by this process's running jobs, from the
+    provider's answer until the job ends (spilled results don't count). BudgetedWorker stops pulling jobs while the
+    total is over budget.
+    """
+
+    def __init__(self, budget: int = INFLIGHT_BUDGET_BYTES):
+        self.budget = budget
+        self.used = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def add(self, n: int):
+        with self._lock:
+            self.used += n
+            self.peak = max(self.peak, self.used)
+
+    def sub(self, n: int):
+        with self._lock:
+            self.used -= n
+
+    def over(self) -> bool:
+        return bool(self.budget) and self.used > self.budget
+
+
+inflight = InflightBytes()
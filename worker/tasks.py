@@ -1,23 +1,35 @@
-import os
 import asyncio
 import logging
+import os
 import time
 import traceback
 
-from worker.policies import POLICIES
-from worker.limiter import RateLimiter
+import httpx
+from arq.worker import Retry
+
+from worker import config
+from worker.delivery import Delivery
+from worker.limiter import BudgetTimeout
+from worker.metrics import (ADAPTIVE_LIMIT, FAILURES, HANDLER_LATENCY, LIMITER_WAIT, RESULT_BYTES, RESULT_STORE,
+                            timed)
+from worker.policies import DEFAULT_LANE, LANE_WEIGHTS, ModelPolicy, get_policy
+from worker.spool import discard, inflight, memory_size, result_size, spill
+from worker.tracing import job_trace, span
 from worker.telegram import TelegramClient, OsonIntelektServer
-from worker.handlers import HANDLERS
+from worker.handlers import HANDLERS, PROVIDERS, get_handler
+from worker.keypool import key_error, pools
 
 log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-if not BOT_TOKEN:
-    raise RuntimeError("BOT_TOKEN is not set")
+# arq tries per job (WorkerSettings.max_tries); a delivery failure after the result is saved is retried
+MAX_TRIES = int(os.getenv("ARQ_MAX_TRIES", "5"))
+DELIVERY_RETRY_S = float(os.getenv("DELIVERY_RETRY_S", "10"))
 
-tg = TelegramClient(BOT_TOKEN)
+# BOT_TOKEN is checked in on_startup (config.validate), not at import
+tg = TelegramClient(config.BOT_TOKEN)
 oson = OsonIntelektServer()
+delivery = Delivery(tg, oson)
 
 
 async def get_prompt(data: dict) -> str | None:
@@ -29,10 +41,18 @@ async def get_prompt(data: dict) -> str | None:
 
 async def runway_create(ctx, payload: dict):
     user_id = int(payload["user_id"])
-    handler = HANDLERS['runway_create']
+    with job_trace("runway_create", ctx, job_id=payload.get("job_id"), model_key="runway", user_id=user_id):
+        await _runway_create(ctx, payload, user_id)
+
+
+async def _runway_create(ctx, payload: dict, user_id: int):
+    handler = await get_handler('runway_create')
+    pool = pools[PROVIDERS['runway_create']]
+    key = await pool.pick(ctx["redis"])
     r = {'error': 'adminga murojaat qiling'}
     try:
-        r = await asyncio.wait_for(handler(payload), timeout=30)
+        with span("provider"):
+            r = await asyncio.wait_for(handler(payload, key), timeout=30)
         if not r.get('ok'):
             await tg.send_text(
                 user_id,
@@ -43,6 +63,10 @@ async def runway_create(ctx, payload: dict):
             return
     except Exception as e:
         logging.error(e)
+        if isinstance(e, httpx.HTTPStatusError) and key is not None:
+            reason = key_error(e.response.status_code, e.response.text)
+            if reason:
+                await pool.quarantine(ctx["redis"], key, reason, e)
         await tg.send_text(
             user_id,
             f"<tg-emoji emoji-id='5258474669769497337'>⚠️</tg-emoji>️ Yaratishda xatolik! Qayta urinib ko'ring\n{r.get('error')}.\n\nPrompt:\n"
@@ -51,130 +75,247 @@ async def runway_create(ctx, payload: dict):
         await oson.send_job_status(payload['job_id'], 'FAILED')
         return
 
-    m = await tg.send_text(user_id,
-                           f"<tg-emoji emoji-id='5256112304612741267'>©️</tg-emoji>️ <b>{payload['media_type']} tayyornalmoqda!</b>\n"
-                           f"<tg-emoji emoji-id='5283112212792121487'>©️</tg-emoji>️ <b>Progress: 0%</b>\n\n"
-                           f"<tg-emoji emoji-id='5249231689695115145'>©️</tg-emoji>️ <b>Prompt:</b>\n<blockquote expandable>{payload['body']['promptText']}</blockquote>")
+    with span("notify"):
+        m = await tg.send_text(user_id,
+                               f"<tg-emoji emoji-id='5256112304612741267'>©️</tg-emoji>️ <b>{payload['media_type']} tayyornalmoqda!</b>\n"
+                               f"<tg-emoji emoji-id='5283112212792121487'>©️</tg-emoji>️ <b>Progress: 0%</b>\n\n"
+                               f"<tg-emoji emoji-id='5249231689695115145'>©️</tg-emoji>️ <b>Prompt:</b>\n<blockquote expandable>{payload['body']['promptText']}</blockquote>")
     message_id = m['result']['message_id']
 
     job_data = {'task_id': r['task_id'], 'message_id': message_id, 'prompt': payload['body']['promptText'],
                 'user_id': user_id, 'media_type': payload['media_type'], 'job_id': payload['job_id'],
-                'started_at': time.time()}
+                'started_at': time.time(), 'key_id': r.get('key_id')}
 
-    await ctx["redis"].enqueue_job(
-        "poll_job",
-        job_data,
-        _defer_by=10,
-    )
+    # ✅ polled by the in-process RunwayPoller, no arq job per poll
+    with span("track", task_id=r['task_id']):
+        await ctx["runway_poller"].track(job_data)
 
 
 async def poll_job(ctx, job_data: dict):
-    user_id = int(job_data["user_id"])
-    handler = HANDLERS['runway_poll']
-    r = {'error': 'adminga murojaat qiling'}
+    # kept for poll jobs enqueued before the poller existed: hand them over
+    with job_trace("poll_job", ctx, job_id=job_data.get("job_id"), model_key="runway", user_id=job_data.get("user_id")):
+        with span("track", task_id=job_data.get("task_id")):
+            await ctx["runway_poller"].track(job_data)
+
+
+async def kling_resolved(ctx, task_id: str):
+    # enqueued by the backend when a Kling callback arrives, so the reconciler doesn't report it again
+    with job_trace("kling_resolved", ctx, model_key="kling", task_id=task_id):
+        await ctx["kling_reconciler"].untrack(task_id)
+
+
+async def runway_progress(job_data: dict, progress):
+    if not progress:
+        return
     text = (f"<tg-emoji emoji-id='5256112304612741267'>©️</tg-emoji>️ <b>{job_data['media_type']} tayyornalmoqda!</b>\n"
-            "<tg-emoji emoji-id='5283112212792121487'>©️</tg-emoji>️ <b>Progress: {progress}%</b>\n\n"
-            f"<tg-emoji emoji-id='5249231689695115145'>©️</tg-emoji>️ <b>Prompt:/b>\n<blockquote expandable>{job_data['prompt']}</blockquote>")
+            f"<tg-emoji emoji-id='5283112212792121487'>©️</tg-emoji>️ <b>Progress: {float(progress) * 100}%</b>\n\n"
+            f"<tg-emoji emoji-id='5249231689695115145'>©️</tg-emoji>️ <b>Prompt:</b>\n<blockquote expandable>{job_data['prompt']}</blockquote>")
+    await tg.edit_text(chat_id=int(job_data['user_id']), text=text, message_id=int(job_data['message_id']))
 
-    try:
-        r = await asyncio.wait_for(handler(job_data), timeout=30)
-        if not r.get('ok'):
+
+async def runway_succeeded(job_data: dict, result_url):
+    with span("status", job_id=job_data['job_id'], model_key="runway", user_id=job_data['user_id']):
+        await oson.runway_success(job_data['job_id'], results=result_url)
+
+
+async def runway_failed(job_data: dict, error):
+    with span("runway_failed", job_id=job_data['job_id'], model_key="runway", user_id=job_data['user_id']):
+        with span("notify"):
             await tg.send_text(
-                user_id,
-                f"<tg-emoji emoji-id='5258474669769497337'>⚠️</tg-emoji>️ Yaratishda xatolik! Qayta urinib ko'ring\n{r.get('error')}.\n\nPrompt:\n"
+                int(job_data['user_id']),
+                f"<tg-emoji emoji-id='5258474669769497337'>⚠️</tg-emoji>️ Yaratishda xatolik! Qayta urinib ko'ring\n{error}.\n\nPrompt:\n"
                 f"<blockquote expandable>{job_data['prompt']}</blockquote>"
             )
+        with span("status"):
             await oson.send_job_status(job_data['job_id'], 'FAILED')
-            return
-    except Exception as e:
-        logging.error(e)
-        await tg.send_text(
-            user_id,
-            f"<tg-emoji emoji-id='5258474669769497337'>⚠️</tg-emoji>️ Yaratishda xatolik! Qayta urinib ko'ring\n{r.get('error')}.\n\nPrompt:\n"
-            f"<blockquote expandable>{job_data['prompt']}</blockquote>"
-        )
-        await oson.send_job_status(job_data['job_id'], 'FAILED')
-        return
-    progress = r.get('progress', False)
-    if progress:
-        try:
-            await tg.edit_text(chat_id=user_id, text=text.format(progress=float(progress) * 100),
-                               message_id=int(job_data['message_id']))
-        except Exception as e:
-            logging.error(e)
-            pass
 
-    if r.get('status') == 'SUCCEEDED':
-        await oson.runway_success(job_data['job_id'], results=r.get('result_url'))
+
+async def kling_reconciled(job_data: dict, data: dict):
+    with span("kling_reconciled", job_id=job_data['job_id'], model_key="kling", user_id=job_data['user_id']):
+        with span("status", task_status=data.get('task_status')):
+            await oson.kling_status(data)
+
+
+async def kling_expired(job_data: dict):
+    with span("kling_expired", job_id=job_data['job_id'], model_key="kling", user_id=job_data['user_id']):
+        with span("notify"):
+            await tg.send_text(
+                int(job_data['user_id']),
+                f"<tg-emoji emoji-id='5258474669769497337'>⚠️</tg-emoji>️ Yaratishda xatolik! Qayta urinib ko'ring\nGeneration timeout.\n\nPrompt:\n"
+                f"<blockquote expandable>{job_data.get('prompt')}</blockquote>"
+            )
+        with span("status"):
+            await oson.send_job_status(job_data['job_id'], 'FAILED')
+
+
+async def adapt(limiter, model_key: str, policy: ModelPolicy, result: dict | None, latency_s: float):
+    """
+    Feed the outcome of a provider call back into the adaptive limits.
+    No result means the call timed out (callers pass None for nothing
+    else); plain provider errors say nothing about capacity and are not
+    reported.
+    """
+    if result is None:
+        outcome = "slow"
+    elif result.get("throttled"):
+        outcome = "throttled"
+    elif not result.get("ok"):
         return
+    elif policy.latency_slo_s and latency_s > policy.latency_slo_s:
+        outcome = "slow"
+    else:
+        outcome = "ok"
 
-    await ctx["redis"].enqueue_job(
-        "poll_job",
-        job_data,
-        _defer_by=5,
-    )
+    rpm_bounds = policy.rpm_bounds()
+    try:
+        conc, rpm = await limiter.feedback(
+            model_key,
+            outcome,
+            concurrency=policy.concurrency_bounds(),
+            rpm=rpm_bounds,
+            concurrency_step=policy.concurrency_step,
+            rpm_step=policy.rpm_step or (max(1.0, rpm_bounds[2] / 20) if rpm_bounds else 1.0),
+            decrease=policy.decrease,
+            cooldown_s=policy.cooldown_s or policy.window_s,
+        )
+    except Exception as e:
+        log.warning(f"Adaptive limit update failed: {model_key}: {e}")
+        return
+    if outcome != "ok":
+        log.info(f"{model_key} {outcome}: limits now concurrency={conc} rpm={rpm}")
+    if conc is not None:
+        ADAPTIVE_LIMIT.labels(model_key=model_key, limit="concurrency").set(conc)
+    if rpm is not None:
+        ADAPTIVE_LIMIT.labels(model_key=model_key, limit="rpm").set(rpm)
 
 
 async def generate_and_send(ctx, payload: dict, user_id: int):
-    redis = ctx["redis"]
-
     model_key = payload["model_key"]
-    if model_key not in POLICIES:
+    with job_trace("generate_and_send", ctx, job_id=payload.get("job_id"), model_key=model_key, user_id=user_id):
+        await _generate_and_send(ctx, payload, user_id, model_key)
+
+
+async def _generate_and_send(ctx, payload: dict, user_id: int, model_key: str):
+    # ✅ live policy: code default + overrides from Redis (python -m worker.policies)
+    policy = get_policy(model_key)
+    if policy is None:
         await tg.send_text(user_id, f"Unknown model: <code>{model_key}</code>")
         return
     if model_key not in HANDLERS:
         await tg.send_text(user_id, f"No handler for model: <code>{model_key}</code>")
         return
 
-    policy = POLICIES[model_key]
-    handler = HANDLERS[model_key]
-    limiter = RateLimiter(redis)
+    handler = await get_handler(model_key)
+    limiter = ctx["limiter"]
 
-    # ✅ LIMITS HERE (global across all VPS)
-    try:
-        await limiter.acquire(
-            model_key=model_key,
-            rpm=policy.rpm,
-            window_s=policy.window_s,
-            concurrency=policy.concurrency,
-            max_wait_s=120,  # if queue is huge, fail fast
-        )
-    except TimeoutError:
-        await tg.send_text(user_id,
-                           f"<tg-emoji emoji-id='5258474669769497337'>⚠️</tg-emoji>️ Navbat ko'p, Iltimos keginroq qayta urinib ko'ring\n\nPrompt:\n<code>{payload.get('prompt', '')}</code>")
+    results = ctx["results"]
+    job_id = payload.get("job_id")
+    stored = await results.get(job_id) if job_id is not None else None
+    if stored is not None and "delivered" in stored.steps:
+        # a retry of a job that already reached the user
+        RESULT_STORE.labels(model_key=model_key, outcome="skipped").inc()
+        log.info(f"Job {job_id} already delivered, skipping")
         return
+    # ✅ generated on an earlier try: go straight to delivery
+    result = await results.load(stored) if stored is not None else None
+    if result is not None:
+        RESULT_STORE.labels(model_key=model_key, outcome="redelivered").inc()
+
+    # ✅ one account of the provider's pool, each with its own limiter budget
+    pool = pools.get(PROVIDERS.get(model_key))
+    key = None
+    limit_key = model_key
+    if result is None:
+        if pool is not None:
+            key = await pool.pick(ctx["redis"], limiter, model_key, policy)
+            limit_key = pool.limiter_key(model_key, key)
+        # ✅ LIMITS HERE (global across all VPS)
+        try:
+            with span("limiter"), timed(LIMITER_WAIT, model_key=model_key):
+                lease = await limiter.acquire(
+                    model_key=limit_key,
+                    rpm=policy.rpm,
+                    window_s=policy.window_s,
+                    concurrency=policy.concurrency,
+                    algorithm=policy.rpm_algorithm,
+                    burst=policy.rpm_burst,
+                    prefetch=policy.rpm_prefetch,
+                    adaptive=policy.adaptive,
+                    user=user_id,
+                    user_concurrency=policy.user_concurrency,
+                    weight=LANE_WEIGHTS.get(payload.get("lane"), LANE_WEIGHTS[DEFAULT_LANE]),
+                    holder={"job_id": payload.get("job_id"), "user_id": user_id, "lane": payload.get("lane")},
+                    max_wait_s=120,  # if queue is huge, fail fast
+                )
+        except BudgetTimeout as e:
+            FAILURES.labels(model_key=model_key, reason=e.reason).inc()
+            await tg.send_text(user_id,
+                               f"<tg-emoji emoji-id='5258474669769497337'>⚠️</tg-emoji>️ Navbat ko'p, Iltimos keginroq qayta urinib ko'ring\n\nPrompt:\n<code>{payload.get('prompt', '')}</code>")
+            return
 
     prompt = await get_prompt(payload)
+    held = 0
+    # the result is in the store: a failure from here on is retried by arq, not reported
+    saved = result is not None
     try:
-        result = await asyncio.wait_for(handler(payload), timeout=policy.timeout_s)
-        logging.info(result)
+        if result is None:
+            started = time.monotonic()
+            timed_out = False
+            try:
+                with span("provider") as sp, timed(HANDLER_LATENCY, model_key=model_key):
+                    result = await asyncio.wait_for(handler(payload, key), timeout=policy.timeout_s)
+                    sp.set(ok=bool(result.get("ok")), result_bytes=len(result.get("bytes") or b""))
+            except asyncio.TimeoutError:
+                timed_out = True
+                raise
+            finally:
+                # ✅ release concurrency slot as soon as the provider is done, before any upload
+                await limiter.release(limit_key, lease)
+                # other exceptions (a failed download, a handler bug) say nothing about the provider
+                if policy.adaptive and (result is not None or timed_out):
+                    await adapt(limiter, limit_key, policy, result, time.monotonic() - started)
+            if result.get("key_error") and key is not None:
+                await pool.quarantine(ctx["redis"], key, result["key_error"], result.get("error"))
+            # ✅ large outputs wait for the upload on disk, not in memory
+            result = await spill(result)
+            held = memory_size(result)
+            inflight.add(held)
+            logging.info(result)
 
-        if not result.get("ok"):
-            await tg.send_text(
-                user_id,
-                f"<tg-emoji emoji-id='5258474669769497337'>⚠️</tg-emoji>️ Yaratishda xatolik! Qayta urinib ko'ring\n{result.get('error')}.\n\nPrompt:\n"
-                f"<blockquote expandable>{prompt}</blockquote>"
-            )
-            await oson.send_job_status(payload['job_id'], 'FAILED')
-            return
+            if result.get("throttled"):
+                FAILURES.labels(model_key=model_key, reason="throttled").inc()
+            elif not result.get("ok"):
+                FAILURES.labels(model_key=model_key, reason="provider_error").inc()
+            elif result_size(result):
+                RESULT_BYTES.labels(model_key=model_key).observe(result_size(result))
 
-        if result.get('task_id', False):
-            await tg.send_text(user_id,
-                               f"<tg-emoji emoji-id='5283112212792121487'>©️</tg-emoji>️ <b>{payload['media_type']} tayyornalmoqda!</b>\n\n"
-                               f"<tg-emoji emoji-id='5249231689695115145'>©️</tg-emoji>️ <b>Prompt:</b>\n<blockquote expandable>{prompt}</blockquote>")
-            await oson.send_job_status(payload['job_id'], 'PROCESSING', task_id=result.get('task_id'))
-            return
+            # ✅ Kling reports through its callback; recheck the task in case the callback is lost
+            if result.get("kling_kind") and job_id is not None:
+                await ctx["kling_reconciler"].track({'task_id': result['task_id'], 'kind': result['kling_kind'],
+                                                     'job_id': job_id, 'user_id': user_id, 'prompt': prompt,
+                                                     'key_id': result.get('key_id')})
 
-        mime = result["mime"]
-        ext = mime.split("/")[-1]
-        filename = f"OsonIntelektBot.{ext}"
+            # ✅ saved before delivery, so a failed upload is retried without generating again
+            if result.get("ok") and job_id is not None:
+                await results.save(job_id, result)
+                saved = True
+        else:
+            result = await spill(result)
+            held = memory_size(result)
+            inflight.add(held)
 
-        await tg.send_document(user_id, filename, result["bytes"], mime, caption="@OsonIntelektBot")
-        await tg.send_text(user_id, f"<tg-emoji emoji-id='5260416304224936047'>©️</tg-emoji>️ <b>Yakunlandi!</b>\n\n"
-                                    f"<tg-emoji emoji-id='5249231689695115145'>©️</tg-emoji>️ Prompt:\n<blockquote expandable>{prompt}</blockquote>")
-        await oson.send_job_status(payload['job_id'], 'FINISHED')
-    except Exception:
+        await delivery.deliver(payload, user_id, prompt, result, results=results,
+                               done=stored.steps if stored is not None else set())
+        if result.get("ok") and job_id is not None:
+            await results.mark(job_id, "delivered")
+    except Exception as e:
+        job_try = ctx.get("job_try", 1)
+        if saved and job_try < MAX_TRIES:
+            log.warning(f"Delivery of job {job_id} failed (try {job_try}/{MAX_TRIES}), retrying: {e!r}")
+            FAILURES.labels(model_key=model_key, reason="delivery_retry").inc()
+            raise Retry(defer=DELIVERY_RETRY_S * job_try) from e
         log.exception("Generation failed")
+        FAILURES.labels(model_key=model_key, reason="timeout" if isinstance(e, asyncio.TimeoutError) else "exception").inc()
         try:
             await oson.send_job_status(payload['job_id'], 'FAILED')
         except Exception as e:
@@ -187,5 +328,5 @@ async def generate_and_send(ctx, payload: dict, user_id: int):
             pass
         raise
     finally:
-        # ✅ release concurrency slot
-        await limiter.release(model_key)
+        inflight.sub(held)
+        await discard(result)
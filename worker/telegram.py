@@ -1,53 +1,216 @@
-import httpx
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
 
 from worker import config
+from worker.http_pool import get_client
+from worker.spool import SpooledFile
+
+log = logging.getLogger(__name__)
+
+TELEGRAM_API = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+
+# Bot API limits are per bot; these buckets are per process, so split the
+# global rate between worker processes.
+GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+GLOBAL_BURST = float(os.getenv("TG_GLOBAL_BURST", "30"))
+CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))
+CHAT_BURST = float(os.getenv("TG_CHAT_BURST", "3"))
+MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "5"))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def idle(self) -> bool:
+        return not self._lock.locked() and time.monotonic() - self.updated > self.burst / self.rate
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    async def take(self):
+        # the lock keeps waiters in arrival order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = self.blocked_until - now
+                if wait <= 0 and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep(max(wait, (1 - self.tokens) / self.rate))
 
 
 class TelegramClient:
+    """
+    Every call goes through a global and a per-chat token bucket and is
+    retried on 429 after `retry_after`. Edits are scheduled in the background:
+    an edit identical to the last text is dropped, and edits queued for the
+    same message are merged so only the latest text is sent.
+    """
+
     def __init__(self, bot_token: str):
         self.bot_token = bot_token
-        self.base = f"https://api.telegram.org/bot{bot_token}"
+        self.base = f"{TELEGRAM_API}/bot{bot_token}"
+        self._global = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self._chats: dict[int, TokenBucket] = {}
+        # (chat_id, message_id) -> text waiting to be sent / last text sent
+        self._pending_edits: dict[tuple[int, int], str] = {}
+        self._last_edits: OrderedDict[tuple[int, int], str] = OrderedDict()
+        self._edit_senders: set[tuple[int, int]] = set()
+        self._edit_tasks: set[asyncio.Task] = set()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10_000:
+                self._chats = {k: b for k, b in self._chats.items() if not b.idle()}
+            bucket = self._chats[chat_id] = TokenBucket(CHAT_RATE, CHAT_BURST)
+        return bucket
+
+    async def _call(self, method: str, chat_id: int, data: dict, files: dict | None = None,
+                    timeout: float = 30, per_chat: bool = True) -> dict:
+        # calls without a chat bucket only wait on the global one, so that is the one a 429 blocks
+        bucket = self._chat_bucket(chat_id) if per_chat else self._global
+        for attempt in range(MAX_RETRIES + 1):
+            if per_chat:
+                await bucket.take()
+            await self._global.take()
+            r = await get_client(self.base).post(f"{self.base}/{method}", data=data, files=files, timeout=timeout)
+            if r.status_code != 429 or attempt == MAX_RETRIES:
+                return r.json()
+            self._backoff(bucket, r, method, chat_id)
+
+    @staticmethod
+    def _backoff(bucket: TokenBucket, r, method: str, chat_id: int):
+        retry_after = float(r.json().get("parameters", {}).get("retry_after", 1))
+        log.warning(f"Telegram 429 on {method} chat={chat_id}, retry after {retry_after}s")
+        bucket.block(retry_after)
+
+    async def close(self):
+        # let scheduled edits go out before the HTTP pools are closed
+        if self._edit_tasks:
+            await asyncio.gather(*self._edit_tasks, return_exceptions=True)
 
     async def send_text(self, chat_id: int, text: str):
-        async with httpx.AsyncClient(timeout=30) as s:
-            a = await s.post(
-                f"{self.base}/sendMessage",
-                data={"chat_id": chat_id, "text": text, "parse_mode": "HTML"},
-            )
-            return a.json()
+        return await self._call("sendMessage", chat_id, {"chat_id": chat_id, "text": text, "parse_mode": "HTML"})
 
     async def edit_text(self, chat_id: int, text: str, message_id: int):
-        async with httpx.AsyncClient(timeout=30) as s:
-            await s.post(
-                f"{self.base}/editMessageText",
-                data={"chat_id": chat_id, "text": text, 'message_id': message_id, "parse_mode": "HTML"},
-            )
+        key = (chat_id, message_id)
+        if key not in self._pending_edits and self._last_edits.get(key) == text:
+            return
+        self._pending_edits[key] = text
+        if key in self._edit_senders:
+            return
+        self._edit_senders.add(key)
+        task = asyncio.create_task(self._send_edits(key))
+        self._edit_tasks.add(task)
+        task.add_done_callback(self._edit_tasks.discard)
+
+    async def _send_edits(self, key: tuple[int, int]):
+        chat_id, message_id = key
+        chat = self._chat_bucket(chat_id)
+        attempt = 0
+        try:
+            while key in self._pending_edits:
+                await chat.take()
+                await self._global.take()
+                # whatever arrived while we waited for the buckets wins
+                text = self._pending_edits.pop(key, None)
+                if text is None or self._last_edits.get(key) == text:
+                    continue
+                r = await get_client(self.base).post(
+                    f"{self.base}/editMessageText",
+                    data={"chat_id": chat_id, "text": text, 'message_id': message_id, "parse_mode": "HTML"},
+                    timeout=30,
+                )
+                if r.status_code == 429 and attempt < MAX_RETRIES:
+                    attempt += 1
+                    # edits always take the chat bucket, so the 429 blocks that chat
+                    self._backoff(chat, r, "editMessageText", chat_id)
+                    self._pending_edits.setdefault(key, text)
+                    continue
+                attempt = 0
+                self._last_edits[key] = text
+                self._last_edits.move_to_end(key)
+                if len(self._last_edits) > 10_000:
+                    self._last_edits.popitem(last=False)
+        except Exception as e:
+            logging.error(e)
+            self._pending_edits.pop(key, None)
+        finally:
+            self._edit_senders.discard(key)
 
     async def send_action(self, chat_id: int, action: str):
-        async with httpx.AsyncClient(timeout=10) as s:
-            await s.post(f"{self.base}/sendChatAction", data={"chat_id": chat_id, "action": action})
+        await self._call("sendChatAction", chat_id, {"chat_id": chat_id, "action": action}, timeout=10,
+                         per_chat=False)
 
-    async def send_document(self, chat_id: int, filename: str, file_bytes: bytes, mime_type: str, caption: str = ""):
-        async with httpx.AsyncClient(timeout=180) as s:
-            await self.send_action(chat_id, "upload_document")
-            files = {"document": (filename, file_bytes, mime_type)}
-            data = {"chat_id": chat_id, "caption": caption}
-            await s.post(f"{self.base}/sendDocument", data=data, files=files)
+    async def send_document(self, chat_id: int, filename: str, file: bytes | SpooledFile, mime_type: str,
+                            caption: str = ""):
+        """
+        `file` is the document bytes or a spilled result; httpx streams the
+        latter from disk in chunks (and rewinds it on a 429 retry).
+        """
+        await self.send_action(chat_id, "upload_document")
+        data = {"chat_id": chat_id, "caption": caption}
+        if isinstance(file, SpooledFile):
+            with file.open() as f:
+                files = {"document": (filename, f, mime_type)}
+                await self._call("sendDocument", chat_id, data, files=files, timeout=180)
+            return
+        files = {"document": (filename, file, mime_type)}
+        await self._call("sendDocument", chat_id, data, files=files, timeout=180)
 
 
 class OsonIntelektServer:
+    # outbox event kind -> endpoint
+    PATHS = {"job-status": "/api/job-status", "runway-status": "/api/runway/status", "kling-status": "/kling/status"}
+
     def __init__(self):
         self.base = config.BASE_URL
         self.api_key = config.SERVER_KEY
+        # takes a list of {"kind": ..., **payload}; unset until the backend has one
+        self.bulk_path = os.getenv("OSON_BULK_STATUS_PATH")
+        # set in on_startup; without it status calls are posted inline
+        self.outbox = None
 
     async def send_job_status(self, job_id: int, status: str, task_id: str | None = None):
-        async with httpx.AsyncClient(timeout=30) as s:
-            payload = {'job_id': job_id, 'status': status, 'task_id': task_id}
-            headers = {'x-telegram-init-data': self.api_key}
-            await s.post(f"{self.base}/api/job-status", json=payload, headers=headers)
+        payload = {'job_id': job_id, 'status': status, 'task_id': task_id}
+        await self._emit("job-status", payload, job_id, status)
 
     async def runway_success(self, job_id: int, results: list[str]):
-        async with httpx.AsyncClient(timeout=30) as s:
-            payload = {'job_id': job_id, 'results': results}
-            headers = {'x-telegram-init-data': self.api_key}
-            await s.post(f"{self.base}/api/runway/status", json=payload, headers=headers)
+        payload = {'job_id': job_id, 'results': results}
+        await self._emit("runway-status", payload, job_id, "RUNWAY_SUCCEEDED")
+
+    async def kling_status(self, data: dict):
+        """A Kling task as its callback would have reported it (see KlingReconciler)."""
+        await self._emit("kling-status", data, data['task_id'], data['task_status'])
+
+    async def _emit(self, kind: str, payload: dict, job_id, status: str):
+        if self.outbox is not None:
+            await self.outbox.put(kind, payload, job_id, status)
+            return
+        headers = {'x-telegram-init-data': self.api_key}
+        await get_client(self.base).post(f"{self.base}{self.PATHS[kind]}", json=payload, headers=headers, timeout=30)
+
+    async def post_event(self, kind: str, payload: dict):
+        """Used by the outbox; raises unless the backend accepted the event."""
+        headers = {'x-telegram-init-data': self.api_key}
+        r = await get_client(self.base).post(f"{self.base}{self.PATHS[kind]}", json=payload, headers=headers,
+                                             timeout=30)
+        r.raise_for_status()
+
+    async def post_bulk(self, events: list[dict]):
+        headers = {'x-telegram-init-data': self.api_key}
+        r = await get_client(self.base).post(f"{self.base}{self.bulk_path}", json={'events': events},
+                                             headers=headers, timeout=30)
+        r.raise_for_status()
@@ -0,0 +1,200 @@
+import contextvars
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+log = logging.getLogger(__name__)
+
+TRACE_SINK = os.getenv("TRACE_SINK", "")  # "", "jsonl" or "otlp"
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "oson-worker")
+
+# copied from the parent onto every child span so each line is self-describing
+JOB_ATTRS = ("job_id", "model_key", "user_id")
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "attrs", "start_ns", "end_ns", "error", "handle")
+
+    def __init__(self, name: str, parent: Optional["Span"], attrs: dict, start_ns: int | None = None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        inherited = {k: parent.attrs[k] for k in JOB_ATTRS if parent and k in parent.attrs}
+        self.attrs = {**inherited, **{k: v for k, v in attrs.items() if v is not None}}
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns = None
+        self.error = None
+        self.handle = None
+
+    def set(self, **attrs):
+        self.attrs.update({k: v for k, v in attrs.items() if v is not None})
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start_ns / 1e9,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "attrs": self.attrs,
+            "error": self.error,
+        }
+
+
+class _NoopSpan:
+    def set(self, **attrs):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+class JsonlSink:
+    """One JSON object per finished span, appended to `path`."""
+
+    def __init__(self, path: str = TRACE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._f = open(path, "a", buffering=1)
+
+    def start(self, span: Span, parent: Optional[Span]):
+        pass
+
+    def end(self, span: Span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock:
+            self._f.write(line + "\n")
+
+    def close(self):
+        self._f.close()
+
+
+class OtlpSink:
+    """
+    Forwards spans to OpenTelemetry. With no exporter the OTLP/HTTP exporter
+    (configured by the usual OTEL_EXPORTER_OTLP_* env vars) is batched; pass
+    e.g. an InMemorySpanExporter to inspect spans in-process.
+    """
+
+    def __init__(self, exporter=None):
+        from opentelemetry import trace as otel_trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, SimpleSpanProcessor
+        from opentelemetry.trace import Status, StatusCode
+
+        if exporter is None:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            processor = BatchSpanProcessor(OTLPSpanExporter())
+        else:
+            processor = SimpleSpanProcessor(exporter)
+
+        self._otel = otel_trace
+        self._error = lambda msg: Status(StatusCode.ERROR, msg)
+        self.provider = TracerProvider(resource=Resource.create({"service.name": SERVICE_NAME}))
+        self.provider.add_span_processor(processor)
+        self.tracer = self.provider.get_tracer("worker")
+
+    def start(self, span: Span, parent: Optional[Span]):
+        context = self._otel.set_span_in_context(parent.handle) if parent and parent.handle else None
+        span.handle = self.tracer.start_span(span.name, context=context, start_time=span.start_ns)
+
+    def end(self, span: Span):
+        span.handle.set_attributes({k: v if isinstance(v, (str, bool, int, float)) else str(v)
+                                    for k, v in span.attrs.items()})
+        if span.error:
+            span.handle.set_status(self._error(span.error))
+        span.handle.end(end_time=span.end_ns)
+
+    def close(self):
+        self.provider.shutdown()
+
+
+_sink = None
+_current: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("trace_span", default=None)
+
+
+def configure(sink):
+    """Install a sink (or None to disable tracing); returns the previous one."""
+    global _sink
+    previous, _sink = _sink, sink
+    return previous
+
+
+def setup_from_env():
+    if TRACE_SINK == "jsonl":
+        configure(JsonlSink(TRACE_FILE))
+    elif TRACE_SINK == "otlp":
+        configure(OtlpSink())
+    elif TRACE_SINK:
+        log.warning(f"Unknown TRACE_SINK={TRACE_SINK!r}, tracing disabled")
+
+
+def close():
+    sink = configure(None)
+    if sink is not None:
+        sink.close()
+
+
+def _start(sink, s: Span, parent: Optional[Span]):
+    try:
+        sink.start(s, parent)
+    except Exception as e:
+        log.warning(f"Trace export failed: {e}")
+
+
+def _finish(sink, s: Span, end_ns: int | None = None):
+    s.end_ns = end_ns or time.time_ns()
+    try:
+        sink.end(s)
+    except Exception as e:
+        log.warning(f"Trace export failed: {e}")
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    Times the enclosed block as a child of the current span (or as a new
+    trace). Exceptions are recorded on the span and re-raised.
+    """
+    sink = _sink
+    if sink is None:
+        yield _NOOP
+        return
+
+    parent = _current.get()
+    s = Span(name, parent, attrs)
+    _start(sink, s, parent)
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        _finish(sink, s)
+
+
+@contextmanager
+def job_trace(name: str, ctx: dict | None = None, **attrs):
+    """
+    Root span for an arq job. A `queue` child covers the time between
+    enqueue and start, taken from arq's `enqueue_time` in ctx.
+    """
+    with span(name, **attrs) as root:
+        enqueued = (ctx or {}).get("enqueue_time")
+        if _sink is not None and enqueued is not None:
+            root.set(arq_job_id=ctx.get("job_id"), job_try=ctx.get("job_try"))
+            queued = Span("queue", root, {}, start_ns=int(enqueued.timestamp() * 1e9))
+            _start(_sink, queued, root)
+            _finish(_sink, queued, end_ns=root.start_ns)
+        yield root
@@ -1,6 +1,24 @@
+import logging
 import os
 from arq.connections import RedisSettings
-from worker.tasks import generate_and_send, poll_job, runway_create
+from arq.constants import default_queue_name
+from arq.worker import Worker
+
+from worker import config, http_pool, imaging, tracing
+from worker.executor import blocking
+from worker.handlers import kieapi, runway
+from worker.kling_client import kling
+from worker.kling_reconciler import KlingReconciler
+from worker.limiter import RateLimiter
+from worker.metrics import MetricsServer
+from worker.outbox import StatusOutbox
+from worker.policies import PolicyStore
+from worker.results import ResultStore
+from worker.runway_poller import RunwayPoller
+from worker.spool import inflight
+from worker.tasks import (MAX_TRIES, generate_and_send, kling_expired, kling_reconciled, kling_resolved, poll_job,
+                          runway_create, runway_failed, runway_progress, runway_succeeded, oson, tg)
+from worker.telegram import TELEGRAM_API
 
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
@@ -9,9 +27,65 @@ REDIS_DB = int(os.getenv("REDIS_DB", "0"))
 
 ARQ_QUEUE = os.getenv("ARQ_QUEUE")
 
+log = logging.getLogger(__name__)
+
+
+async def startup(ctx):
+    # settings are checked here rather than at import, so importing the worker stays cheap
+    config.validate()
+    tracing.setup_from_env()
+
+    # one keep-alive pool per upstream, reused by every job in this process
+    await http_pool.startup(TELEGRAM_API, config.BASE_URL, kling.base, runway.BASE, kieapi.BASE)
+
+    # policies hot-reloaded from Redis, read from memory on the hot path
+    ctx["policies"] = PolicyStore(ctx["redis"])
+    await ctx["policies"].start()
+
+    # one limiter per process: it owns the pub/sub connection that wakes waiters
+    ctx["limiter"] = RateLimiter(ctx["redis"])
+    await ctx["limiter"].start()
+
+    # provider output by job_id, so retries re-deliver instead of re-generating
+    ctx["results"] = ResultStore(ctx["redis"])
+
+    # status calls to the Oson backend go through a Redis stream, off the job's critical path
+    ctx["outbox"] = StatusOutbox(ctx["redis"], oson)
+    await ctx["outbox"].start()
+    oson.outbox = ctx["outbox"]
+
+    ctx["runway_poller"] = RunwayPoller(ctx["redis"], runway_progress, runway_succeeded, runway_failed)
+    await ctx["runway_poller"].start()
+
+    # re-reports Kling tasks whose callback never reached the backend
+    ctx["kling_reconciler"] = KlingReconciler(ctx["redis"], kling, kling_reconciled, kling_expired)
+    await ctx["kling_reconciler"].start()
+
+    # the multi-queue worker (worker.multiqueue) puts its queues in ctx
+    ctx["metrics"] = MetricsServer(ctx["redis"], ctx["limiter"], ctx.get("queues") or [ARQ_QUEUE or default_queue_name])
+    await ctx["metrics"].start()
+
+
+async def shutdown(ctx):
+    # startup may have failed part way
+    for name in ("metrics", "kling_reconciler", "runway_poller", "limiter", "outbox", "policies"):
+        if name in ctx:
+            await ctx[name].close()
+    oson.outbox = None
+    await tg.close()
+    await http_pool.shutdown()
+    await config.close()
+    blocking.shutdown()
+    imaging.shutdown()
+    tracing.close()
+
+
 class WorkerSettings:
     redis_settings = RedisSettings(host=REDIS_HOST, port=REDIS_PORT, database=REDIS_DB, password=REDIS_PASSWORD )
-    functions = [generate_and_send, runway_create, poll_job]
+    functions = [generate_and_send, runway_create, poll_job, kling_resolved]
+
+    on_startup = startup
+    on_shutdown = shutdown
 
     # This worker listens to one queue (best for per-model scaling)
     queue_name = ARQ_QUEUE
@@ -23,3 +97,37 @@ class WorkerSettings:
     job_timeout = int(os.getenv("ARQ_JOB_TIMEOUT", "300"))
 
     retry_jobs = True
+    max_tries = MAX_TRIES
+
+
+class BudgetedWorker(Worker):
+    """
+    arq Worker that stops pulling new jobs while result bytes held by its
+    running jobs are over INFLIGHT_BUDGET_BYTES (see worker.spool), and
+    resumes once they drop back. Run with `python -m worker`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # False once arq stops picking for good (shutdown signal); the budget never re-enables it
+        self._pick_jobs = self.allow_pick_jobs
+        self._budget_paused = False
+
+    def may_pick(self) -> bool:
+        paused = inflight.over()
+        if paused != self._budget_paused:
+            self._budget_paused = paused
+            if paused:
+                log.warning(f"In-flight results {inflight.used} B over budget {inflight.budget} B, "
+                            f"not taking new jobs")
+            else:
+                log.info("In-flight results back under budget, taking jobs again")
+        return not paused
+
+    def handle_sig_wait_for_completion(self, signum) -> None:
+        self._pick_jobs = False
+        super().handle_sig_wait_for_completion(signum)
+
+    async def _poll_iteration(self) -> None:
+        self.allow_pick_jobs = self._pick_jobs and self.may_pick()
+        await super()._poll_iteration()